@@ -1,9 +1,13 @@
 import typing
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import gzip
-from itertools import repeat
+from itertools import accumulate, chain, repeat
 import os
-import multiprocessing
+import shutil
+import sys
+from multiprocessing import resource_tracker, shared_memory
 
 from logger import set_logger
 
@@ -13,8 +17,17 @@ CPU_COUNT = os.cpu_count()
 
 TRANSLATION_TABLE = str.maketrans("ATGCRYSWKMBDHVN", "TACGAAAAAAAAAAA")
 
+TRANSPORT_BATCH_SIZE = 10_000  # reads pairs passed to a worker at once
+FASTQ_FIELD_SEPARATOR = "\n"
+MOCK_MERGED_HEADER_OVERHEAD = len(" mock_merged_") + 2 * 20 + 1  # the suffix of the header with both read lengths
+SHARED_MEMORY_DIR = "/dev/shm"  # only 64M in docker containers by default
+
 FastqRead = namedtuple('FastqRead', ['header', 'sequence', 'quality'])
 
+# reads pairs packed into the input shared memory and the space for their merged reads in the output shared memory
+SharedBatch = namedtuple('SharedBatch', ['input_name', 'input_start', 'input_end',
+                                         'output_name', 'output_start', 'output_end'])
+
 
 def read_fastq_file_chunk(file_obj: typing.TextIO, reads_chunk_size: int) -> list[FastqRead]:
     """Reads a FASTQ file chunk and returns a list of reads."""
@@ -43,18 +56,170 @@ def mock_merge_one_reads_pair(read1: FastqRead, read2: FastqRead, inner_distance
            f"{new_read_quality}\n"
 
 
+def pack_reads_pairs(reads_pairs: list[tuple[FastqRead, FastqRead]]) -> bytes:
+    """Joins the fields of both reads of all pairs into one buffer"""
+    return FASTQ_FIELD_SEPARATOR.join(chain.from_iterable(chain.from_iterable(reads_pairs))).encode()
+
+
+def unpack_reads_pairs(buffer) -> list[tuple[FastqRead, FastqRead]]:
+    """Returns reads pairs packed by pack_reads_pairs() from any bytes-like buffer"""
+    if not len(buffer):
+        return []
+    fields = iter(str(buffer, 'utf-8').split(FASTQ_FIELD_SEPARATOR))
+    return [(FastqRead(*read1_fields), FastqRead(*read2_fields))
+            for read1_fields, read2_fields in zip(zip(fields, fields, fields), zip(fields, fields, fields))]
+
+
+def get_max_merged_reads_size(packed_reads_size: int, reads_pairs_count: int, inner_distance_size: int) -> int:
+    """Returns the upper bound of the size of mock merged reads pairs packed into packed_reads_size bytes"""
+    return packed_reads_size + reads_pairs_count * (2 * max(inner_distance_size, 0) + MOCK_MERGED_HEADER_OVERHEAD)
+
+
+def mock_merge_reads_pairs(reads_pairs: list[tuple[FastqRead, FastqRead]], inner_distance_size: int) -> bytes:
+    """Mock merges a batch of reads pairs into FASTQ records"""
+    return ''.join(mock_merge_one_reads_pair(read1, read2, inner_distance_size)
+                   for read1, read2 in reads_pairs).encode()
+
+
+def mock_merge_shared_batch(batch: SharedBatch, inner_distance_size: int) -> int:
+    """Mock merges reads pairs of the shared input memory into the shared output memory, returns the merged size"""
+    input_memory = shared_memory.SharedMemory(batch.input_name)
+    output_memory = shared_memory.SharedMemory(batch.output_name)
+    try:
+        with input_memory.buf[batch.input_start:batch.input_end] as buffer:
+            merged_reads = mock_merge_reads_pairs(unpack_reads_pairs(buffer), inner_distance_size)
+        output_memory.buf[batch.output_start:batch.output_start + len(merged_reads)] = merged_reads
+        return len(merged_reads)
+    finally:
+        input_memory.close()
+        output_memory.close()
+
+
+def get_free_shared_memory() -> float:
+    """Returns free bytes of the shared memory, unlimited if its size is unknown"""
+    if not os.path.isdir(SHARED_MEMORY_DIR):
+        return float('inf')
+    return shutil.disk_usage(SHARED_MEMORY_DIR).free
+
+
+def allocate_shared_memory(size: int) -> typing.Optional[shared_memory.SharedMemory]:
+    """
+    Creates shared memory with all its pages allocated upfront, returns None if there is no room for them:
+    pages of the tmpfs are allocated only when written otherwise, and a worker writing past its free space is killed
+    by SIGBUS.
+    """
+    memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    if not os.path.isdir(SHARED_MEMORY_DIR):
+        return memory
+    try:
+        fd = os.open(os.path.join(SHARED_MEMORY_DIR, memory.name.lstrip("/")), os.O_RDWR)
+        try:
+            os.posix_fallocate(fd, 0, memory.size)
+        finally:
+            os.close(fd)
+    except OSError:
+        memory.close()
+        memory.unlink()
+        return None
+    return memory
+
+
+class SharedBuffers:
+    """
+    Input and output shared memory of the reads pairs processed by the workers at once, reused by the next ones
+    and recreated larger, when they do not fit. Pages of both buffers are allocated when they are created,
+    so workers never write into memory the tmpfs has no room for. Buffers are unlinked on exit.
+    """
+
+    def __init__(self):
+        self.input_memory = None
+        self.output_memory = None
+        self.is_full = False
+
+    def reserve(self, input_size: int, output_size: int) -> bool:
+        """
+        Makes buffers of at least the given sizes, returns False if the shared memory has no room for both of them
+        """
+        missing_sizes = {}
+        for attribute, size in (('input_memory', input_size), ('output_memory', output_size)):
+            memory = getattr(self, attribute)
+            if memory is None or memory.size < size:
+                self._unlink(attribute)
+                missing_sizes[attribute] = size
+        if sum(missing_sizes.values()) > get_free_shared_memory():
+            return self._set_full()
+        for attribute, size in missing_sizes.items():
+            memory = allocate_shared_memory(size)
+            if memory is None:
+                return self._set_full()
+            setattr(self, attribute, memory)
+        return True
+
+    def _set_full(self) -> bool:
+        if not self.is_full:
+            logger.warning(f"No room for reads in the shared memory ({SHARED_MEMORY_DIR}), "
+                           f"passing them to workers pickled.")
+        self.is_full = True
+        return False
+
+    def _unlink(self, attribute: str):
+        memory = getattr(self, attribute)
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+            setattr(self, attribute, None)
+
+    def close(self):
+        self._unlink('input_memory')
+        self._unlink('output_memory')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def process_reads_chunk_in_parallel(fq1_reads_chunk_list: list[tuple[str, str, str]],
                                     fq2_reads_chunk_list: list[tuple[str, str, str]],
-                                    inner_distance_size: int) -> tuple[bytes]:
-    """Merges read chunk in parallel"""
-    with multiprocessing.Pool(processes=CPU_COUNT) as pool:
-        processed_reads_chunk = pool.starmap(mock_merge_one_reads_pair,
-                                             zip(fq1_reads_chunk_list, fq2_reads_chunk_list,
-                                                 repeat(inner_distance_size)))
-    return tuple(read.encode() for read in processed_reads_chunk)
+                                    inner_distance_size: int, executor: ProcessPoolExecutor,
+                                    shared_buffers: SharedBuffers) -> typing.Iterator:
+    """
+    Merges read chunk in parallel: batches of reads pairs are packed into the shared input memory,
+    workers get only their positions and write the merged reads into the shared output memory.
+    Yields the merged reads of every round of batches (valid until the next round),
+    the batches are pickled, if the shared memory has no room for them.
+    Raises BrokenProcessPool, if a worker dies.
+    """
+    reads_pairs = list(zip(fq1_reads_chunk_list, fq2_reads_chunk_list))
+    round_size = TRANSPORT_BATCH_SIZE * CPU_COUNT
+    for round_start in range(0, len(reads_pairs), round_size):
+        batches = [reads_pairs[batch_start:batch_start + TRANSPORT_BATCH_SIZE]
+                   for batch_start in range(round_start, min(round_start + round_size, len(reads_pairs)),
+                                            TRANSPORT_BATCH_SIZE)]
+        packed_batches = [pack_reads_pairs(batch) for batch in batches]
+        input_sizes = [len(packed_batch) for packed_batch in packed_batches]
+        output_sizes = [get_max_merged_reads_size(input_size, len(batch), inner_distance_size)
+                        for input_size, batch in zip(input_sizes, batches)]
+        if not shared_buffers.reserve(sum(input_sizes), sum(output_sizes)):
+            yield from executor.map(mock_merge_reads_pairs, batches, repeat(inner_distance_size))
+            continue
+        shared_batches = []
+        for packed_batch, input_end, output_end, output_size in zip(packed_batches, accumulate(input_sizes),
+                                                                    accumulate(output_sizes), output_sizes):
+            input_start = input_end - len(packed_batch)
+            shared_buffers.input_memory.buf[input_start:input_end] = packed_batch
+            shared_batches.append(SharedBatch(shared_buffers.input_memory.name, input_start, input_end,
+                                              shared_buffers.output_memory.name, output_end - output_size, output_end))
+        merged_sizes = list(executor.map(mock_merge_shared_batch, shared_batches, repeat(inner_distance_size)))
+        for shared_batch, merged_size in zip(shared_batches, merged_sizes):
+            with shared_buffers.output_memory.buf[shared_batch.output_start:
+                                                  shared_batch.output_start + merged_size] as merged_reads:
+                yield merged_reads
 
 
-def append_merged_reads_to_fastq_file(out_fq12_file_obj: gzip.GzipFile, mock_merged_read_chunk: tuple[bytes]) -> None:
+def append_merged_reads_to_fastq_file(out_fq12_file_obj: gzip.GzipFile,
+                                      mock_merged_read_chunk: typing.Iterable[bytes]) -> None:
     """Append mock merged reads into fq12 file"""
     out_fq12_file_obj.writelines(mock_merged_read_chunk)
 
@@ -63,21 +228,29 @@ def mock_merge_by_chunks(fq1_path: str, fq2_path: str, inner_distance_size: int,
                          reads_chunk_size: int, out_fq12: str) -> None:
     """Mock merge reads by chunk and append merged read to fq12 file"""
     logger.info("Going to perform mock merge reads for FASTQ1 and FASTQ2 files...")
+    resource_tracker.ensure_running()  # workers share the tracker of the shared memory with the main process
     with (gzip.open(fq1_path, "rt") as fq1_file_obj,
           gzip.open(fq2_path, "rt") as fq2_file_obj,
-          gzip.open(out_fq12, "ab") as out_fq12_file_obj):
+          gzip.open(out_fq12, "ab") as out_fq12_file_obj,
+          ProcessPoolExecutor(max_workers=CPU_COUNT) as executor,
+          SharedBuffers() as shared_buffers):
 
         fq1_reads_chunk_list = read_fastq_file_chunk(fq1_file_obj, reads_chunk_size)
         fq2_reads_chunk_list = read_fastq_file_chunk(fq2_file_obj, reads_chunk_size)
 
         while fq1_reads_chunk_list and fq2_reads_chunk_list:
             mock_merged_read_chunk = process_reads_chunk_in_parallel(fq1_reads_chunk_list, fq2_reads_chunk_list,
-                                                                     inner_distance_size)
+                                                                     inner_distance_size, executor, shared_buffers)
 
-            append_merged_reads_to_fastq_file(out_fq12_file_obj, mock_merged_read_chunk)
+            try:
+                append_merged_reads_to_fastq_file(out_fq12_file_obj, mock_merged_read_chunk)
+            except BrokenProcessPool as e:
+                logger.critical(f"A mock merging worker died unexpectedly: {e}, exiting...")
+                sys.exit(1)
+            merged_reads_count = min(len(fq1_reads_chunk_list), len(fq2_reads_chunk_list))
 
             fq1_reads_chunk_list = read_fastq_file_chunk(fq1_file_obj, reads_chunk_size)
             fq2_reads_chunk_list = read_fastq_file_chunk(fq2_file_obj, reads_chunk_size)
-            logger.info(f"Successfully processed chunk with '{len(mock_merged_read_chunk)}' reads.")
+            logger.info(f"Successfully processed chunk with '{merged_reads_count}' reads.")
 
     logger.info("All reads successfully merged.")
@@ -0,0 +1,91 @@
+import errno
+import gzip
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker
+
+from pytest import fixture, raises
+
+import mock_merge
+from mock_merge import (FastqRead, SharedBuffers, mock_merge_by_chunks, mock_merge_one_reads_pair, pack_reads_pairs,
+                        process_reads_chunk_in_parallel, unpack_reads_pairs)
+
+INNER_DISTANCE_SIZE = 3
+
+
+def create_reads(reads_count: int, read_num: int) -> list[FastqRead]:
+    return [FastqRead(f"@read{i} {read_num}:N:0:1", "ACGTN"[i % 5] * (i % 7 + 1), "K" * (i % 7 + 1))
+            for i in range(reads_count)]
+
+
+def get_expected_merged_reads(fq1_reads: list[FastqRead], fq2_reads: list[FastqRead]) -> bytes:
+    return "".join(mock_merge_one_reads_pair(read1, read2, INNER_DISTANCE_SIZE)
+                   for read1, read2 in zip(fq1_reads, fq2_reads)).encode()
+
+
+def merge_chunk(fq1_reads: list[FastqRead], fq2_reads: list[FastqRead], shared_buffers: SharedBuffers) -> bytes:
+    resource_tracker.ensure_running()
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        return b"".join(bytes(merged_reads) for merged_reads in process_reads_chunk_in_parallel(
+            fq1_reads, fq2_reads, INNER_DISTANCE_SIZE, executor, shared_buffers))
+
+
+def kill_worker(*args):
+    os._exit(1)
+
+
+@fixture
+def small_batches(monkeypatch):
+    monkeypatch.setattr(mock_merge, "TRANSPORT_BATCH_SIZE", 7)
+    monkeypatch.setattr(mock_merge, "CPU_COUNT", 2)
+
+
+def test_pack_reads_pairs():
+    reads_pairs = list(zip(create_reads(10, 1), create_reads(10, 2)))
+    assert unpack_reads_pairs(pack_reads_pairs(reads_pairs)) == reads_pairs
+    assert unpack_reads_pairs(pack_reads_pairs([])) == []
+
+
+def test_process_reads_chunk_in_shared_memory(small_batches):
+    fq1_reads, fq2_reads = create_reads(40, 1), create_reads(39, 2)
+    with SharedBuffers() as shared_buffers:
+        assert merge_chunk(fq1_reads, fq2_reads, shared_buffers) == get_expected_merged_reads(fq1_reads, fq2_reads)
+        assert shared_buffers.input_memory is not None and not shared_buffers.is_full
+    assert shared_buffers.input_memory is None and shared_buffers.output_memory is None
+
+
+def test_process_reads_chunk_without_room_for_both_buffers(small_batches, monkeypatch):
+    fq1_reads, fq2_reads = create_reads(40, 1), create_reads(40, 2)
+    input_size = len(pack_reads_pairs(list(zip(fq1_reads, fq2_reads))[:14]))
+    monkeypatch.setattr(mock_merge, "get_free_shared_memory", lambda: input_size + 1)  # room for the input only
+    with SharedBuffers() as shared_buffers:
+        assert merge_chunk(fq1_reads, fq2_reads, shared_buffers) == get_expected_merged_reads(fq1_reads, fq2_reads)
+        assert shared_buffers.is_full
+        assert shared_buffers.input_memory is None and shared_buffers.output_memory is None
+
+
+def test_process_reads_chunk_when_pages_can_not_be_allocated(small_batches, monkeypatch):
+    def fail_fallocate(fd, offset, length):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    monkeypatch.setattr(os, "posix_fallocate", fail_fallocate)
+    fq1_reads, fq2_reads = create_reads(20, 1), create_reads(20, 2)
+    with SharedBuffers() as shared_buffers:
+        assert merge_chunk(fq1_reads, fq2_reads, shared_buffers) == get_expected_merged_reads(fq1_reads, fq2_reads)
+        assert shared_buffers.is_full
+
+
+def test_dead_worker_is_detected(small_batches, monkeypatch, tmp_path):
+    monkeypatch.setattr(mock_merge, "mock_merge_shared_batch", kill_worker)
+    fq1_reads, fq2_reads = create_reads(20, 1), create_reads(20, 2)
+    with SharedBuffers() as shared_buffers, raises(BrokenProcessPool):
+        merge_chunk(fq1_reads, fq2_reads, shared_buffers)
+
+    fastq_paths = []
+    for read_num, reads in ((1, fq1_reads), (2, fq2_reads)):
+        fastq_paths.append(str(tmp_path / f"R{read_num}.fastq.gz"))
+        with gzip.open(fastq_paths[-1], "wt") as f:
+            f.writelines(f"{read.header}\n{read.sequence}\n+\n{read.quality}\n" for read in reads)
+    with raises(SystemExit):
+        mock_merge_by_chunks(*fastq_paths, INNER_DISTANCE_SIZE, 100, str(tmp_path / "R12.fastq.gz"))
@@ -0,0 +1,142 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable, Optional
+
+import run
+from extract import init_worker, process_batch
+from logger import set_logger
+from memory import get_peak_rss
+from pattern import get_prepared_pattern_and_umi_len
+from stream import PairedFastqReader
+from synthetic import DESIGNS, ReadDesign, write_read_pairs
+
+logger = set_logger(name=__file__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark of pyumi on synthetic read pairs')
+    parser.add_argument('--designs', help='Read designs to benchmark', nargs='+', choices=list(DESIGNS),
+                        default=list(DESIGNS))
+    parser.add_argument('--read-pairs', help='Read pairs count of every design', type=int, default=200_000)
+    parser.add_argument('--read-length', help='Length of the synthetic reads', type=int, default=150)
+    parser.add_argument('--error-rate', help='Substitution rate in the adapters', type=float, default=0.01)
+    parser.add_argument('--max-error', help='Max error of the patterns like in pyumi', type=int, default=1)
+    parser.add_argument('--seed', help='Seed of the synthetic reads', type=int, default=0)
+    parser.add_argument('--repeats', help='Runs of every stage, the fastest one is reported', type=int, default=3)
+    parser.add_argument('--work-dir', help='Directory for the synthetic and output FASTQs, temporary by default')
+    parser.add_argument('--out-json', help='Output json with reads per second and peak memory of every stage',
+                        required=True)
+    return parser.parse_args()
+
+
+def run_isolated(func: Callable, *args) -> Optional[dict]:
+    """Runs func in a forked process, so its peak memory is not mixed with other runs,
+    returns its result with the peak RSS of the process and of its workers,
+    None if the process failed (func raised or exited) without a result."""
+    def target(connection, *target_args):
+        result = func(*target_args)
+        connection.send({**result, "peak_rss": get_peak_rss()})
+        connection.close()
+
+    context = multiprocessing.get_context('fork')
+    parent_connection, child_connection = context.Pipe(duplex=False)
+    process = context.Process(target=target, args=(child_connection, *args))
+    process.start()
+    child_connection.close()  # otherwise recv() waits for the copy of the parent, if the child exits without a result
+    try:
+        result = parent_connection.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        logger.error(f'Benchmarked {func.__name__} failed with exit code {process.exitcode}')
+    return result
+
+
+def benchmark_match(fq1_path: str, fq2_path: str, design: ReadDesign, max_error: int) -> dict:
+    """Times process_batch on the read pairs parsed in advance, in one process."""
+    fq1_pattern, _ = get_prepared_pattern_and_umi_len(design.pattern, max_error=max_error)
+    init_worker(fq1_pattern, '', design.find_in_reverse_complement)
+    batches = list(PairedFastqReader(fq1_path, fq2_path).iter_batches())
+    start_time = time.perf_counter()
+    stats_list = [process_batch(read_pairs).stats for read_pairs in batches]
+    seconds = time.perf_counter() - start_time
+    discarded_pairs = sum(stats['discarded_pairs'] for stats in stats_list)
+    return {"seconds": seconds, "read_pairs": sum(map(len, batches)), "discarded_pairs": discarded_pairs}
+
+
+def benchmark_end_to_end(fq1_path: str, fq2_path: str, design: ReadDesign, max_error: int, work_dir: str) -> dict:
+    """Times run.run() from the input FASTQs to the compressed outputs and the json, runs in a forked process."""
+    out_json = os.path.join(work_dir, f'{design.name}_pyumi.json')
+    sys.argv = ['run.py', '--in-fq1', fq1_path, '--in-fq2', fq2_path, '--fq1-pattern', design.pattern,
+                '--max-error', str(max_error),
+                '--out-fq1', os.path.join(work_dir, f'{design.name}_pR1.fastq.gz'),
+                '--out-fq2', os.path.join(work_dir, f'{design.name}_pR2.fastq.gz'),
+                '--out-json', out_json]
+    if design.find_in_reverse_complement:
+        sys.argv.append('--find-in-reverse-complement')
+    args = run.parse_args()  # the defaults of the real command line
+    start_time = time.perf_counter()
+    run.run(args)
+    seconds = time.perf_counter() - start_time
+    with open(out_json) as f:
+        metrics = json.load(f)
+    return {"seconds": seconds, "read_pairs": metrics['summary']['before_filtering']['total_reads'],
+            "discarded_pairs": metrics['pairing']['discarded_pairs']}
+
+
+def benchmark_design(design: ReadDesign, args: argparse.Namespace, work_dir: str) -> list[dict]:
+    fq1_path = os.path.join(work_dir, f'{design.name}_R1.fastq.gz')
+    fq2_path = os.path.join(work_dir, f'{design.name}_R2.fastq.gz')
+    write_read_pairs(fq1_path, fq2_path, design, args.read_pairs, args.error_rate, args.read_length, args.seed)
+
+    results = []
+    for stage, func, func_args in (('match', benchmark_match, (fq1_path, fq2_path, design, args.max_error)),
+                                   ('end_to_end', benchmark_end_to_end,
+                                    (fq1_path, fq2_path, design, args.max_error, work_dir))):
+        runs = [run_isolated(func, *func_args) for _ in range(args.repeats)]
+        if None in runs:
+            results.append({"design": design.name, "pattern": design.pattern, "stage": stage, "failed": True})
+            continue
+        fastest_run = min(runs, key=lambda result: result['seconds'])
+        result = {"design": design.name, "pattern": design.pattern, "stage": stage,
+                  "read_pairs": fastest_run['read_pairs'],
+                  "discarded_pairs": fastest_run['discarded_pairs'],
+                  "seconds": round(fastest_run['seconds'], 4),
+                  "reads_per_second": round(fastest_run['read_pairs'] / fastest_run['seconds']),
+                  "peak_rss": {process: max(run_result['peak_rss'][process] for run_result in runs)
+                               for process in ('main', 'children')}}
+        logger.info(f"{design.name} {stage}: {result['reads_per_second']} read pairs/s, "
+                    f"peak RSS {result['peak_rss']['main']} bytes")
+        results.append(result)
+    return results
+
+
+def main(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.work_dir or temp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        results = [result for design_name in args.designs
+                   for result in benchmark_design(DESIGNS[design_name], args, work_dir)]
+    report = {"config": {"read_pairs": args.read_pairs, "read_length": args.read_length,
+                         "error_rate": args.error_rate, "max_error": args.max_error, "seed": args.seed,
+                         "repeats": args.repeats, "cpu_count": os.cpu_count(),
+                         "python": platform.python_version()},
+              "results": results}
+    with open(args.out_json, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f'Benchmark results are saved into {args.out_json}')
+    failed_stages = [f"{result['design']} {result['stage']}" for result in results if result.get('failed')]
+    if failed_stages:
+        logger.critical(f'Failed benchmark stages: {failed_stages}, exiting...')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(parse_args())
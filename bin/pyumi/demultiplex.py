@@ -0,0 +1,118 @@
+import csv
+import os
+import sys
+from collections import Counter
+from contextlib import ExitStack
+
+from extract import SampleRecords
+from logger import set_logger
+from pattern import NORMAL_NUCLEOTIDES
+from stream import CompressedFastqWriter, DEFAULT_COMPRESSION_LEVEL, DEFAULT_COMPRESSION_THREADS
+
+logger = set_logger(name=__file__)
+
+
+def load_sample_barcodes(sample_barcodes_path: str) -> dict[str, str]:
+    """
+    Loads the tab-separated table of sample names and sample barcodes (an optional header line is skipped),
+    returns the sample of each barcode.
+
+    Example:
+    sample1	ACGTAC
+    sample2	TTGCAG
+    """
+    barcode_to_sample = {}
+    with open(sample_barcodes_path, newline='') as f:
+        for line_number, row in enumerate(csv.reader(f, delimiter='\t'), start=1):
+            if not row or not ''.join(row).strip():
+                continue
+            if len(row) != 2:
+                logger.critical(f'Expected sample and barcode in line {line_number} of {sample_barcodes_path}, '
+                                f'got {row}, exiting...')
+                sys.exit(1)
+            sample, barcode = row[0].strip(), row[1].strip().upper()
+            if line_number == 1 and not set(barcode) <= set(NORMAL_NUCLEOTIDES):
+                continue  # header
+            if not barcode or not set(barcode) <= set(NORMAL_NUCLEOTIDES) or not sample:
+                logger.critical(f'Invalid sample {sample} or barcode {barcode} in line {line_number} '
+                                f'of {sample_barcodes_path}, exiting...')
+                sys.exit(1)
+            if barcode in barcode_to_sample:
+                logger.critical(f'Barcode {barcode} is duplicated in {sample_barcodes_path}, exiting...')
+                sys.exit(1)
+            barcode_to_sample[barcode] = sample
+    if not barcode_to_sample:
+        logger.critical(f'No sample barcodes found in {sample_barcodes_path}, exiting...')
+        sys.exit(1)
+    logger.info(f'Loaded {len(barcode_to_sample)} sample barcodes from {sample_barcodes_path}')
+    return barcode_to_sample
+
+
+def check_sample_barcode_lengths(barcode_to_sample: dict[str, str], sample_barcode_length: int):
+    """Warns about barcodes of the table, which can not be matched by the sample barcode (SBC:) of the pattern."""
+    unmatched_barcodes = [barcode for barcode in barcode_to_sample if len(barcode) != sample_barcode_length]
+    if unmatched_barcodes:
+        logger.warning(f'Sample barcodes {unmatched_barcodes} differ in length from the sample barcode '
+                       f'of the pattern ({sample_barcode_length}), their read pairs will be undetermined.')
+
+
+def get_sample_path(output_dir: str, sample: str, output_path: str) -> str:
+    """Returns the path of a sample output in output_dir.
+    Example: (out, s1, path/to/pR1.fastq.gz) -> out/s1_pR1.fastq.gz
+    """
+    return os.path.join(output_dir, f'{sample}_{os.path.basename(output_path)}')
+
+
+class SampleWriters:
+    """Writes read pairs of each sample into its own pair of compressed FASTQs in output_dir and counts them."""
+
+    def __init__(self, barcode_to_sample: dict[str, str], output_dir: str, out_fq1_path: str, out_fq2_path: str,
+                 compression_level=DEFAULT_COMPRESSION_LEVEL, compression_threads=DEFAULT_COMPRESSION_THREADS):
+        self.barcode_to_sample = barcode_to_sample
+        self.output_dir = output_dir
+        self.out_fq1_path = out_fq1_path
+        self.out_fq2_path = out_fq2_path
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.reads_counts = Counter()
+        self._writers = {}
+        self._exit_stack = None
+
+    def __enter__(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._exit_stack = ExitStack()
+        for sample in sorted(set(self.barcode_to_sample.values())):
+            self._writers[sample] = tuple(
+                self._exit_stack.enter_context(CompressedFastqWriter(self.get_path(sample, out_path),
+                                                                     self.compression_level,
+                                                                     self.compression_threads))
+                for out_path in (self.out_fq1_path, self.out_fq2_path))
+        return self
+
+    @property
+    def samples_count(self) -> int:
+        return len(set(self.barcode_to_sample.values()))
+
+    def get_path(self, sample: str, output_path: str) -> str:
+        return get_sample_path(self.output_dir, sample, output_path)
+
+    def write(self, samples: dict[str, SampleRecords]):
+        for sample, sample_records in samples.items():
+            fq1_writer, fq2_writer = self._writers[sample]
+            fq1_writer.write(sample_records.fq1_records)
+            fq2_writer.write(sample_records.fq2_records)
+            self.reads_counts[sample] += sample_records.reads_count
+
+    @property
+    def compress_time(self) -> float:
+        return sum(writer.compress_time for writers in self._writers.values() for writer in writers)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._exit_stack.__exit__(exc_type, exc_value, traceback)
+
+    def get_metrics(self) -> dict:
+        sample_to_barcodes = {}
+        for barcode, sample in self.barcode_to_sample.items():
+            sample_to_barcodes.setdefault(sample, []).append(barcode)
+        return {sample: {"sample_barcodes": barcodes, "read_pairs": self.reads_counts[sample]}
+                for sample, barcodes in sorted(sample_to_barcodes.items())}
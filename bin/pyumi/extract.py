@@ -1,20 +1,32 @@
-import os
-import tempfile
-import pyfastx
-import regex
-import multiprocessing
-from collections import namedtuple
-from itertools import cycle
+import time
+from collections import Counter, namedtuple
+from typing import Optional, Union
+
+import numpy as np
 
 from logger import set_logger
+from matcher import BUDGET_EXCEEDED, PLACEMENTS, TieredMatcher, create_matcher
+from pattern import TRANSLATION_TABLE
+from positional import extract_fixed_umis
+from shards import FastqShard, read_shard_pairs
+from transport import SharedBatch, read_shared_batch
+from umi_table import summarize_umis
+from whitelist import UmiCorrector
 
 logger = set_logger(name=__file__)
-TEMPDIR_NAME = tempfile.gettempdir()
 
-BarcodeMarkup = namedtuple('BarcodeMarkup', ['sequence', 'quality'])
-PatternMarkup = namedtuple('PatternMarkup', ['barcode', 'start', 'end'])
+# FASTQ records of a batch are joined and encoded into one bytes buffer per mate,
+# parse_time is the time of reading the batch by the worker (None if it was parsed by the main process),
+# placements are the ones the batch was searched in (None for all placements)
+BatchResult = namedtuple('BatchResult', ['fq1_records', 'fq2_records', 'reads_count', 'stats', 'placement_hits',
+                                         'umis', 'samples', 'error_counts', 'process_time', 'parse_time',
+                                         'placements'])
+SampleRecords = namedtuple('SampleRecords', ['fq1_records', 'fq2_records', 'reads_count'])
+# result of a shard and its reads without a mate in the shard (by read ID)
+ShardResult = namedtuple('ShardResult', ['batch_result', 'pending_reads1', 'pending_reads2'])
 
-TRANSLATION_TABLE = bytes.maketrans(b"ATGCRYSWKMBDHVN", b"TACGAAAAAAAAAAA")
+# patterns compiled once per worker process by init_worker()
+WORKER_CONTEXT = {}
 
 
 def get_reverse_complement(sequence: str) -> str:
@@ -24,80 +36,102 @@ def get_reverse_complement(sequence: str) -> str:
     return sequence.translate(TRANSLATION_TABLE)[::-1]
 
 
-def write_new_reads_to_file(reads: list[str]) -> str:
-    with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_file:
-        temp_file.writelines(reads)
-        return temp_file.name
-
+def get_barcode(match, barcode_type='UMI') -> str:
+    return ''.join(match.captures(barcode_type)).replace('N', 'A')
 
-def add_barcode_to_the_header(header: str, umi_seq: str, barcode_type='UMI'):
-    """Adds UMI to the header.
 
-    Example:
-    @M01691:10:000000000-A7F7L:1:1101:13747:1534 2:N:0:1 UMI:CCGTGAGCTGTTT
+def create_barcoded_read(read: tuple, match, header_barcode_types=()) -> tuple[str, str, str]:
     """
-    return ' '.join([header, f'{barcode_type}:{umi_seq}']) if umi_seq else header
-
-
-def get_barcode_fields(read, match, barcode_type='UMI'):
-    barcode_seq = ''.join(match.captures(barcode_type)).replace('N', 'A')
-    barcode_start_end_indices = match.spans(barcode_type)
-    barcode_quality = ''
-    for (barcode_start, barcode_end) in barcode_start_end_indices:
-        barcode_quality += read[2][barcode_start:barcode_end]
-    pattern_match_start, pattern_match_end = match.span()
-    return PatternMarkup(BarcodeMarkup(barcode_seq, barcode_quality), pattern_match_start, pattern_match_end)
-
-
-def replace_umi_to_the_seq_start(read_seq: str, read_quality: str,
-                                 pattern: PatternMarkup) -> tuple[str, str]:
-    if not read_seq:
-        return read_seq, read_quality
-    new_read_seq = pattern.barcode.sequence + remove_subseq(read_seq, pattern.start, pattern.end)
-    new_read_quality = pattern.barcode.quality + remove_subseq(read_quality, pattern.start, pattern.end)
-    return new_read_seq, new_read_quality
-
-
-def remove_subseq(sequence: str, subseq_start: int, subseq_end: int) -> str:
-    if subseq_start == 0 and subseq_end == 0:
-        return sequence
-    return sequence[:subseq_start] + sequence[subseq_end:]
-
-
-def match_in_reverse_complement(read_seq, pattern):
-    read_seq_rc = get_reverse_complement(read_seq)
-    match = regex.search(pattern, read_seq_rc, regex.BESTMATCH)
-    return match
-
-
-def match_barcode(read1: list[str], read2: list[str], pattern: str,
-                  is_read2: bool, find_umi_in_rc=True) -> tuple[PatternMarkup, list[str], list[str]]:
+    Returns the new FASTQ record of the matched read, its UMI and sample barcode.
+    UMI is moved to the read start, the other barcodes are removed from the read and added to the header:
+    @M01691:10:000000000-A7F7L:1:1101:13747:1534 2:N:0:1 SBC:ACGTAC
+    The record is assembled from slices of the read in one step, without intermediate per-read objects.
+    """
+    header, sequence, quality = read
+    umi = get_barcode(match)
+    umi_quality = ''.join([quality[start:end] for start, end in match.spans('UMI')])
+    header_barcodes = {barcode_type: get_barcode(match, barcode_type) for barcode_type in header_barcode_types}
+    header += ''.join([f' {barcode_type}:{barcode}' for barcode_type, barcode in header_barcodes.items() if barcode])
+    match_start, match_end = match.span()
+    return (f"@{header}\n{umi}{sequence[:match_start]}{sequence[match_end:]}\n+\n"
+            f"{umi_quality}{quality[:match_start]}{quality[match_end:]}\n",
+            umi, header_barcodes.get('SBC', ''))
 
-    def find_match(read):
-        match = regex.search(pattern, read[1], regex.BESTMATCH)
-        if not match and (find_umi_in_rc or not is_read2):
-            match = match_in_reverse_complement(read[1], pattern)
-        return match
 
-    match1 = find_match(read1)
-    match2 = find_match(read2)
+def get_reverse_complement_search_sequence(read_seq: str, pattern: TieredMatcher) -> str:
+    if pattern.search_window:  # the prefix of reverse complement is the reverse complement of the suffix
+        read_seq = read_seq[-pattern.search_window:]
+    return get_reverse_complement(read_seq)
 
-    if not match1 and match2:
-        read1, read2 = read2, read1
 
-    return (get_barcode_fields(read1, match1) if match1 else
-            PatternMarkup(BarcodeMarkup('', ''), 0, 0)), read1, read2
+def count_placement_hits(pattern: TieredMatcher, placement: str, matches: list):
+    hits_count = sum(1 for match in matches if match)
+    if hits_count:
+        pattern.placement_hits[placement] += hits_count
 
 
-def process_umi_in_read(read1: list[str], read2: list[str], pattern: str, find_umi_in_rc=True, is_read2=False,
-                        keep_reads_without_adapter=False, add_to_the_header=False):
-    pattern_markup, read1, read2 = match_barcode(read1, read2, pattern, is_read2, find_umi_in_rc)
-    if pattern_markup.barcode.sequence or keep_reads_without_adapter:
-        read_header = add_barcode_to_the_header(read1[0], pattern_markup.barcode.sequence) \
-            if add_to_the_header else read1[0]
-        read_seq, read_quality = replace_umi_to_the_seq_start(read1[1], read1[2], pattern_markup)
-        return create_new_read(read_header, read_seq, read_quality)
-    return ''
+def find_matches(reads: list[tuple], pattern: TieredMatcher, forward_placement: str, rc_placement: str,
+                 search_in_rc: bool, placements=PLACEMENTS) -> list:
+    """
+    Searches the pattern in the forward reads and then in reverse complement of the reads without a match,
+    only in the given placements, and counts the placement hits. Returns the match of every read or None,
+    BUDGET_EXCEEDED if a search of the read without a match exceeded the match_timeout budget.
+    Reverse complement is searched by the reverse complemented pattern in the reads themselves if it is compiled.
+    """
+    matches = [None] * len(reads)
+    if forward_placement in placements:
+        matches = pattern.search_many([read[1] for read in reads])
+        count_placement_hits(pattern, forward_placement, matches)
+    if search_in_rc and rc_placement in placements:
+        unmatched_indices = [i for i, match in enumerate(matches) if not match]
+        if pattern.rc_exact_pattern is not None:
+            rc_matches = pattern.search_many_reverse_complement([reads[i][1] for i in unmatched_indices])
+        else:
+            rc_matches = pattern.search_many([get_reverse_complement_search_sequence(reads[i][1], pattern)
+                                              for i in unmatched_indices])
+        for i, match in zip(unmatched_indices, rc_matches):
+            if match or matches[i] is None:
+                matches[i] = match
+        count_placement_hits(pattern, rc_placement, rc_matches)
+    return matches
+
+
+def match_barcodes(reads: list[tuple], mate_reads: list[tuple], pattern: TieredMatcher, is_read2: bool,
+                   find_umi_in_rc=True, placements=PLACEMENTS) -> list[tuple]:
+    """
+    Searches the pattern in a batch of reads and their mates only in the given placements (mate and strand).
+    Returns the match (None if nothing found, BUDGET_EXCEEDED if a search of the pair exceeded the match_timeout
+    budget) of every read with the read and its mate.
+    """
+    search_in_rc = find_umi_in_rc or not is_read2
+    matches1 = find_matches(reads, pattern, 'fwd', 'rc', search_in_rc, placements)
+    matches2 = find_matches(mate_reads, pattern, 'mate_fwd', 'mate_rc', search_in_rc, placements)
+
+    matched_reads = []
+    for read1, read2, match1, match2 in zip(reads, mate_reads, matches1, matches2):
+        if not match1 and match2:
+            read1, read2 = read2, read1
+        elif not match1 and match2 is BUDGET_EXCEEDED:
+            match1 = match2
+        matched_reads.append((match1, read1, read2))
+    return matched_reads
+
+
+def process_umis_in_reads(reads: list[tuple], mate_reads: list[tuple], pattern: TieredMatcher,
+                          find_umi_in_rc=True, is_read2=False,
+                          placements=PLACEMENTS) -> list[tuple[str, str, str, bool]]:
+    """Returns the new FASTQ record, the UMI and the sample barcode of every read in a batch,
+    empty strings if nothing found, and whether the read was left without a match after exceeding the match budget.
+    The tier of the match kept for every read is counted once."""
+    header_barcode_types = pattern.header_barcode_types
+    processed_reads = []
+    for match, read, _ in match_barcodes(reads, mate_reads, pattern, is_read2, find_umi_in_rc, placements):
+        if match:
+            pattern.count_match(match)
+            processed_reads.append((*create_barcoded_read(read, match, header_barcode_types), False))
+        else:
+            processed_reads.append(('', '', '', match is BUDGET_EXCEEDED))
+    return processed_reads
 
 
 def create_new_read(header: str, seq: str, quality: str) -> str:
@@ -107,44 +141,159 @@ def create_new_read(header: str, seq: str, quality: str) -> str:
            f"{quality}\n"
 
 
-def process_barcode(read1: list[str], read2: list[str], read1_pattern: str,
-                    read2_pattern: str, find_umi_in_rc: bool) -> tuple[str, str]:
-    new_read1, new_read2 = create_new_read(*read1), create_new_read(*read2)
-    if read1_pattern:
-        new_read1 = process_umi_in_read(read1, read2, read1_pattern, find_umi_in_rc=find_umi_in_rc)
-    if read2_pattern:
-        new_read2 = process_umi_in_read(read2, read1, read2_pattern, find_umi_in_rc=find_umi_in_rc, is_read2=True)
-    return new_read1, new_read2
-
-
-def get_processed_reads(reads1: list[str], reads2: list[str], read1_pattern: str,
-                        read2_pattern: str, find_umi_in_rc: bool) -> tuple[list, list]:
-    with multiprocessing.Pool(processes=os.cpu_count()) as pool:
-        args_list = list(zip(reads1, reads2, cycle([read1_pattern]), cycle([read2_pattern]), cycle([find_umi_in_rc])))
-        processed_reads = [read for read in pool.starmap(process_barcode, args_list)]
-    return map(list, zip(*processed_reads))
-
-
-def get_fastq_reads(in_fq1_path: str, in_fq2_path: str) -> tuple[list[str], list[str]]:
-    logger.info(f'Reading FASTQ files...')
-
-    reads1 = [seq for seq in pyfastx.Fastq(in_fq1_path, build_index=False, full_name=True)]
-    reads2 = [seq for seq in pyfastx.Fastq(in_fq2_path, build_index=False, full_name=True)]
-
-    logger.info(f'Initial read count in FASTQ: {len(reads1)}')
-    logger.info(f'FASTQ files have been read.')
-
-    return reads1, reads2
-
-
-def get_processed_fastqs(raw_fq1_path: str, raw_fq2_path: str, read1_pattern: str, read2_pattern: str,
-                         find_umi_in_rc: bool) -> tuple[str, str, int, int]:
-    reads1, reads2 = get_fastq_reads(raw_fq1_path, raw_fq2_path)
-    processed_reads1, processed_reads2 = get_processed_reads(reads1, reads2, read1_pattern, read2_pattern, find_umi_in_rc)
-
-    out_fq1_path = write_new_reads_to_file(processed_reads1)
-    out_fq2_path = write_new_reads_to_file(processed_reads2)
+def process_reads(reads: list[tuple], mate_reads: list[tuple], matcher: Optional[TieredMatcher],
+                  find_umi_in_rc: bool, is_read2=False,
+                  placements=PLACEMENTS) -> tuple[list[str], list[str], list[str], list[bool]]:
+    """
+    Processes one mate of the read pairs in a batch and returns their new FASTQ records, UMIs, sample barcodes
+    and flags of the reads left without a match after exceeding the match budget.
+    Anchored adapter-free patterns are cut positionally from the whole batch at once,
+    reads that can not be cut this way go through the regex matcher.
+    """
+    if matcher is None:
+        return [create_new_read(*read) for read in reads], [''] * len(reads), [''] * len(reads), [False] * len(reads)
+
+    if not matcher.fixed_umi_len:
+        processed_reads = process_umis_in_reads(reads, mate_reads, matcher, find_umi_in_rc=find_umi_in_rc,
+                                                is_read2=is_read2, placements=placements)
+        return tuple(map(list, zip(*processed_reads))) if processed_reads else ([], [], [], [])
+
+    new_sequences, is_unmatched = extract_fixed_umis(reads, matcher.fixed_umi_len)
+    new_reads = [create_new_read(read[0], new_sequence, read[2]) for read, new_sequence in zip(reads, new_sequences)]
+    umis = [new_sequence[:matcher.fixed_umi_len] for new_sequence in new_sequences]
+    sample_barcodes = [''] * len(reads)  # only UMIs are cut positionally
+    budget_exceeded = [False] * len(reads)
+    unmatched_indices = np.flatnonzero(is_unmatched).tolist()
+    processed_reads = process_umis_in_reads([reads[i] for i in unmatched_indices],
+                                            [mate_reads[i] for i in unmatched_indices], matcher,
+                                            find_umi_in_rc=find_umi_in_rc, is_read2=is_read2, placements=placements)
+    for i, processed_read in zip(unmatched_indices, processed_reads):
+        new_reads[i], umis[i], sample_barcodes[i], budget_exceeded[i] = processed_read
+    matcher.stats['fixed'] += len(reads) - len(unmatched_indices)
+    matcher.placement_hits['fwd'] += len(reads) - len(unmatched_indices)
+    matcher.error_counts[0] += len(reads) - len(unmatched_indices)
+    return new_reads, umis, sample_barcodes, budget_exceeded
+
+
+def correct_umis(new_reads: list[str], umis: list[str], umi_corrector: UmiCorrector, indices: list[int]):
+    """Replaces UMIs at the start of the new read sequences of the given reads with the whitelisted ones in place."""
+    for i in indices:
+        umi = umis[i]
+        if not umi:
+            continue
+        corrected_umi = umi_corrector.correct(umi)
+        if corrected_umi != umi:
+            sequence_start = new_reads[i].index('\n') + 1
+            new_reads[i] = new_reads[i][:sequence_start] + corrected_umi + new_reads[i][sequence_start + len(umi):]
+            umis[i] = corrected_umi
+
+
+def join_records(new_reads: list[str], indices: list[int]) -> bytes:
+    """Joins the FASTQ records of the given reads into one buffer, encoded once for the whole batch."""
+    return ''.join([new_reads[i] for i in indices]).encode('ascii')
+
+
+def init_worker(read1_pattern: str, read2_pattern: str, find_umi_in_rc: bool, search_window: Optional[int] = None,
+                collect_umis=False, barcode_to_sample: Optional[dict[str, str]] = None,
+                umi_corrector: Optional[UmiCorrector] = None, match_timeout: Optional[float] = None):
+    """Pool initializer: compiles both patterns once per worker process."""
+    WORKER_CONTEXT['read1_pattern'] = create_matcher(read1_pattern, search_window, match_timeout)
+    WORKER_CONTEXT['read2_pattern'] = create_matcher(read2_pattern, search_window, match_timeout)
+    WORKER_CONTEXT['find_umi_in_rc'] = find_umi_in_rc
+    WORKER_CONTEXT['collect_umis'] = collect_umis
+    WORKER_CONTEXT['barcode_to_sample'] = barcode_to_sample
+    WORKER_CONTEXT['umi_corrector'] = umi_corrector
+
+
+def process_batch(read_pairs: list[tuple], placements: Optional[dict[str, tuple]] = None) -> BatchResult:
+    """
+    Processes a batch of read pairs with the patterns compiled by init_worker()
+    and returns the new FASTQ records of the batch joined into one bytes buffer per mate.
+    Pairs, where any mate lost its barcode (processed into an empty record), are discarded.
+    Placements restrict where the pattern of each FASTQ ('fq1' or 'fq2') is searched, all by default.
+    If UMIs are collected, they are returned summarized for the UMI table of each FASTQ with a pattern.
+    If samples are demultiplexed, pairs with a known sample barcode are returned separately for each sample,
+    the rest of pairs (undetermined) are returned as the batch records.
+    If UMIs are corrected by the whitelist, UMIs of the kept pairs are snapped to the whitelisted ones.
+    The time taken by the batch is returned as process_time, the given placements are returned with the result.
+    """
+    start_time = time.perf_counter()
+    searched_placements = placements
+    placements = placements or {}
+    reads1, reads2 = [read1 for read1, _ in read_pairs], [read2 for _, read2 in read_pairs]
+    new_reads1, umis1, sample_barcodes1, budget_exceeded1 = process_reads(
+        reads1, reads2, WORKER_CONTEXT['read1_pattern'], WORKER_CONTEXT['find_umi_in_rc'],
+        placements=placements.get('fq1', PLACEMENTS))
+    new_reads2, umis2, sample_barcodes2, budget_exceeded2 = process_reads(
+        reads2, reads1, WORKER_CONTEXT['read2_pattern'], WORKER_CONTEXT['find_umi_in_rc'], is_read2=True,
+        placements=placements.get('fq2', PLACEMENTS))
+    paired_reads = [i for i, (new_read1, new_read2) in enumerate(zip(new_reads1, new_reads2))
+                    if new_read1 and new_read2]
+    umi_corrector = WORKER_CONTEXT['umi_corrector']
+    if umi_corrector is not None:
+        correct_umis(new_reads1, umis1, umi_corrector, paired_reads)
+        correct_umis(new_reads2, umis2, umi_corrector, paired_reads)
+
+    samples = {}
+    if WORKER_CONTEXT['barcode_to_sample'] is not None:
+        sample_reads = {}
+        undetermined_reads = []
+        for i in paired_reads:
+            sample = WORKER_CONTEXT['barcode_to_sample'].get(sample_barcodes1[i] or sample_barcodes2[i])
+            if sample is None:
+                undetermined_reads.append(i)
+            else:
+                sample_reads.setdefault(sample, []).append(i)
+        samples = {sample: SampleRecords(join_records(new_reads1, indices), join_records(new_reads2, indices),
+                                         len(indices))
+                   for sample, indices in sample_reads.items()}
+        paired_reads = undetermined_reads
+
+    stats = Counter({'discarded_pairs': len(read_pairs) - len(paired_reads) -
+                     sum(sample_records.reads_count for sample_records in samples.values())})
+    if WORKER_CONTEXT['barcode_to_sample'] is not None:
+        stats['undetermined_pairs'] = len(paired_reads)
+    if umi_corrector is not None:
+        stats.update(umi_corrector.pop_stats())
+    # a pair is counted once even if searches of both patterns in several placements exceeded the budget
+    budget_exceeded_pairs = sum(1 for exceeded1, exceeded2 in zip(budget_exceeded1, budget_exceeded2)
+                                if exceeded1 or exceeded2)
+    if budget_exceeded_pairs:
+        stats['budget_exceeded'] = budget_exceeded_pairs
+    placement_hits, error_counts, batch_umis = {}, {}, {}
+    for fastq, matcher, umis in (('fq1', WORKER_CONTEXT['read1_pattern'], umis1),
+                                 ('fq2', WORKER_CONTEXT['read2_pattern'], umis2)):
+        if matcher is not None:
+            stats.update(matcher.pop_stats())
+            placement_hits[fastq] = matcher.pop_placement_hits()
+            error_counts[fastq] = matcher.pop_error_counts()
+            if WORKER_CONTEXT['collect_umis']:
+                batch_umis[fastq] = summarize_umis([umis[i] for i in paired_reads])
+    return BatchResult(join_records(new_reads1, paired_reads), join_records(new_reads2, paired_reads),
+                       len(read_pairs), stats, placement_hits, batch_umis, samples, error_counts,
+                       time.perf_counter() - start_time, None, searched_placements)
+
+
+def process_shard(shard1: FastqShard, shard2: FastqShard,
+                  placements: Optional[dict[str, tuple]] = None) -> ShardResult:
+    """
+    Reads the read pairs of the shards (see shards.py) in the worker and processes them by process_batch(),
+    reads without a mate in the shards are returned to be paired with the reads of the neighbour shards.
+    The time taken by reading is returned as parse_time.
+    """
+    start_time = time.perf_counter()
+    read_pairs, pending_reads1, pending_reads2 = read_shard_pairs(shard1, shard2)
+    parse_time = time.perf_counter() - start_time
+    batch_result = process_batch(read_pairs, placements)
+    return ShardResult(batch_result._replace(parse_time=parse_time), pending_reads1, pending_reads2)
 
-    logger.info(f'Final read count in FASTQ: {len(processed_reads1)}')
 
-    return out_fq1_path, out_fq2_path, len(reads1), len(processed_reads1)
+def process_shared_batch(batch: Union[SharedBatch, list[tuple]],
+                         placements: Optional[dict[str, tuple]] = None) -> BatchResult:
+    """
+    Processes the read pairs packed into shared memory by the main process (see transport.py) by process_batch(),
+    the time taken by unpacking is included into process_time.
+    """
+    start_time = time.perf_counter()
+    batch_result = process_batch(read_shared_batch(batch), placements)
+    return batch_result._replace(process_time=time.perf_counter() - start_time)
@@ -0,0 +1,181 @@
+from collections import Counter
+from typing import Optional
+
+import regex
+
+from logger import set_logger
+from pattern import TRANSLATION_TABLE, get_exact_pattern, get_fixed_position_umi_len, get_reverse_complement_pattern, \
+    get_search_window
+from seeded import create_seeded_matcher
+
+logger = set_logger(name=__file__)
+
+MATCH_TIERS = ('fixed', 'exact', 'fuzzy')
+# where a pattern can be found: forward or reverse complement of the read itself or of its mate
+PLACEMENTS = ('fwd', 'rc', 'mate_fwd', 'mate_rc')
+
+
+class BudgetExceeded:
+    """Result of a search exceeding the match_timeout budget: falsy like None, so it is not a match."""
+
+    def __bool__(self) -> bool:
+        return False
+
+
+BUDGET_EXCEEDED = BudgetExceeded()
+
+
+class ReverseComplementMatch:
+    """
+    Match of the reverse complemented pattern in the sequence with the part of the regex match interface
+    used by create_barcoded_read(), translated into coordinates and letters of reverse complement of the sequence.
+    """
+
+    def __init__(self, match, sequence: str):
+        self._match = match
+        self._sequence = sequence
+        self.fuzzy_counts = match.fuzzy_counts
+
+    def _get_reverse_complement_span(self, start: int, end: int) -> tuple[int, int]:
+        return len(self._sequence) - end, len(self._sequence) - start
+
+    def span(self) -> tuple[int, int]:
+        return self._get_reverse_complement_span(*self._match.span())
+
+    def spans(self, barcode_type: str) -> list[tuple[int, int]]:
+        return [self._get_reverse_complement_span(start, end)
+                for start, end in sorted(self._match.spans(barcode_type), reverse=True)]
+
+    def captures(self, barcode_type: str) -> list[str]:
+        return [self._sequence[start:end].translate(TRANSLATION_TABLE)[::-1]
+                for start, end in sorted(self._match.spans(barcode_type), reverse=True)]
+
+
+class TieredMatcher:
+    """
+    Two-tier barcode matcher: searches the exact (zero-error) version of the pattern first
+    and falls back to the fuzzy BESTMATCH search only when there is no exact match.
+    Counts how many matches were found in each placement. The tier and the number of errors are counted
+    by count_match() only for the match kept for a read, so searches in the other placements are not counted.
+    Anchored adapter-free patterns additionally get fixed_umi_len to be cut positionally (the 'fixed' tier).
+
+    Only the read prefix of search_window length is searched (the explicit one or the maximum span
+    of a pattern anchored to the read start), the whole read if it is None.
+
+    Fuzzy patterns of fixed-length adapters and UMIs are searched by the seeded Hamming engine
+    in the whole batch of sequences at once instead of the regex.
+
+    If match_timeout is given, the regex search of every sequence in each tier is limited to this number of seconds,
+    sequences exceeding the budget are left without a match: BUDGET_EXCEEDED instead of None, so the read pairs
+    left without a match after exceeding the budget are counted once per pair by process_batch().
+    The seeded engine does not need the budget: its cost is bounded by the sequence length.
+
+    Fixed-length patterns are also compiled reverse complemented (with the same tiers), so reverse complement
+    of a read is searched in the read itself (its suffix of search_window length) without building it.
+    """
+
+    def __init__(self, pattern: str, search_window: Optional[int] = None, match_timeout: Optional[float] = None):
+        self.fixed_umi_len = get_fixed_position_umi_len(pattern)
+        max_pattern_span = get_search_window(pattern)
+        if search_window and max_pattern_span and search_window < max_pattern_span:
+            logger.warning(f'Search window {search_window} is shorter than the maximum span {max_pattern_span} '
+                           f'of the pattern {pattern}, matches could be lost.')
+        self.search_window = search_window or max_pattern_span
+        self.match_timeout = match_timeout
+        exact_pattern = get_exact_pattern(pattern)
+        self.exact_pattern = regex.compile(exact_pattern)
+        # barcodes extracted together with UMI in the same search and written into the read header
+        self.header_barcode_types = tuple(barcode_type for barcode_type in self.exact_pattern.groupindex
+                                          if barcode_type != 'UMI')
+        self.fuzzy_pattern = regex.compile(pattern, regex.BESTMATCH) if exact_pattern != pattern else None
+        self.seeded_matcher = create_seeded_matcher(pattern) if self.fuzzy_pattern is not None else None
+        rc_pattern = get_reverse_complement_pattern(pattern)
+        self.rc_exact_pattern = regex.compile(get_exact_pattern(rc_pattern), regex.REVERSE) if rc_pattern else None
+        self.rc_fuzzy_pattern = regex.compile(rc_pattern, regex.BESTMATCH | regex.REVERSE) \
+            if rc_pattern and self.fuzzy_pattern is not None else None
+        self.rc_seeded_matcher = create_seeded_matcher(pattern, is_reverse_complement=True) \
+            if self.rc_fuzzy_pattern is not None else None
+        self.stats = Counter()
+        self.placement_hits = Counter()
+        self.error_counts = Counter()
+
+    def _search_regex(self, compiled_pattern, sequences: list[str]) -> tuple[list, set[int]]:
+        """Searches the regex in every sequence, returns the matches or None (BUDGET_EXCEEDED
+        for the sequences exceeding the match_timeout budget) and indices of these sequences."""
+        if self.match_timeout is None:
+            return [compiled_pattern.search(sequence) for sequence in sequences], set()
+        matches, exceeded_indices = [], set()
+        for i, sequence in enumerate(sequences):
+            try:
+                matches.append(compiled_pattern.search(sequence, timeout=self.match_timeout))
+            except TimeoutError:
+                matches.append(BUDGET_EXCEEDED)
+                exceeded_indices.add(i)
+        return matches, exceeded_indices
+
+    def _search_tiers(self, sequences: list[str], exact_pattern, fuzzy_pattern, seeded_matcher) -> list:
+        matches, exceeded_indices = self._search_regex(exact_pattern, sequences)
+        unmatched_indices = [i for i, match in enumerate(matches) if not match and i not in exceeded_indices]
+        if fuzzy_pattern is None or not unmatched_indices:
+            return matches
+
+        unmatched_sequences = [sequences[i] for i in unmatched_indices]
+        if seeded_matcher is not None:
+            fuzzy_matches = seeded_matcher.search_many(unmatched_sequences)
+        else:
+            fuzzy_matches, _ = self._search_regex(fuzzy_pattern, unmatched_sequences)
+        for i, match in zip(unmatched_indices, fuzzy_matches):
+            if match is not None:
+                matches[i] = match
+        return matches
+
+    def search_many(self, sequences: list[str]) -> list:
+        """Searches the pattern in every sequence, returns the regex (or seeded engine) matches
+        or None (BUDGET_EXCEEDED if the search exceeded the match_timeout budget)."""
+        if self.search_window:
+            sequences = [sequence[:self.search_window] for sequence in sequences]
+        return self._search_tiers(sequences, self.exact_pattern, self.fuzzy_pattern, self.seeded_matcher)
+
+    def search_many_reverse_complement(self, sequences: list[str]) -> list:
+        """
+        Searches the reverse complemented pattern in every sequence (only if rc_exact_pattern is compiled),
+        returns the matches in coordinates of reverse complement of the sequence (of its suffix) or None
+        (BUDGET_EXCEEDED if the search exceeded the match_timeout budget).
+        """
+        if self.search_window:  # the prefix of reverse complement is the reverse complement of the suffix
+            sequences = [sequence[-self.search_window:] for sequence in sequences]
+        matches = self._search_tiers(sequences, self.rc_exact_pattern, self.rc_fuzzy_pattern, self.rc_seeded_matcher)
+        return [ReverseComplementMatch(match, sequence) if match else match
+                for match, sequence in zip(matches, sequences)]
+
+    def search(self, sequence: str):
+        return self.search_many([sequence])[0]
+
+    def count_match(self, match):
+        """
+        Counts the tier and the number of errors of the match kept for a read: the fuzzy tier is searched
+        only if there is no exact match, so the match has errors only if it is resolved by the fuzzy tier.
+        """
+        errors_count = sum(match.fuzzy_counts)
+        self.stats['fuzzy' if errors_count else 'exact'] += 1
+        self.error_counts[errors_count] += 1
+
+    def pop_stats(self) -> Counter:
+        """Returns the tier counters accumulated since the last call and resets them."""
+        stats, self.stats = self.stats, Counter()
+        return stats
+
+    def pop_error_counts(self) -> Counter:
+        """Returns the match counters by the number of errors accumulated since the last call and resets them."""
+        error_counts, self.error_counts = self.error_counts, Counter()
+        return error_counts
+
+    def pop_placement_hits(self) -> Counter:
+        """Returns the placement hit counters accumulated since the last call and resets them."""
+        placement_hits, self.placement_hits = self.placement_hits, Counter()
+        return placement_hits
+
+
+def create_matcher(pattern: str, search_window: Optional[int] = None,
+                   match_timeout: Optional[float] = None) -> Optional[TieredMatcher]:
+    return TieredMatcher(pattern, search_window, match_timeout) if pattern else None
@@ -0,0 +1,93 @@
+import re
+import resource
+import sys
+from itertools import islice
+
+from logger import set_logger
+
+logger = set_logger(name=__file__)
+
+MEMORY_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+MEMORY_SIZE_REGEX = re.compile(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", re.IGNORECASE)
+
+PROBE_BATCH_SIZE = 1_000  # read pairs in the first batch, before the size of reads is known
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 200_000
+SAMPLED_READ_PAIRS_COUNT = 100  # read pairs of every batch measured to estimate the memory per read pair
+# copies of a batch alive at once: input packed into shared memory (see transport.py, the parsed batch is released
+# once packed), input unpacked by the worker, worker output records, output records in the parent
+BATCH_MEMORY_COPIES = 4
+WORKER_MEMORY_OVERHEAD = 64 * 1024 ** 2  # interpreter with compiled patterns in every worker process
+
+
+def parse_memory_size(value: str) -> int:
+    """Parses memory size in bytes from strings like '12G', '512 MB' or '1000000'."""
+    match = MEMORY_SIZE_REGEX.fullmatch(value.strip())
+    if not match:
+        raise ValueError(f'Invalid memory size: {value}')
+    number, unit = match.groups()
+    return int(float(number) * MEMORY_UNITS[unit.upper()])
+
+
+def get_rss() -> int:
+    """Returns the current resident set size of the process in bytes, the peak one where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # in KB on Linux
+
+
+def get_peak_rss() -> dict[str, int]:
+    """Returns the peak resident set size in bytes of this process and of the largest finished child process."""
+    return {"main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024}
+
+
+def get_read_pair_size(read_pair: tuple) -> int:
+    """Returns the memory taken by the read pair tuples and strings and by its output records."""
+    size = sys.getsizeof(read_pair)
+    for read in read_pair:
+        size += sys.getsizeof(read) + sum(sys.getsizeof(field) for field in read)
+        size += sys.getsizeof(''.join(read)) + len('@\n\n+\n')  # output FASTQ record
+    return size
+
+
+class MemoryBudget:
+    """
+    Sizes batches of read pairs, so all batches in flight fit into max_memory.
+
+    The fixed part (the main process, worker processes and the compression buffers) is reserved
+    from max_memory, the rest is shared by max_in_flight batches. The memory per read pair is measured
+    on a sample of every read batch, so the batch size follows the read length of the library.
+    """
+
+    def __init__(self, max_memory: int, max_in_flight: int, workers_count: int, reserved_memory=0):
+        self.max_memory = max_memory
+        self.max_in_flight = max_in_flight
+        self.reserved_memory = get_rss() + workers_count * WORKER_MEMORY_OVERHEAD + reserved_memory
+        self.batch_size = PROBE_BATCH_SIZE
+        self.bytes_per_read_pair = 0
+        self.max_batch_size = 0
+        if self.reserved_memory >= self.max_memory:
+            logger.warning(f'Memory reserved for the processes ({self.reserved_memory} bytes) exceeds '
+                           f'the memory limit {self.max_memory} bytes, using batches of {MIN_BATCH_SIZE} read pairs')
+
+    def observe(self, read_pairs: list[tuple]):
+        """Updates the size of the next batches from the memory taken by the read pairs of the batch."""
+        sample = list(islice(read_pairs, SAMPLED_READ_PAIRS_COUNT))
+        if not sample:
+            return
+        bytes_per_read_pair = sum(map(get_read_pair_size, sample)) // len(sample)
+        self.bytes_per_read_pair = max(self.bytes_per_read_pair, bytes_per_read_pair)
+        batch_memory = (self.max_memory - self.reserved_memory) // self.max_in_flight
+        batch_size = batch_memory // (BATCH_MEMORY_COPIES * self.bytes_per_read_pair)
+        self.batch_size = min(max(batch_size, MIN_BATCH_SIZE), MAX_BATCH_SIZE)
+        self.max_batch_size = max(self.max_batch_size, self.batch_size)
+
+    def get_metrics(self) -> dict:
+        return {"max_memory": self.max_memory,
+                "reserved_memory": self.reserved_memory,
+                "bytes_per_read_pair": self.bytes_per_read_pair,
+                "max_batch_size": self.max_batch_size,
+                "peak_rss": get_peak_rss()}
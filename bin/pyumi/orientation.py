@@ -0,0 +1,81 @@
+from collections import Counter
+from typing import Optional
+
+from logger import set_logger
+from matcher import PLACEMENTS
+
+logger = set_logger(name=__file__)
+
+PROFILE_READS_COUNT = 10_000  # read pairs searched in all placements before the orientation is learned
+RECHECK_INTERVAL = 50  # every n-th batch is searched in all placements again to catch drift
+MIN_PLACEMENT_SHARE = 0.01  # placements with a smaller share of pattern matches are not searched
+
+
+def select_placements(placement_hits: Counter, min_share=MIN_PLACEMENT_SHARE) -> tuple:
+    """Returns placements carrying at least min_share of the pattern matches, all placements if nothing matched."""
+    total_hits = sum(placement_hits.values())
+    if not total_hits:
+        return PLACEMENTS
+    return tuple(placement for placement in PLACEMENTS if placement_hits[placement] >= min_share * total_hits)
+
+
+class OrientationLearner:
+    """
+    Learns which mate and strand carry the pattern of each FASTQ ('fq1', 'fq2').
+
+    The first profile_reads_count read pairs are searched in all placements, then only the placements
+    with matches are searched. Every recheck_interval-th batch is searched in all placements again,
+    placements, which got matches there, are searched again for the rest of the run.
+    Batch results are passed to update() with the placements returned by next_placements() for their batch,
+    so only the results of the batches searched in all placements are profiled, whatever order they come in.
+    """
+
+    def __init__(self, fastqs: list[str], profile_reads_count=PROFILE_READS_COUNT,
+                 recheck_interval=RECHECK_INTERVAL):
+        self.profile_reads_count = profile_reads_count
+        self.recheck_interval = recheck_interval
+        self.placements = {fastq: PLACEMENTS for fastq in fastqs}
+        self.profile_hits = {fastq: Counter() for fastq in fastqs}
+        self.profiled_reads_count = 0
+        self.is_learned = False
+        self._submitted_batches_count = 0
+
+    def next_placements(self) -> Optional[dict[str, tuple]]:
+        """Returns placements to search in the next submitted batch, None means all placements."""
+        self._submitted_batches_count += 1
+        is_full_search = not self.is_learned or self._submitted_batches_count % self.recheck_interval == 0
+        return None if is_full_search else self.placements
+
+    def update(self, placement_hits: dict[str, Counter], reads_count: int,
+               placements: Optional[dict[str, tuple]] = None):
+        """Profiles the placement hits of a batch searched in the given placements (None means all placements)."""
+        if placements is not None:
+            return
+        if self.is_learned:
+            self._recheck(placement_hits)
+            return
+
+        for fastq, hits in placement_hits.items():
+            self.profile_hits[fastq].update(hits)
+        self.profiled_reads_count += reads_count
+        if self.profiled_reads_count >= self.profile_reads_count:
+            self.placements = {fastq: select_placements(hits) for fastq, hits in self.profile_hits.items()}
+            self.is_learned = True
+            logger.info(f'Orientation learned on {self.profiled_reads_count} read pairs, '
+                        f'searched placements: {self.placements}')
+
+    def _recheck(self, placement_hits: dict[str, Counter]):
+        for fastq, hits in placement_hits.items():
+            if not sum(hits.values()):
+                continue
+            missed_placements = set(select_placements(hits)) - set(self.placements[fastq])
+            if missed_placements:
+                logger.warning(f'Pattern of {fastq} is found in not searched placements {sorted(missed_placements)}, '
+                               f'searching them again.')
+                self.placements[fastq] = tuple(placement for placement in PLACEMENTS
+                                               if placement in missed_placements or
+                                               placement in self.placements[fastq])
+
+    def get_metrics(self) -> dict:
+        return {fastq: {"placements": list(self.placements[fastq]), "profile_hits": dict(self.profile_hits[fastq])}
+                for fastq in self.placements}
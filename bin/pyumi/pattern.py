@@ -1,5 +1,7 @@
 import math
 import re
+from collections import namedtuple
+from typing import Optional
 
 from logger import set_logger
 
@@ -8,14 +10,35 @@ logger = set_logger(name=__file__)
 NORMAL_NUCLEOTIDES = 'ATGC'
 IUPAC_WILDCARDS = 'RYSWKMBDHVN'
 ALLOWED_LETTERS_IN_UMI = NORMAL_NUCLEOTIDES + 'N'
+# UMI, sample barcode and cell barcode, barcodes other than UMI are written into the read header
+BARCODE_TYPES = ('UMI', 'SBC', 'CB')
+# complement of read letters, IUPAC wildcards are complemented into A
+TRANSLATION_TABLE = bytes.maketrans(b"ATGCRYSWKMBDHVN", b"TACGAAAAAAAAAAA")
 
+BARCODE_BODY_REGEX = r"(?:N?\{\d+\}|N+)"  # length of a barcode in the raw pattern: N{12}, {12} or NNNNNNNNNNNN
 ADAPTER_PATTERN_REGEX = rf"(?<!\[)\b[{ALLOWED_LETTERS_IN_UMI}]+\b(?!\])"
+FIXED_POSITION_UMI_REGEX = rf"\(\?P<UMI>\[{ALLOWED_LETTERS_IN_UMI}\]\{{(\d+)\}}\)"
+QUANTIFIER_REGEX = re.compile(r"\{(\d*)(,?)(\d*)\}|[*+?]")
+FUZZY_COST_REGEX = re.compile(r"\{((?:[sied]<=\d+,?)+)\}")
+SUBSTITUTION_COST_REGEX = re.compile(r"(?:s<=\d+)?")
+# letters of the read complemented into each letter by TRANSLATION_TABLE, e.g. A <- T and all IUPAC wildcards
+COMPLEMENTED_FROM = {}
+for letter_code in range(ord('A'), ord('Z') + 1):
+    COMPLEMENTED_FROM.setdefault(chr(TRANSLATION_TABLE[letter_code]), []).append(chr(letter_code))
+
+# node of the parsed prepared pattern: kind is one of 'anchor', 'literal', 'class', 'group';
+# max_repeat is None for unbounded quantifiers, fuzzy is the fuzzy costs string (e.g. 's<=2') or ''
+PatternNode = namedtuple('PatternNode', ['kind', 'value', 'children', 'min_repeat', 'max_repeat', 'fuzzy'])
 
 
 class ValidationError(Exception):
     pass
 
 
+class PatternParseError(Exception):
+    pass
+
+
 def parse_umi_length(pattern: str, barcode_type='UMI') -> int:
     """
     Parses the total length of the specified barcode type from the pattern.
@@ -43,6 +66,22 @@ def add_nucleotide_cost(pattern: str, max_error=2) -> str:
     return new_pattern
 
 
+def get_exact_pattern(pattern: str) -> str:
+    """Removes fuzzy mismatch costs from the prepared pattern.
+    Example: ^(TGGTATCAACGCAGAGT){s<=4}(?P<UMI>[ATGCN]{14}) -> ^(TGGTATCAACGCAGAGT)(?P<UMI>[ATGCN]{14})
+    """
+    return re.sub(r'\{s<=\d+\}', '', pattern)
+
+
+def get_fixed_position_umi_len(pattern: str) -> int:
+    """Returns the UMI length if the prepared pattern is a pure positional slice of the read start, otherwise 0.
+    Example: ^(?P<UMI>[ATGCN]{6})(?P<UMI>[ATGCN]{6}) -> 12; ^(TGG){s<=1}(?P<UMI>[ATGCN]{6}) -> 0
+    """
+    if not re.fullmatch(rf'\^(?:{FIXED_POSITION_UMI_REGEX})+', pattern):
+        return 0
+    return sum(int(umi_len) for umi_len in re.findall(FIXED_POSITION_UMI_REGEX, pattern))
+
+
 def replace_barcode_type_to_regex_group(pattern: str, barcode_type: str) -> str:
     """Replaces barcode type to a named regex group in the given pattern.
     Example: ^(UMI:N{12}) -> ^(?P<UMI>N{12})
@@ -51,12 +90,29 @@ def replace_barcode_type_to_regex_group(pattern: str, barcode_type: str) -> str:
 
 
 def add_brackets_around_barcode(pattern: str, barcode_type: str) -> str:
-    """Adds brackets around the specified barcode type in the pattern if not already present.
-    Example: ^UMI:N{12} -> ^(UMI:N{12})
+    """Adds brackets around every barcode of the specified type in the pattern, which is not bracketed yet.
+    The barcode is only its length (N{12} or NNNNNNNNNNNN), so the adjacent barcodes and adapters stay outside.
+    Example: ^UMI:N{12} -> ^(UMI:N{12}); ^CB:N{8}ACGT(UMI:N{10}) -> ^(CB:N{8})ACGT(UMI:N{10})
     """
-    if not re.search(rf'\({barcode_type}:[A-Z0-9{{}}]+\)', pattern):
-        pattern = re.sub(rf'({barcode_type}:[A-Z0-9{{}}]+)', r'(\1)', pattern)
-    return pattern
+    return re.sub(rf'(?<!\()({barcode_type}:{BARCODE_BODY_REGEX})', r'(\1)', pattern)
+
+
+def get_pattern_barcode_types(pattern: str) -> list[str]:
+    """Returns barcode types of the raw pattern: UMI and the other types followed by ':'.
+    Example: ^(SBC:N{6})(UMI:N{12}) -> ['UMI', 'SBC']
+    """
+    return [barcode_type for barcode_type in BARCODE_TYPES
+            if barcode_type == 'UMI' or f'{barcode_type}:' in pattern.upper()]
+
+
+def get_barcode_lengths(pattern: str) -> dict[str, int]:
+    """Returns the total length of each barcode type in the raw pattern.
+    Example: ^SBC:N{6}UMI:N{12} -> {'UMI': 12, 'SBC': 6}
+    """
+    if not pattern:
+        return {}
+    return {barcode_type: parse_umi_length(pattern.upper(), barcode_type)
+            for barcode_type in get_pattern_barcode_types(pattern)}
 
 
 def validate_pattern(pattern: str, umi_len: int):
@@ -79,11 +135,184 @@ def get_prepared_pattern_and_umi_len(pattern: str, max_error=2) -> tuple[str, in
     umi_len = parse_umi_length(pattern)
     validate_pattern(pattern, umi_len)
     pattern = pattern.upper()
-    pattern = add_brackets_around_barcode(pattern, 'UMI')
-    pattern = replace_barcode_type_to_regex_group(pattern, 'UMI')
+    for barcode_type in get_pattern_barcode_types(pattern):
+        pattern = add_brackets_around_barcode(pattern, barcode_type)
+        pattern = replace_barcode_type_to_regex_group(pattern, barcode_type)
     pattern = pattern.replace('N', f'[{ALLOWED_LETTERS_IN_UMI}]')
     pattern = add_nucleotide_cost(pattern, max_error)
     pattern = pattern.replace('{*}', '*')
 
     logger.info(f"Pattern has been converted into '{pattern}', umi length is {umi_len}...")
     return pattern, umi_len
+
+
+def _parse_node_suffix(pattern: str, pos: int) -> tuple[int, Optional[int], str, int]:
+    """Parses quantifier and fuzzy costs following a node, returns (min_repeat, max_repeat, fuzzy, new position)."""
+    min_repeat, max_repeat, fuzzy = 1, 1, ''
+    while pos < len(pattern):
+        fuzzy_match = FUZZY_COST_REGEX.match(pattern, pos)
+        quantifier_match = QUANTIFIER_REGEX.match(pattern, pos)
+        if fuzzy_match:
+            fuzzy = fuzzy_match.group(1)
+            pos = fuzzy_match.end()
+        elif quantifier_match and (quantifier_match.group(1) or quantifier_match.group(3) or
+                                   quantifier_match.group(0) in '*+?'):
+            quantifier = quantifier_match.group(0)
+            if quantifier in '*+?':
+                min_repeat, max_repeat = {'*': (0, None), '+': (1, None), '?': (0, 1)}[quantifier]
+            elif not quantifier_match.group(2):
+                min_repeat = max_repeat = int(quantifier_match.group(1))
+            else:
+                min_repeat = int(quantifier_match.group(1) or 0)
+                max_repeat = int(quantifier_match.group(3)) if quantifier_match.group(3) else None
+            pos = quantifier_match.end()
+        else:
+            break
+    return min_repeat, max_repeat, fuzzy, pos
+
+
+def _parse_sequence(pattern: str, pos: int) -> tuple[list[PatternNode], int]:
+    nodes = []
+    while pos < len(pattern) and pattern[pos] != ')':
+        char = pattern[pos]
+        if char in '^$':
+            nodes.append(PatternNode('anchor', char, [], 1, 1, ''))
+            pos += 1
+            continue
+        if char == '(':
+            name = None
+            if pattern.startswith('(?P<', pos):
+                name_end = pattern.index('>', pos)
+                name, pos = pattern[pos + 4:name_end], name_end + 1
+            elif pattern.startswith('(?', pos):
+                raise PatternParseError(f'Unsupported group at {pos} in {pattern}')
+            else:
+                pos += 1
+            children, pos = _parse_sequence(pattern, pos)
+            if pos >= len(pattern):
+                raise PatternParseError(f'Unclosed group in {pattern}')
+            kind, value, pos = 'group', name, pos + 1
+        elif char == '[':
+            class_end = pattern.find(']', pos)
+            if class_end == -1:
+                raise PatternParseError(f'Unclosed character class in {pattern}')
+            kind, value, children, pos = 'class', pattern[pos:class_end + 1], [], class_end + 1
+        elif char in '\\|':
+            raise PatternParseError(f'Unsupported {char} at {pos} in {pattern}')
+        else:
+            kind, value, children, pos = ('class' if char == '.' else 'literal'), char, [], pos + 1
+        min_repeat, max_repeat, fuzzy, pos = _parse_node_suffix(pattern, pos)
+        nodes.append(PatternNode(kind, value, children, min_repeat, max_repeat, fuzzy))
+    return nodes, pos
+
+
+def parse_prepared_pattern(pattern: str) -> Optional[list[PatternNode]]:
+    """Parses the prepared pattern into a tree of nodes, returns None for constructions beyond the pattern language.
+    Example: ^(TGG){s<=1}(?P<UMI>[ATGCN]{6}) -> [anchor ^, group (literals T, G, G; s<=1), group UMI (class x6)]
+    """
+    try:
+        nodes, pos = _parse_sequence(pattern, 0)
+    except PatternParseError as e:
+        logger.warning(f'Pattern is not parsed: {e}')
+        return None
+    if pos != len(pattern):
+        logger.warning(f'Pattern is not parsed: unexpected ) at {pos} in {pattern}')
+        return None
+    return nodes
+
+
+def get_fuzzy_length_change(fuzzy: str) -> int:
+    """Returns how much longer a fuzzy match could be due to insertions. Example: i<=1,s<=2 -> 1"""
+    return sum(int(limit) for error_type, limit in re.findall(r'([sied])<=(\d+)', fuzzy) if error_type in 'ie')
+
+
+def get_max_span(nodes: list[PatternNode]) -> Optional[int]:
+    """Returns the maximum length of a sequence matched by the nodes, None if it is unbounded."""
+    max_span = 0
+    for node in nodes:
+        if node.kind == 'anchor':
+            continue
+        node_span = get_max_span(node.children) if node.kind == 'group' else 1
+        if node_span is None or node.max_repeat is None:
+            return None
+        max_span += node_span * node.max_repeat + get_fuzzy_length_change(node.fuzzy)
+    return max_span
+
+
+def get_search_window(pattern: str) -> Optional[int]:
+    """
+    Returns the length of the read prefix, where the prepared pattern could be matched:
+    the maximum span of a pattern anchored to the read start, otherwise None (the whole read).
+    """
+    nodes = parse_prepared_pattern(pattern)
+    if not nodes or nodes[0] != PatternNode('anchor', '^', [], 1, 1, '') or \
+            any(node.kind == 'anchor' for node in nodes[1:]):
+        return None
+    return get_max_span(nodes)
+
+
+def format_pattern_nodes(nodes: list[PatternNode]) -> str:
+    """Formats the parsed nodes back into the prepared pattern. Example: [anchor ^, class [ATGCN] x6] -> ^[ATGCN]{6}"""
+    parts = []
+    for node in nodes:
+        if node.kind == 'group':
+            name = '' if node.value is None else f'?P<{node.value}>'
+            parts.append(f'({name}{format_pattern_nodes(node.children)})')
+        else:
+            parts.append(node.value)
+        if node.min_repeat == node.max_repeat != 1:
+            parts.append(f'{{{node.min_repeat}}}')
+        elif node.min_repeat != node.max_repeat:
+            parts.append(f"{{{node.min_repeat},{'' if node.max_repeat is None else node.max_repeat}}}")
+        if node.fuzzy:
+            parts.append(f'{{{node.fuzzy}}}')
+    return ''.join(parts)
+
+
+def get_complement_class(letters: str) -> Optional[str]:
+    """Returns the read letters complemented into any of the letters, as a class if there are several of them,
+    None if there are no such letters. Example: A -> [BDHKMNRSTVWY], GT -> [AC]
+    """
+    complement_letters = sorted({complement_letter for letter in letters
+                                 for complement_letter in COMPLEMENTED_FROM.get(letter, [])})
+    if len(complement_letters) > 1:
+        return f"[{''.join(complement_letters)}]"
+    return complement_letters[0] if complement_letters else None
+
+
+def _get_reverse_complement_nodes(nodes: list[PatternNode]) -> list[PatternNode]:
+    rc_nodes = []
+    for node in reversed(nodes):
+        if node.min_repeat != node.max_repeat or not SUBSTITUTION_COST_REGEX.fullmatch(node.fuzzy):
+            raise PatternParseError(f'variable length of {format_pattern_nodes([node])}')
+        if node.kind == 'anchor':
+            node = node._replace(value='$' if node.value == '^' else '^')
+        elif node.kind == 'group':
+            node = node._replace(children=_get_reverse_complement_nodes(node.children))
+        elif node.value != '.':
+            letters = node.value[1:-1] if node.kind == 'class' else node.value
+            complement_class = get_complement_class(letters) if letters.isalpha() and letters.isupper() else None
+            if complement_class is None:
+                raise PatternParseError(f'no complement of {node.value}')
+            node = node._replace(kind='class' if len(complement_class) > 1 else 'literal', value=complement_class)
+        rc_nodes.append(node)
+    return rc_nodes
+
+
+def get_reverse_complement_pattern(pattern: str) -> Optional[str]:
+    """
+    Returns the pattern, which matches the read with the same errors where the prepared pattern matches
+    the reverse complement of the read (like get_reverse_complement() builds it): the nodes are reversed,
+    letters and classes are replaced with the read letters complemented into them and the anchors are swapped.
+    Returns None for patterns beyond the pattern language, of variable length or with insertion and deletion costs:
+    the reverse complement of their best match is not always the best match of the reverse complemented pattern.
+    Example: ^(TGG){s<=1}(?P<UMI>[ATGCN]{2}) -> (?P<UMI>[ABCDGHKMNRSTVWY]{2})(CCA){s<=1}$
+    """
+    nodes = parse_prepared_pattern(pattern)
+    if not nodes:
+        return None
+    try:
+        return format_pattern_nodes(_get_reverse_complement_nodes(nodes))
+    except PatternParseError as e:
+        logger.debug(f'Reverse complement of the pattern {pattern} is not compiled: {e}')
+        return None
@@ -0,0 +1,87 @@
+import time
+from collections import Counter, deque
+from typing import Iterable, Iterator
+
+from extract import BatchResult
+from matcher import MATCH_TIERS
+from memory import get_peak_rss
+
+TIME_PRECISION = 4  # digits of seconds in the metrics
+
+
+def iter_timed(items: Iterable, times: deque) -> Iterator:
+    """Yields items and appends the time taken to produce every item into times."""
+    items = iter(items)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        times.append(time.perf_counter() - start_time)
+        yield item
+
+
+def get_reads_per_second(reads_count: int, seconds: float) -> int:
+    return round(reads_count / seconds) if seconds else 0
+
+
+class PerformanceStats:
+    """
+    Collects the throughput, the time of every stage and the match counters of every batch (chunk) and in total.
+
+    Stages: parse (the reader thread or a worker reading its shard), match (a worker process), write (the writer
+    thread) and compress (the compression threads, for a chunk it is the time of blocks compressed while the chunk
+    was written). Reads per second of a chunk are measured by its worker, the total ones by the wall time of the run.
+    Parse times are appended by the reader in the order of batches, chunks have to be added in the same order.
+    Chunks read by the workers bring their own parse time, the ones of mates read by different shards
+    (cross_shard_pairs) are paired by the main process and have zero parse time.
+    """
+
+    def __init__(self):
+        self.parse_times = deque()
+        self.chunks = []
+        self.totals = Counter()
+        self.placement_hits = {}
+        self.wall_time = 0.0
+        self._start_time = None
+
+    def start(self):
+        self._start_time = time.perf_counter()
+
+    def add_chunk(self, batch_result: BatchResult, write_time: float, compress_time: float):
+        parse_time = self.parse_times.popleft() if batch_result.parse_time is None else batch_result.parse_time
+        chunk_times = {"parse_time": parse_time, "match_time": batch_result.process_time,
+                       "write_time": write_time, "compress_time": compress_time}
+        self.chunks.append({"read_pairs": batch_result.reads_count,
+                            "reads_per_second": get_reads_per_second(batch_result.reads_count,
+                                                                     batch_result.process_time),
+                            **{stage: round(seconds, TIME_PRECISION) for stage, seconds in chunk_times.items()},
+                            "match_tiers": {tier: batch_result.stats[tier] for tier in MATCH_TIERS},
+                            "placement_hits": {fastq: dict(hits)
+                                               for fastq, hits in batch_result.placement_hits.items()},
+                            "discarded_pairs": batch_result.stats['discarded_pairs'],
+                            "peak_rss": get_peak_rss()['main']})
+        self.totals.update(chunk_times)
+        self.totals.update({"read_pairs": batch_result.reads_count,
+                            "discarded_pairs": batch_result.stats['discarded_pairs'],
+                            **{tier: batch_result.stats[tier] for tier in MATCH_TIERS}})
+        for fastq, hits in batch_result.placement_hits.items():
+            self.placement_hits.setdefault(fastq, Counter()).update(hits)
+
+    def finish(self, compress_time: float):
+        """Stops the wall clock, compress_time is the total one including blocks flushed after the last chunk."""
+        self.wall_time = time.perf_counter() - self._start_time
+        self.totals['compress_time'] = compress_time
+
+    def get_metrics(self) -> dict:
+        return {"total": {"read_pairs": self.totals['read_pairs'],
+                          "wall_time": round(self.wall_time, TIME_PRECISION),
+                          "reads_per_second": get_reads_per_second(self.totals['read_pairs'], self.wall_time),
+                          **{stage: round(self.totals[stage], TIME_PRECISION)
+                             for stage in ('parse_time', 'match_time', 'write_time', 'compress_time')},
+                          "match_tiers": {tier: self.totals[tier] for tier in MATCH_TIERS},
+                          "placement_hits": {fastq: dict(hits) for fastq, hits in self.placement_hits.items()},
+                          "discarded_pairs": self.totals['discarded_pairs'],
+                          "peak_rss": get_peak_rss()},
+                "chunks": self.chunks}
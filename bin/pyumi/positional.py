@@ -0,0 +1,44 @@
+import numpy as np
+
+from pattern import ALLOWED_LETTERS_IN_UMI
+
+# lookup tables over byte values: letters allowed in UMI and N -> A replacement
+ALLOWED_UMI_BYTES = np.zeros(256, dtype=bool)
+ALLOWED_UMI_BYTES[np.frombuffer(ALLOWED_LETTERS_IN_UMI.encode(), dtype=np.uint8)] = True
+N_TO_A_BYTES = np.arange(256, dtype=np.uint8)
+N_TO_A_BYTES[ord('N')] = ord('A')
+
+
+def pack_sequences(sequences: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Packs sequences into one byte buffer, returns it with the start offsets and lengths of sequences."""
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    starts = np.zeros(len(sequences), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    buffer = np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8).copy()
+    return buffer, starts, lengths
+
+
+def unpack_sequences(buffer: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> list[str]:
+    packed = buffer.tobytes().decode('ascii')
+    return [packed[start:start + length] for start, length in zip(starts.tolist(), lengths.tolist())]
+
+
+def extract_fixed_umis(reads: list[tuple], umi_length: int) -> tuple[list[str], np.ndarray]:
+    """
+    Extracts UMI from the first umi_length nucleotides of every read in the batch at once.
+
+    The UMI stays at the read start, so only N inside it is replaced with A (like the regex path does).
+    Returns new sequences and the mask of reads, which could not be matched positionally
+    (too short or with a letter, not allowed in UMI) and have to be processed by the regex matcher.
+    """
+    buffer, starts, lengths = pack_sequences([read[1] for read in reads])
+
+    is_long_enough = lengths >= umi_length
+    umi_indices = starts[is_long_enough, None] + np.arange(umi_length)
+    umi_bytes = buffer[umi_indices]
+    is_umi_valid = ALLOWED_UMI_BYTES[umi_bytes].all(axis=1)
+    buffer[umi_indices[is_umi_valid]] = N_TO_A_BYTES[umi_bytes[is_umi_valid]]
+
+    is_matched = np.zeros(len(reads), dtype=bool)
+    is_matched[is_long_enough] = is_umi_valid
+    return unpack_sequences(buffer, starts, lengths), ~is_matched
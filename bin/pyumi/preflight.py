@@ -0,0 +1,89 @@
+import gzip
+import os
+import time
+from collections import Counter
+from itertools import islice
+from multiprocessing.pool import Pool
+
+from extract import process_batch
+from logger import set_logger
+from matcher import MATCH_TIERS
+from stream import PairedFastqReader, WORKERS_COUNT, starmap_bounded
+
+logger = set_logger(name=__file__)
+
+GZIP_MAGIC = b'\x1f\x8b'
+FASTQ_RECORD_LINES = 4
+
+
+def estimate_reads_count(fastq_path: str, sampled_reads_count: int) -> int:
+    """
+    Estimates the reads count of the FASTQ from its file size and the (compressed) size of its first reads,
+    returns the exact count if the file has no more than sampled_reads_count reads.
+    """
+    with open(fastq_path, 'rb') as raw_file:
+        is_gzipped = raw_file.read(2) == GZIP_MAGIC
+        raw_file.seek(0)
+        fastq_file = gzip.GzipFile(fileobj=raw_file) if is_gzipped else raw_file
+        lines_count = sum(1 for _ in islice(fastq_file, FASTQ_RECORD_LINES * sampled_reads_count))
+        reads_count = lines_count // FASTQ_RECORD_LINES
+        if lines_count < FASTQ_RECORD_LINES * sampled_reads_count or not fastq_file.readline():
+            return reads_count
+        sampled_size = raw_file.tell()  # the gzip reader is ahead by its read buffer at most
+    return round(reads_count * os.path.getsize(fastq_path) / sampled_size)
+
+
+def get_rates(counts: Counter, total_count: int) -> dict:
+    return {key: round(count / total_count, 4) if total_count else 0.0 for key, count in counts.items()}
+
+
+def run_preflight(fq1_paths: list[str], fq2_paths: list[str], read_pairs_count: int, pool: Pool,
+                  workers_count=WORKERS_COUNT) -> dict:
+    """
+    Processes the first read_pairs_count read pairs of the first lane by the workers of the pool
+    (created by create_worker_pool()) with the real matcher tiers and reports: the share of kept pairs (match_rate), the match rate of each FASTQ
+    pattern in every placement, the number of matches by errors count, the observed speed
+    and the projected wall time of the full run.
+
+    The read pairs are split between workers_count workers. The projection assumes that parsing overlaps
+    with matching like in the run, the total read pairs count is estimated from the sizes of the forward FASTQs
+    of all lanes.
+    """
+    logger.info(f'Preflight on the first {read_pairs_count} read pairs...')
+    reader = PairedFastqReader(fq1_paths[0], fq2_paths[0])
+    parse_start = time.perf_counter()
+    read_pairs = list(islice(reader.iter_pairs(), read_pairs_count))
+    parse_time = time.perf_counter() - parse_start
+
+    stats, placement_hits, error_counts = Counter(), {}, {}
+    batch_size = max(-(-len(read_pairs) // workers_count), 1)
+    batches_args = ((read_pairs[batch_start:batch_start + batch_size],)
+                    for batch_start in range(0, len(read_pairs), batch_size))
+    match_start = time.perf_counter()
+    for batch_result in starmap_bounded(pool, process_batch, batches_args):
+        stats.update(batch_result.stats)
+        for fastq, hits in batch_result.placement_hits.items():
+            placement_hits.setdefault(fastq, Counter()).update(hits)
+        for fastq, counts in batch_result.error_counts.items():
+            error_counts.setdefault(fastq, Counter()).update(counts)
+    match_time = time.perf_counter() - match_start
+
+    sampled_pairs_count = len(read_pairs)
+    estimated_pairs_count = sum(estimate_reads_count(fq1_path, sampled_pairs_count) for fq1_path in fq1_paths)
+    pair_time = max(parse_time, match_time) / sampled_pairs_count if sampled_pairs_count else 0.0
+    report = {"read_pairs": sampled_pairs_count,
+              "match_rate": round(1 - stats['discarded_pairs'] / sampled_pairs_count, 4) if sampled_pairs_count
+              else 0.0,
+              "placement_match_rates": {fastq: get_rates(hits, sampled_pairs_count)
+                                        for fastq, hits in placement_hits.items()},
+              "error_counts": {fastq: {str(errors): count for errors, count in sorted(counts.items())}
+                               for fastq, counts in error_counts.items()},
+              "match_tiers": {tier: stats[tier] for tier in MATCH_TIERS},
+              "reads_per_second": round(1 / pair_time) if pair_time else 0,
+              "estimated_read_pairs": estimated_pairs_count,
+              "projected_wall_time": round(pair_time * estimated_pairs_count, 1)}
+    logger.info(f"Preflight match rate: {report['match_rate']}, by placements: {report['placement_match_rates']}, "
+                f"matches by errors count: {report['error_counts']}")
+    logger.info(f"Preflight speed: {report['reads_per_second']} read pairs/s, "
+                f"projected wall time of ~{estimated_pairs_count} read pairs: {report['projected_wall_time']} s")
+    return report
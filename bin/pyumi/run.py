@@ -1,8 +1,20 @@
 import argparse
 
+from demultiplex import SampleWriters, check_sample_barcode_lengths, get_sample_path, load_sample_barcodes
+
 from logger import set_logger
-from utils import keep_only_paired_reads, split_by_chunks, extract_umi, save_metrics, save_results
-from pattern import get_prepared_pattern_and_umi_len
+from utils import create_worker_pool, exit_with_error, extract_umi, save_metrics
+from matcher import MATCH_TIERS
+from memory import MemoryBudget, parse_memory_size
+from orientation import OrientationLearner, PROFILE_READS_COUNT, RECHECK_INTERVAL
+from performance import PerformanceStats
+from preflight import run_preflight
+from pattern import get_barcode_lengths, get_pattern_barcode_types, get_prepared_pattern_and_umi_len
+from stream import (DEFAULT_COMPRESSION_LEVEL, DEFAULT_COMPRESSION_THREADS, LANE_PREFETCH_BATCHES,
+                    MAX_BATCHES_IN_FLIGHT, PREFETCH_BATCHES, WORKERS_COUNT, WRITE_BATCHES, MultiLaneReader,
+                    get_writer_memory)
+from umi_table import UmiTable
+from whitelist import MAX_WHITELIST_DISTANCE, UmiCorrector, check_whitelist_umi_lengths, load_umi_whitelist
 
 logger = set_logger(name=__file__)
 
@@ -11,20 +23,69 @@ def check_argument_consistency(args: argparse.Namespace) -> list[str]:
     msg_list = []
     if not args.fq1_pattern and not args.fq2_pattern:
         msg_list += ['One of the arguments --fq1-pattern or --fq2-pattern is required.']
+    if args.sample_barcodes:
+        if not args.out_demultiplex_dir:
+            msg_list += ['The argument --out-demultiplex-dir is required with --sample-barcodes.']
+        if not any('SBC' in get_pattern_barcode_types(pattern)
+                   for pattern in (args.fq1_pattern, args.fq2_pattern) if pattern):
+            msg_list += ['Sample barcode (SBC:) is required in --fq1-pattern or --fq2-pattern '
+                         'with --sample-barcodes.']
+    if args.preflight_min_match_rate is not None and not args.preflight:
+        msg_list += ['The argument --preflight is required with --preflight-min-match-rate.']
+    if len(args.in_fq1) != len(args.in_fq2):
+        msg_list += ['The same number of --in-fq1 and --in-fq2 FASTQs (one pair per lane) is required.']
+    if args.match_timeout is not None and args.match_timeout <= 0:
+        msg_list += ['The argument --match-timeout should be positive.']
     return msg_list
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument('--in-fq1', help='Input forward FASTQ', required=True)
-    parser.add_argument('--in-fq2', help='Input reverse FASTQ', required=True)
+    parser.add_argument('--in-fq1', help='Input forward FASTQ, one per lane', nargs='+', required=True)
+    parser.add_argument('--in-fq2', help='Input reverse FASTQ, one per lane in the order of --in-fq1', nargs='+',
+                        required=True)
     parser.add_argument('--fq1-pattern', help='Barcode pattern of forward FASTQ', type=str)
     parser.add_argument('--fq2-pattern', help='Barcode pattern of reverse FASTQ', type=str)
     parser.add_argument('--find-in-reverse-complement', action='store_true')
+    parser.add_argument('--orientation', help='Search patterns in all placements (mates and strands) '
+                                              'or only in the placements learned on the first read pairs',
+                        choices=['all', 'auto'], default='all')
+    parser.add_argument('--orientation-profile-reads', help='Read pairs count to learn the orientation on',
+                        type=int, default=PROFILE_READS_COUNT)
+    parser.add_argument('--orientation-recheck-interval', help='Re-check all placements in every n-th batch',
+                        type=int, default=RECHECK_INTERVAL)
+    parser.add_argument('--search-window', help='Search patterns only in this number of the first nucleotides '
+                                                '(the last ones in reverse complement), by default the maximum span '
+                                                'of a pattern anchored to the read start', type=int)
     parser.add_argument('--max-error', help='Max error (mismatch) per ten nucleotides', type=int, default=1)
     parser.add_argument('--out-fq1', help='Output forward fastq without PCR duplicates', required=True)
     parser.add_argument('--out-fq2', help='Output reverse fastq without PCR duplicates', required=True)
     parser.add_argument('--out-json', help='Output json with umi metrics', required=True)
+    parser.add_argument('--out-umi-table', help='Output numpy archive (.npz) with UMI counts '
+                                                'and UMI index of every output read')
+    parser.add_argument('--sample-barcodes', help='Tab-separated table of sample names and sample barcodes (SBC: '
+                                                  'in a pattern) to demultiplex read pairs by')
+    parser.add_argument('--out-demultiplex-dir', help='Output directory with FASTQs and json of each sample, '
+                                                      'pairs of unknown samples are written into --out-fq1/2')
+    parser.add_argument('--umi-whitelist', help='File with whitelisted UMIs (one per line), extracted UMIs are '
+                                                'corrected to the closest whitelisted UMI')
+    parser.add_argument('--umi-whitelist-distance', help='Maximum substitutions to correct an UMI by the whitelist',
+                        type=int, choices=range(1, MAX_WHITELIST_DISTANCE + 1), default=1)
+    parser.add_argument('--preflight', help='Process this number of the first read pairs before the run '
+                                            'to report the match rate and the projected wall time', type=int)
+    parser.add_argument('--preflight-min-match-rate', help='Stop the run, if the share of read pairs kept '
+                                                           'by the preflight is below this value', type=float)
+    parser.add_argument('--match-timeout', help='Budget of the fuzzy search of a pattern in one read in seconds, '
+                                                'reads exceeding it are left without a match', type=float)
+    parser.add_argument('--parallel-reading', help='Workers parse their shards of uncompressed or BGZF input FASTQs '
+                                                   'themselves, instead of the main process', action='store_true')
+    parser.add_argument('--compression-level', help='Gzip compression level of the output FASTQs', type=int,
+                        choices=range(1, 10), default=DEFAULT_COMPRESSION_LEVEL)
+    parser.add_argument('--compression-threads', help='Threads compressing each output FASTQ', type=int,
+                        default=DEFAULT_COMPRESSION_THREADS)
+    parser.add_argument('--max-memory', help='Memory budget (e.g. 12G or 500M), batches of reads are sized '
+                                             'to fit into it, by default batches have a fixed size',
+                        type=parse_memory_size)
 
     args = parser.parse_args()
 
@@ -39,23 +100,98 @@ def run(args: argparse.Namespace):
     fq1_pattern, fq1_umi_length = get_prepared_pattern_and_umi_len(args.fq1_pattern, max_error=args.max_error)
     fq2_pattern, fq2_umi_length = get_prepared_pattern_and_umi_len(args.fq2_pattern, max_error=args.max_error)
 
-    fq1_filtered, fq2_filtered = keep_only_paired_reads(args.in_fq1, args.in_fq2)
-
-    fq12_chunks = split_by_chunks(fq1_filtered, fq2_filtered)
-
-    processed_fq1, processed_fq2, total_reads_count = extract_umi(fq12_chunks,
-                                                                  fq1_pattern,
-                                                                  fq2_pattern,
-                                                                  args.find_in_reverse_complement)
-
-    fq1_filtered, fq2_filtered = keep_only_paired_reads(processed_fq1, processed_fq2, clear=True)
-
-    save_metrics({"summary": {"before_filtering": {"total_reads": int(total_reads_count)}}},
+    fastqs_with_pattern = [fastq for fastq, pattern in (('fq1', fq1_pattern), ('fq2', fq2_pattern)) if pattern]
+
+    orientation_learner = None
+    if args.orientation == 'auto':
+        orientation_learner = OrientationLearner(fastqs_with_pattern, args.orientation_profile_reads,
+                                                 args.orientation_recheck_interval)
+    umi_table = UmiTable(fastqs_with_pattern) if args.out_umi_table else None
+    reader = MultiLaneReader(args.in_fq1, args.in_fq2)
+    lanes_count = len(args.in_fq1)
+    sample_writers, barcode_to_sample = None, None
+    if args.sample_barcodes:
+        barcode_to_sample = load_sample_barcodes(args.sample_barcodes)
+        sample_barcode_length = (get_barcode_lengths(args.fq1_pattern).get('SBC') or
+                                 get_barcode_lengths(args.fq2_pattern).get('SBC'))
+        check_sample_barcode_lengths(barcode_to_sample, sample_barcode_length)
+        sample_writers = SampleWriters(barcode_to_sample, args.out_demultiplex_dir,
+                                       args.out_fq1, args.out_fq2, args.compression_level, args.compression_threads)
+    memory_budget = None
+    if args.max_memory:
+        lane_batches = LANE_PREFETCH_BATCHES * lanes_count if lanes_count > 1 else 0
+        # a pair of compressing writers for the main output and for every sample
+        writers_count = 2 * (1 + (sample_writers.samples_count if sample_writers else 0))
+        memory_budget = MemoryBudget(args.max_memory,
+                                     MAX_BATCHES_IN_FLIGHT + PREFETCH_BATCHES + WRITE_BATCHES + lane_batches,
+                                     workers_count=WORKERS_COUNT,
+                                     reserved_memory=writers_count * get_writer_memory(args.compression_threads))
+    umi_corrector = None
+    if args.umi_whitelist:
+        umi_whitelist = load_umi_whitelist(args.umi_whitelist)
+        check_whitelist_umi_lengths(umi_whitelist, [umi_length for umi_length in (fq1_umi_length, fq2_umi_length)
+                                                    if umi_length])
+        umi_corrector = UmiCorrector(umi_whitelist, args.umi_whitelist_distance)
+
+    performance_stats = PerformanceStats()
+    preflight_report = None
+    # one pool of workers with the compiled patterns serves the preflight and the whole run
+    with create_worker_pool(fq1_pattern, fq2_pattern, args.find_in_reverse_complement, args.search_window,
+                            umi_table is not None, barcode_to_sample, umi_corrector, args.match_timeout) as pool:
+        if args.preflight:
+            preflight_report = run_preflight(args.in_fq1, args.in_fq2, args.preflight, pool)
+            if args.preflight_min_match_rate is not None and \
+                    preflight_report['match_rate'] < args.preflight_min_match_rate:
+                exit_with_error(f"Preflight match rate {preflight_report['match_rate']} is below "
+                                f"{args.preflight_min_match_rate}, check the patterns, exiting...")
+
+        stats = extract_umi(reader, args.out_fq1, args.out_fq2,
+                            fq1_pattern, fq2_pattern, args.find_in_reverse_complement,
+                            compression_level=args.compression_level,
+                            compression_threads=args.compression_threads,
+                            orientation_learner=orientation_learner,
+                            search_window=args.search_window,
+                            umi_table=umi_table,
+                            memory_budget=memory_budget,
+                            sample_writers=sample_writers,
+                            umi_corrector=umi_corrector,
+                            performance_stats=performance_stats,
+                            match_timeout=args.match_timeout,
+                            pool=pool,
+                            parallel_reading=args.parallel_reading)
+
+    if umi_table:
+        umi_table.save(args.out_umi_table)
+
+    save_metrics({"summary": {"before_filtering": {"total_reads": stats['total_reads']}}},
                  {"fq1_umi_length": fq1_umi_length},
                  {"fq2_umi_length": fq2_umi_length},
+                 {"barcode_lengths": {"fq1": get_barcode_lengths(args.fq1_pattern),
+                                      "fq2": get_barcode_lengths(args.fq2_pattern)}},
+                 {"match_tiers": {tier: stats[tier] for tier in MATCH_TIERS}},
+                 {"pairing": {"unpaired_reads": stats['unpaired_reads'], "discarded_pairs": stats['discarded_pairs'],
+                              **({"cross_shard_pairs": stats['cross_shard_pairs']} if args.parallel_reading else {})}},
+                 {"match_budget": {"match_timeout": args.match_timeout,
+                                   "budget_exceeded_reads": stats['budget_exceeded']}} if args.match_timeout else {},
+                 {"lanes": reader.get_metrics()} if lanes_count > 1 else {},
+                 {"orientation": orientation_learner.get_metrics()} if orientation_learner else {},
+                 {"preflight": preflight_report} if preflight_report else {},
+                 {"performance": performance_stats.get_metrics()},
+                 {"memory": memory_budget.get_metrics()} if memory_budget else {},
+                 {"umi_whitelist": {key: stats[key] for key in ('whitelisted_umis', 'corrected_umis', 'unknown_umis')}}
+                 if umi_corrector else {},
+                 {"demultiplexing": {"samples": sample_writers.get_metrics(),
+                                     "undetermined_read_pairs": stats['undetermined_pairs']}}
+                 if sample_writers else {},
                  output_json=args.out_json)
 
-    save_results(fq1_filtered, fq2_filtered, args.out_fq1, args.out_fq2)
+    if sample_writers:
+        for sample, sample_metrics in sample_writers.get_metrics().items():
+            save_metrics({"summary": {"before_filtering": {"total_reads": sample_metrics['read_pairs']}}},
+                         {"sample": sample}, sample_metrics,
+                         {"fq1_umi_length": fq1_umi_length},
+                         {"fq2_umi_length": fq2_umi_length},
+                         output_json=get_sample_path(args.out_demultiplex_dir, sample, args.out_json))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,218 @@
+from collections import namedtuple
+from typing import Optional
+
+import re
+
+import numpy as np
+
+from logger import set_logger
+from pattern import ALLOWED_LETTERS_IN_UMI, TRANSLATION_TABLE, PatternNode, parse_prepared_pattern
+from positional import ALLOWED_UMI_BYTES, pack_sequences
+
+logger = set_logger(name=__file__)
+
+MIN_SEED_LENGTH = 3  # shorter adapter pieces hit too often, all start positions are verified instead
+UMI_CLASS = f'[{ALLOWED_LETTERS_IN_UMI}]'
+COMPLEMENT_BYTES = np.frombuffer(bytes(range(256)).translate(TRANSLATION_TABLE), dtype=np.uint8)
+
+# fixed-length part of the pattern: an adapter with the substitutions budget or a barcode group of barcode_len
+PatternSegment = namedtuple('PatternSegment', ['adapter', 'max_errors', 'barcode_type', 'barcode_len'])
+
+
+class SeededMatch:
+    """Match of SeededAdapterMatcher with the part of the regex match interface used by create_barcoded_read()."""
+
+    def __init__(self, sequence: str, start: int, end: int, barcode_spans: dict[str, list[tuple[int, int]]],
+                 substitutions=0):
+        self._sequence = sequence
+        self._start, self._end = start, end
+        self._barcode_spans = barcode_spans
+        self.fuzzy_counts = (substitutions, 0, 0)  # substitutions, insertions and deletions like in regex
+
+    def span(self) -> tuple[int, int]:
+        return self._start, self._end
+
+    def spans(self, barcode_type: str) -> list[tuple[int, int]]:
+        return self._barcode_spans.get(barcode_type, [])
+
+    def captures(self, barcode_type: str) -> list[str]:
+        return [self._sequence[start:end] for start, end in self.spans(barcode_type)]
+
+
+def _get_literal(nodes: list[PatternNode]) -> Optional[str]:
+    if all(node.kind == 'literal' and node.min_repeat == node.max_repeat == 1 and not node.fuzzy for node in nodes):
+        return ''.join(node.value for node in nodes)
+    return None
+
+
+def _get_max_substitutions(fuzzy: str) -> Optional[int]:
+    """Returns the substitutions budget of fuzzy costs like 's<=2', None for other error types."""
+    if not fuzzy:
+        return 0
+    error_type, _, limit = fuzzy.partition('<=')
+    return int(limit) if error_type == 's' and limit.isdigit() else None
+
+
+def get_pattern_segments(pattern: str) -> Optional[tuple[bool, list[PatternSegment]]]:
+    """
+    Splits the prepared pattern into fixed-length segments: adapters with substitution costs and UMI groups.
+    Returns if the pattern is anchored to the read start and its segments, None for other patterns.
+    Example: ^(TGG){s<=1}(?P<UMI>[ATGCN]{6}) -> True, [TGG with 1 substitution, UMI of 6 nucleotides]
+    """
+    nodes = parse_prepared_pattern(pattern)
+    if not nodes:
+        return None
+    is_anchored = nodes[0] == PatternNode('anchor', '^', [], 1, 1, '')
+    segments = []
+    for node in nodes[1:] if is_anchored else nodes:
+        if node.kind == 'group' and node.value is not None:
+            if node.min_repeat != 1 or node.max_repeat != 1 or node.fuzzy or len(node.children) != 1:
+                return None
+            child = node.children[0]
+            if child.kind != 'class' or child.value != UMI_CLASS or child.min_repeat != child.max_repeat or \
+                    child.fuzzy:
+                return None
+            segments.append(PatternSegment('', 0, node.value, child.max_repeat))
+            continue
+        adapter = _get_literal(node.children) if node.kind == 'group' else _get_literal([node._replace(fuzzy='')])
+        max_errors = _get_max_substitutions(node.fuzzy)
+        if adapter is None or max_errors is None or node.min_repeat != 1 or node.max_repeat != 1:
+            return None
+        segments.append(PatternSegment(adapter, max_errors, None, 0))
+    if not any(segment.adapter for segment in segments):
+        return None
+    return is_anchored, segments
+
+
+class SeededAdapterMatcher:
+    """
+    Regex-free engine for patterns of fixed-length adapters with substitution costs and UMI groups,
+    like ^(TGGTATCAACGCAGAGTAC){s<=2}(?P<UMI>[ATGCN]{6})(TCACCAT){s<=1}(?P<UMI>[ATGCN]{6}).
+
+    Candidate match starts are seeded by exact hits of the adapter pieces: an adapter with at most k
+    substitutions contains at least one of its k + 1 pieces unchanged. All candidates are verified at once
+    by the Hamming distance of every adapter and the letters of every UMI, the candidate with the fewest
+    substitutions wins, the leftmost of equal ones, like the regex BESTMATCH search does.
+
+    The reverse complement engine searches the pattern in reverse complement of the sequences without building it:
+    the reversed segments are compared with the complemented letters, the anchor moves to the sequence end
+    and the rightmost of equal candidates wins. Its matches are in coordinates of the sequences.
+    """
+
+    def __init__(self, is_anchored: bool, segments: list[PatternSegment], is_reverse_complement=False):
+        self.is_anchored = is_anchored
+        self.is_reverse_complement = is_reverse_complement
+        if is_reverse_complement:
+            segments = [segment._replace(adapter=segment.adapter[::-1]) for segment in reversed(segments)]
+        self.segments = segments
+        self.barcode_types = {segment.barcode_type for segment in segments if segment.barcode_type}
+
+        segment_starts = np.cumsum([0] + [len(segment.adapter) or segment.barcode_len for segment in segments])
+        self.span = int(segment_starts[-1])
+        self.segment_starts = segment_starts[:-1].tolist()
+        adapters = [(start, segment) for start, segment in zip(self.segment_starts, segments) if segment.adapter]
+        # positions of adapter letters in the pattern, adapter letters and the first position of each adapter
+        self.adapter_offsets = np.concatenate([start + np.arange(len(segment.adapter)) for start, segment in adapters])
+        self.adapter_bytes = np.frombuffer(''.join(segment.adapter for _, segment in adapters).encode(), np.uint8)
+        self.adapter_bounds = np.cumsum([0] + [len(segment.adapter) for _, segment in adapters[:-1]])
+        self.max_errors = np.array([segment.max_errors for _, segment in adapters])
+        self.barcode_offsets = np.concatenate(
+            [start + np.arange(segment.barcode_len) for start, segment in zip(self.segment_starts, segments)
+             if segment.barcode_type] or [np.zeros(0, dtype=np.int64)])
+        self.seeds = self._get_seeds(adapters)
+        if self.seeds is not None:  # a lookahead reports overlapping hits of all pieces in one scan
+            self.seed_regex = re.compile(f"(?=({'|'.join(sorted(self.seeds))}))")
+
+    @staticmethod
+    def _get_seeds(adapters: list[tuple[int, PatternSegment]]) -> Optional[dict[str, list[int]]]:
+        """Splits the adapter with the longest pieces into max_errors + 1 pieces, returns them with their
+        offsets in the pattern, None if the pieces are too short to seed the search."""
+        start, adapter = max(adapters, key=lambda item: len(item[1].adapter) // (item[1].max_errors + 1))
+        piece_len = len(adapter.adapter) // (adapter.max_errors + 1)
+        if piece_len < MIN_SEED_LENGTH:
+            return None
+        seeds = {}
+        for i in range(0, piece_len * (adapter.max_errors + 1), piece_len):
+            seeds.setdefault(adapter.adapter[i:i + piece_len], []).append(start + i)
+        return seeds
+
+    def _get_candidates(self, sequences: list[str], last_starts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Returns indices of the sequences and the candidate match starts in them."""
+        if self.is_anchored:
+            read_indices = np.flatnonzero(last_starts >= 0)
+            if self.is_reverse_complement:
+                return read_indices, last_starts[read_indices]
+            return read_indices, np.zeros(len(read_indices), dtype=np.int64)
+        if self.seeds is None:  # every start position of every sequence
+            read_indices = np.flatnonzero(last_starts >= 0)
+            starts_counts = last_starts[read_indices] + 1
+            first_candidates = np.cumsum(starts_counts) - starts_counts
+            return (np.repeat(read_indices, starts_counts),
+                    np.arange(starts_counts.sum()) - np.repeat(first_candidates, starts_counts))
+        if self.is_reverse_complement:  # complemented once for the batch, seeds are found between sequence bounds
+            text = ''.join(sequences).translate(TRANSLATION_TABLE)
+            sequence_starts = np.cumsum([0] + [len(sequence) for sequence in sequences[:-1]])
+            seed_hits = (self.seed_regex.finditer(text, start, start + len(sequence))
+                         for start, sequence in zip(sequence_starts.tolist(), sequences))
+        else:
+            sequence_starts = np.zeros(len(sequences), dtype=np.int64)
+            seed_hits = map(self.seed_regex.finditer, sequences)
+        read_indices, starts = [], []
+        for i, (hits, first_start, last_start) in enumerate(zip(seed_hits, sequence_starts.tolist(),
+                                                                (sequence_starts + last_starts).tolist())):
+            candidate_starts = {seed_hit.start() - offset for seed_hit in hits
+                                for offset in self.seeds[seed_hit.group(1)]
+                                if first_start <= seed_hit.start() - offset <= last_start}
+            read_indices += [i] * len(candidate_starts)
+            starts += candidate_starts
+        read_indices = np.array(read_indices, dtype=np.int64)
+        return read_indices, np.array(starts, dtype=np.int64) - sequence_starts[read_indices]
+
+    def _create_match(self, sequence: str, start: int, substitutions: int) -> SeededMatch:
+        barcode_spans = {barcode_type: [] for barcode_type in self.barcode_types}
+        for segment_start, segment in zip(self.segment_starts, self.segments):
+            if segment.barcode_type:
+                barcode_spans[segment.barcode_type].append((start + segment_start,
+                                                            start + segment_start + segment.barcode_len))
+        return SeededMatch(sequence, start, start + self.span, barcode_spans, substitutions)
+
+    def search_many(self, sequences: list[str]) -> list[Optional[SeededMatch]]:
+        """Searches the pattern in all sequences at once, returns the best match of each sequence or None."""
+        matches = [None] * len(sequences)
+        if not sequences:
+            return matches
+        buffer, sequence_starts, lengths = pack_sequences(sequences)
+        if self.is_reverse_complement:
+            buffer = COMPLEMENT_BYTES[buffer]
+        read_indices, starts = self._get_candidates(sequences, lengths - self.span)
+        if not len(read_indices):
+            return matches
+
+        positions = (sequence_starts[read_indices] + starts)[:, None]
+        mismatches = buffer[positions + self.adapter_offsets] != self.adapter_bytes
+        errors = np.add.reduceat(mismatches, self.adapter_bounds, axis=1)
+        is_matched = (errors <= self.max_errors).all(axis=1) & \
+            ALLOWED_UMI_BYTES[buffer[positions + self.barcode_offsets]].all(axis=1)
+        read_indices, starts = read_indices[is_matched], starts[is_matched]
+        total_errors = errors[is_matched].sum(axis=1)
+
+        # the fewest errors first, then the leftmost start (the rightmost one in reverse complement),
+        # the first candidate of each sequence wins
+        order = np.lexsort((-starts if self.is_reverse_complement else starts, total_errors, read_indices))
+        read_indices, starts, total_errors = read_indices[order], starts[order], total_errors[order]
+        is_best = np.ones(len(read_indices), dtype=bool)
+        is_best[1:] = read_indices[1:] != read_indices[:-1]
+        for i, start, substitutions in zip(read_indices[is_best].tolist(), starts[is_best].tolist(),
+                                           total_errors[is_best].tolist()):
+            matches[i] = self._create_match(sequences[i], start, substitutions)
+        return matches
+
+    def search(self, sequence: str) -> Optional[SeededMatch]:
+        return self.search_many([sequence])[0]
+
+
+def create_seeded_matcher(pattern: str, is_reverse_complement=False) -> Optional[SeededAdapterMatcher]:
+    """Returns the seeded engine (of reverse complement of the sequences if is_reverse_complement)
+    for patterns it supports, None for the others."""
+    pattern_segments = get_pattern_segments(pattern)
+    return SeededAdapterMatcher(*pattern_segments, is_reverse_complement) if pattern_segments else None
@@ -0,0 +1,211 @@
+import gzip
+import io
+import os
+import struct
+from bisect import bisect_right
+from collections import deque, namedtuple
+from contextlib import closing
+from itertools import chain, islice
+from math import ceil
+from typing import BinaryIO, Iterator, Optional
+
+from memory import MemoryBudget, SAMPLED_READ_PAIRS_COUNT
+from stream import BATCH_SIZE, MultiLaneReader, iter_in_turn, pair_mates
+
+GZIP_MAGIC = b'\x1f\x8b'
+FASTQ_RECORD_LINES = 4
+GZIP_FEXTRA = 4
+GZIP_HEADER_SIZE = 12  # up to the extra field length
+GZIP_TRAILER_SIZE = 8  # CRC32 and ISIZE, the uncompressed size of the block
+
+# records of a FASTQ read by a worker: the ones starting in the size uncompressed bytes after the shard start
+# (skip_bytes of the decompressed BGZF block at the file offset), or up to the end of the file if size is None.
+# A shard after the first one starts in the middle of a record, the worker skips to the first record starting
+# after the shard start: the previous shard reads the record starting right at it.
+FastqShard = namedtuple('FastqShard', ['path', 'is_bgzf', 'block_offset', 'skip_bytes', 'size', 'is_first'])
+
+
+def get_fastq_compression(fastq_path: str) -> str:
+    """Returns 'bgzf' for blocked gzip (bgzip), 'gzip' for other gzipped FASTQs and 'plain' for uncompressed ones."""
+    with open(fastq_path, 'rb') as f:
+        header = f.read(GZIP_HEADER_SIZE)
+        if not header.startswith(GZIP_MAGIC):
+            return 'plain'
+        if len(header) < GZIP_HEADER_SIZE or not header[3] & GZIP_FEXTRA:
+            return 'gzip'
+        extra_length = struct.unpack('<H', header[10:12])[0]
+        return 'bgzf' if get_bgzf_block_size(f.read(extra_length)) else 'gzip'
+
+
+def get_bgzf_block_size(extra_field: bytes) -> Optional[int]:
+    """Returns the total size of the BGZF block from the BC subfield of the gzip extra field, None if it is missing."""
+    pos = 0
+    while pos + 4 <= len(extra_field):
+        subfield_id, subfield_length = extra_field[pos:pos + 2], struct.unpack('<H', extra_field[pos + 2:pos + 4])[0]
+        if subfield_id == b'BC' and subfield_length == 2:
+            return struct.unpack('<H', extra_field[pos + 4:pos + 6])[0] + 1
+        pos += 4 + subfield_length
+    return None
+
+
+def iter_bgzf_blocks(f: BinaryIO) -> Iterator[tuple[int, int]]:
+    """Yields the offset and the uncompressed size of every BGZF block, reading only the headers and trailers."""
+    while True:
+        block_offset = f.tell()
+        header = f.read(GZIP_HEADER_SIZE)
+        if len(header) < GZIP_HEADER_SIZE:
+            return
+        block_size = get_bgzf_block_size(f.read(struct.unpack('<H', header[10:12])[0]))
+        if block_size is None:
+            raise ValueError(f'Not a BGZF block at {block_offset} of {f.name}')
+        f.seek(block_offset + block_size - GZIP_TRAILER_SIZE)
+        yield block_offset, struct.unpack('<II', f.read(GZIP_TRAILER_SIZE))[1]
+
+
+def get_block_starts(fastq_path: str, is_bgzf: bool) -> tuple[list[int], list[int]]:
+    """
+    Returns the file offsets and the uncompressed offsets of the starts of BGZF blocks and of the end of the file,
+    the uncompressed FASTQ is one block.
+    """
+    file_offsets, uncompressed_offsets = [0], [0]
+    if not is_bgzf:
+        file_size = os.path.getsize(fastq_path)
+        return file_offsets + [file_size], uncompressed_offsets + [file_size]
+    with open(fastq_path, 'rb') as f:
+        for _, uncompressed_size in iter_bgzf_blocks(f):
+            file_offsets.append(f.tell())
+            uncompressed_offsets.append(uncompressed_offsets[-1] + uncompressed_size)
+    return file_offsets, uncompressed_offsets
+
+
+def get_uncompressed_size(fastq_path: str) -> int:
+    return get_block_starts(fastq_path, get_fastq_compression(fastq_path) == 'bgzf')[1][-1]
+
+
+def iter_shards(fastq_path: str, shards_count: int) -> Iterator[FastqShard]:
+    """
+    Yields shards_count shards of equal uncompressed size of the uncompressed or BGZF FASTQ, planned without
+    decompression: a shard of a BGZF FASTQ starts in the block with its first uncompressed byte.
+    """
+    is_bgzf = get_fastq_compression(fastq_path) == 'bgzf'
+    file_offsets, uncompressed_offsets = get_block_starts(fastq_path, is_bgzf)
+    split_offsets = [uncompressed_offsets[-1] * shard_index // shards_count for shard_index in range(shards_count)]
+    for shard_index, split_offset in enumerate(split_offsets):
+        if is_bgzf:
+            block_index = bisect_right(uncompressed_offsets, split_offset) - 1
+            block_offset, skip_bytes = file_offsets[block_index], split_offset - uncompressed_offsets[block_index]
+        else:
+            block_offset, skip_bytes = split_offset, 0
+        size = split_offsets[shard_index + 1] - split_offset if shard_index + 1 < shards_count else None
+        yield FastqShard(fastq_path, is_bgzf, block_offset, skip_bytes, size, shard_index == 0)
+
+
+def iter_paired_shards(fq1_path: str, fq2_path: str, shards_count: int) -> Iterator[tuple[FastqShard, FastqShard]]:
+    """
+    Yields the shards of both FASTQs split at the same fractions of their uncompressed size, so the shards
+    of a pair have nearly the same records, mates of the records near the splits can be in the neighbour shards.
+    """
+    return zip(iter_shards(fq1_path, shards_count), iter_shards(fq2_path, shards_count))
+
+
+def skip_to_record(lines: Iterator[str]) -> tuple[Iterator[str], int]:
+    """
+    Skips the lines up to the first record start: the header line starts with @ and the line after its sequence
+    starts with +, a quality line can start with @, but it is followed by a header and a sequence.
+    Returns the lines from the record and the length of the skipped lines.
+    """
+    skipped_size = len(next(lines, ''))  # the rest of the line split by the shard start
+    window = list(islice(lines, FASTQ_RECORD_LINES - 1))
+    while window and not (window[0].startswith('@') and len(window) > 2 and window[2].startswith('+')):
+        skipped_size += len(window.pop(0))
+        window.extend(islice(lines, 1))
+    return chain(window, lines), skipped_size
+
+
+def iter_shard_reads(shard: FastqShard) -> Iterator[tuple]:
+    """Yields the records of the shard (name, sequence, quality) like pyfastx does."""
+    with open(shard.path, 'rb') as raw_file:
+        raw_file.seek(shard.block_offset)
+        fastq_file = raw_file
+        if shard.is_bgzf:
+            fastq_file = gzip.GzipFile(fileobj=raw_file)
+            fastq_file.read(shard.skip_bytes)
+        lines = iter(io.TextIOWrapper(fastq_file, encoding='ascii', newline='\n'))
+        position = 0  # in the uncompressed bytes after the shard start, the FASTQ is ASCII
+        if not shard.is_first:
+            lines, position = skip_to_record(lines)
+        for header, sequence, separator, quality in zip(*[lines] * FASTQ_RECORD_LINES):
+            if shard.size is not None and position > shard.size:
+                return
+            yield header[1:].rstrip('\r\n'), sequence.rstrip('\r\n'), quality.rstrip('\r\n')
+            position += len(header) + len(sequence) + len(separator) + len(quality)
+
+
+def get_record_size(fastq_path: str, records_count=SAMPLED_READ_PAIRS_COUNT) -> int:
+    """Returns the mean uncompressed size of the first records of the FASTQ."""
+    is_bgzf = get_fastq_compression(fastq_path) == 'bgzf'
+    with closing(iter_shard_reads(FastqShard(fastq_path, is_bgzf, 0, 0, None, True))) as reads:
+        sizes = [sum(map(len, read)) + len('@\n\n+\n\n') for read in islice(reads, records_count)]
+    return sum(sizes) // len(sizes) if sizes else 1
+
+
+def read_shard_pairs(shard1: FastqShard, shard2: FastqShard) -> tuple[list[tuple], dict, dict]:
+    """Reads and pairs the records of both shards, returns the read pairs and the reads without a mate by read ID."""
+    pending_reads1, pending_reads2 = {}, {}
+    read_pairs = list(pair_mates(iter_shard_reads(shard1), iter_shard_reads(shard2), pending_reads1, pending_reads2))
+    return read_pairs, pending_reads1, pending_reads2
+
+
+class ShardMatePairer:
+    """
+    Pairs the reads left without a mate by the shards of a lane: mates near the shard splits are read
+    by the neighbour shards. Reads left in the pending buffers at the end have no mate.
+    """
+
+    def __init__(self):
+        self.pending_reads1 = {}
+        self.pending_reads2 = {}
+
+    def pair(self, reads1: dict, reads2: dict) -> list[tuple]:
+        return list(pair_mates(reads1.values(), reads2.values(), self.pending_reads1, self.pending_reads2))
+
+    @property
+    def unpaired_reads_count(self) -> int:
+        return len(self.pending_reads1) + len(self.pending_reads2)
+
+
+def is_shardable(fastq_path: str) -> bool:
+    """Only uncompressed and BGZF FASTQs can be read from a record in the middle."""
+    return get_fastq_compression(fastq_path) != 'gzip'
+
+
+def get_reads_per_shard(reader: MultiLaneReader, memory_budget: Optional[MemoryBudget] = None,
+                        batch_size=BATCH_SIZE) -> int:
+    """
+    Returns the read pairs count of every shard: batch_size, or if memory_budget is given, its batch size
+    observed on the first read pairs of the first lane (the shards are not parsed by the main process).
+    """
+    if memory_budget is None:
+        return batch_size
+    read_pairs = reader.readers[0].iter_pairs()
+    memory_budget.observe(list(islice(read_pairs, SAMPLED_READ_PAIRS_COUNT)))
+    read_pairs.close()
+    return memory_budget.batch_size
+
+
+def get_shards_count(fastq_path: str, reads_per_shard: int) -> int:
+    """Returns the count of shards of about reads_per_shard records, estimated by the size of the first records."""
+    return max(ceil(get_uncompressed_size(fastq_path) / (reads_per_shard * get_record_size(fastq_path))), 1)
+
+
+def iter_lane_shards(reader: MultiLaneReader, reads_per_shard: int, lane_indices: deque) -> \
+        Iterator[tuple[FastqShard, FastqShard]]:
+    """
+    Yields the paired shards of all lanes of the reader in turn and appends the lane of every shard pair
+    into lane_indices, so the read pairs of the ordered results are added to their lanes.
+    """
+    for lane_index, shard_pair in iter_in_turn([iter_paired_shards(lane.fq1_path, lane.fq2_path,
+                                                                   get_shards_count(lane.fq1_path, reads_per_shard))
+                                                for lane in reader.readers]):
+        lane_indices.append(lane_index)
+        yield shard_pair
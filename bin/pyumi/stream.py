@@ -0,0 +1,303 @@
+import gzip
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, zip_longest
+from multiprocessing.pool import Pool
+from typing import Callable, Iterable, Iterator, Optional
+
+import pyfastx
+
+from logger import set_logger
+from memory import MemoryBudget
+
+logger = set_logger(name=__file__)
+
+BATCH_SIZE = 20_000  # read pairs count in one batch sent to a worker
+WORKERS_COUNT = os.cpu_count() or 1  # worker processes of the pool
+MAX_BATCHES_IN_FLIGHT = 2 * WORKERS_COUNT  # batches submitted to the pool, but not yet written
+PREFETCH_BATCHES = 2  # batches parsed ahead by the reader thread, but not yet submitted to the pool
+LANE_PREFETCH_BATCHES = 1  # batches parsed ahead by the thread of every lane, if there are several lanes
+WRITE_BATCHES = 2  # batch results waiting for the writer thread
+PREFETCH_POLL_INTERVAL = 0.1  # seconds between checks if the consumer of the prefetched batches stopped
+COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024  # uncompressed bytes in one gzip member
+DEFAULT_COMPRESSION_LEVEL = 1  # output FASTQs are only read by the CalibDedup step
+DEFAULT_COMPRESSION_THREADS = min(4, os.cpu_count() or 1)  # per output file
+
+
+def get_read_id(read_name: str) -> str:
+    """Returns the read ID without comment and mate suffix. Example: 'r1/1 1:N:0:1' -> 'r1'"""
+    read_id = read_name.split(maxsplit=1)[0]
+    return read_id[:-2] if read_id.endswith(('/1', '/2')) else read_id
+
+
+def pair_mates(reads1: Iterable[tuple], reads2: Iterable[tuple], pending_reads1: dict, pending_reads2: dict) -> \
+        Iterator[tuple[tuple, tuple]]:
+    """
+    Pairs mates by read ID on the fly: out of order mates wait in the pending buffers until their mate is read,
+    the reads left in the buffers at the end have no mate.
+    """
+    for read1, read2 in zip_longest(reads1, reads2):
+        if read1 and read2 and get_read_id(read1[0]) == get_read_id(read2[0]):
+            yield read1, read2
+            continue
+        if read1:
+            read1_id = get_read_id(read1[0])
+            if read1_id in pending_reads2:
+                yield read1, pending_reads2.pop(read1_id)
+            else:
+                pending_reads1[read1_id] = read1
+        if read2:
+            read2_id = get_read_id(read2[0])
+            if read2_id in pending_reads1:
+                yield pending_reads1.pop(read2_id), read2
+            else:
+                pending_reads2[read2_id] = read2
+
+
+class PairedFastqReader:
+    """
+    Lazily reads both FASTQ files and yields batches of read pairs (name, sequence, quality).
+    Mates are paired by read ID on the fly: reads without a mate are dropped and counted,
+    out of order mates wait in a buffer until their mate is read.
+    """
+
+    def __init__(self, fq1_path: str, fq2_path: str):
+        self.fq1_path = fq1_path
+        self.fq2_path = fq2_path
+        self.unpaired_reads_count = 0
+
+    def iter_pairs(self) -> Iterator[tuple]:
+        reads1 = pyfastx.Fastq(self.fq1_path, build_index=False, full_name=True)
+        reads2 = pyfastx.Fastq(self.fq2_path, build_index=False, full_name=True)
+        pending_reads1, pending_reads2 = {}, {}
+        yield from pair_mates(reads1, reads2, pending_reads1, pending_reads2)
+        self.unpaired_reads_count += len(pending_reads1) + len(pending_reads2)
+
+    def iter_batches(self, batch_size=BATCH_SIZE,
+                     memory_budget: Optional[MemoryBudget] = None) -> Iterator[list[tuple]]:
+        """Yields batches of batch_size read pairs, if memory_budget is given, it sizes the batches instead."""
+        read_pairs = self.iter_pairs()
+        while batch := list(islice(read_pairs, memory_budget.batch_size if memory_budget else batch_size)):
+            if memory_budget:
+                memory_budget.observe(batch)
+            yield batch
+
+
+def prefetch(items: Iterable, max_prefetched=PREFETCH_BATCHES) -> Iterator:
+    """
+    Iterates over items in a background thread, keeping up to max_prefetched items ready,
+    so the next batches are decompressed and parsed while the pool processes the previous ones.
+    Errors of the background iteration are raised in the consumer.
+    """
+    ready = queue.Queue(maxsize=max_prefetched)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                ready.put(item, timeout=PREFETCH_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except BaseException as e:
+            put((end, e))
+
+    producer = threading.Thread(target=produce, name='prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def iter_in_turn(lanes: list[Iterator]) -> Iterator[tuple]:
+    """
+    Yields the items of the lane iterators in turn with the index of their lane, until every lane is exhausted.
+    Several lanes are advanced concurrently by their own prefetch threads.
+    """
+    if len(lanes) > 1:
+        lanes = [prefetch(items, LANE_PREFETCH_BATCHES) for items in lanes]
+    end = object()
+    active_lanes = list(enumerate(lanes))
+    try:
+        while active_lanes:
+            for lane in list(active_lanes):
+                lane_index, items = lane
+                item = next(items, end)
+                if item is end:
+                    active_lanes.remove(lane)
+                    continue
+                yield lane_index, item
+    finally:
+        for items in lanes:
+            if hasattr(items, 'close'):
+                items.close()
+
+
+class MultiLaneReader:
+    """
+    Reads several lanes (pairs of FASTQs) as one input: every lane is parsed by its own prefetch thread
+    and the batches of lanes are yielded in turn, so the lanes are parsed and processed concurrently.
+    A single lane is read like by PairedFastqReader.
+    Lanes read by the workers themselves (see shards.py) add their read pairs by add_lane_reads().
+    """
+
+    def __init__(self, fq1_paths: list[str], fq2_paths: list[str]):
+        self.readers = [PairedFastqReader(fq1_path, fq2_path) for fq1_path, fq2_path in zip(fq1_paths, fq2_paths)]
+        self.read_pairs_counts = [0] * len(self.readers)
+
+    @property
+    def unpaired_reads_count(self) -> int:
+        return sum(reader.unpaired_reads_count for reader in self.readers)
+
+    def iter_batches(self, batch_size=BATCH_SIZE,
+                     memory_budget: Optional[MemoryBudget] = None) -> Iterator[list[tuple]]:
+        """Yields batches of all lanes in turn, until every lane is read."""
+        for lane_index, batch in iter_in_turn([reader.iter_batches(batch_size, memory_budget)
+                                               for reader in self.readers]):
+            self.add_lane_reads(lane_index, len(batch))
+            yield batch
+
+    def add_lane_reads(self, lane_index: int, read_pairs_count: int, unpaired_reads_count=0):
+        self.read_pairs_counts[lane_index] += read_pairs_count
+        self.readers[lane_index].unpaired_reads_count += unpaired_reads_count
+
+    def get_metrics(self) -> list[dict]:
+        return [{"fq1": reader.fq1_path, "fq2": reader.fq2_path, "read_pairs": read_pairs_count,
+                 "unpaired_reads": reader.unpaired_reads_count}
+                for reader, read_pairs_count in zip(self.readers, self.read_pairs_counts)]
+
+
+def starmap_bounded(pool: Pool, func: Callable, batches_args: Iterable[tuple],
+                    max_in_flight=MAX_BATCHES_IN_FLIGHT) -> Iterator:
+    """
+    Lazy ordered analogue of Pool.starmap, which submits no more than max_in_flight batches at once,
+    so the reader can not run ahead of the workers and the writer.
+    """
+    pending = deque()
+    for batch_args in batches_args:
+        pending.append(pool.apply_async(func, batch_args))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def get_writer_memory(compression_threads=DEFAULT_COMPRESSION_THREADS) -> int:
+    """Returns the upper bound of memory taken by the blocks of one CompressedFastqWriter."""
+    max_blocks_count = 2 * compression_threads + 1  # pending blocks and the block being collected
+    return 2 * max_blocks_count * COMPRESSION_BLOCK_SIZE  # uncompressed and compressed copies
+
+
+class BackgroundWriter:
+    """
+    Runs write calls in a single background thread in the order of submission, no more than max_pending at once,
+    so batch results are encoded and written while the next ones are collected from the pool.
+    Errors of the writes are raised in the submitting thread.
+    """
+
+    def __init__(self, max_pending=WRITE_BATCHES):
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._executor = None
+
+    def __enter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+        return self
+
+    def submit(self, func: Callable, *args):
+        self._pending.append(self._executor.submit(func, *args))
+        while len(self._pending) > self.max_pending:
+            self._pending.popleft().result()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                while self._pending:
+                    self._pending.popleft().result()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+
+
+def compress_block(block: bytes, compression_level: int) -> tuple[bytes, float]:
+    """Returns the block compressed into a gzip member and the time taken."""
+    start_time = time.perf_counter()
+    compressed_block = gzip.compress(block, compresslevel=compression_level)
+    return compressed_block, time.perf_counter() - start_time
+
+
+class CompressedFastqWriter:
+    """
+    Writes FASTQ records into the gzip file with parallel block compression.
+
+    Records are collected into blocks of COMPRESSION_BLOCK_SIZE bytes, every block is compressed
+    into a separate gzip member by a thread pool (zlib releases the GIL) and members are written
+    in the original order. A concatenation of gzip members is a valid gzip file.
+    """
+
+    def __init__(self, path: str, compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 compression_threads=DEFAULT_COMPRESSION_THREADS):
+        self.path = path
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self._block, self._block_size = [], 0
+        self._pending_blocks = deque()
+        self._blocks_written = 0
+        self.compress_time = 0.0  # seconds spent by the threads compressing the written blocks
+        self._out_file = None
+        self._executor = None
+
+    def __enter__(self):
+        self._out_file = open(self.path, 'wb')
+        self._executor = ThreadPoolExecutor(max_workers=self.compression_threads)
+        return self
+
+    def write(self, records: bytes):
+        self._block.append(records)
+        self._block_size += len(self._block[-1])
+        if self._block_size >= COMPRESSION_BLOCK_SIZE:
+            self._submit_block()
+
+    def _submit_block(self):
+        self._pending_blocks.append(self._executor.submit(compress_block, b''.join(self._block),
+                                                          self.compression_level))
+        self._block, self._block_size = [], 0
+        while len(self._pending_blocks) > 2 * self.compression_threads:
+            self._write_compressed_block()
+
+    def _write_compressed_block(self):
+        compressed_block, compress_time = self._pending_blocks.popleft().result()
+        self._out_file.write(compressed_block)
+        self.compress_time += compress_time
+        self._blocks_written += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                if self._block or (not self._blocks_written and not self._pending_blocks):  # empty gzip if no records
+                    self._submit_block()
+                while self._pending_blocks:
+                    self._write_compressed_block()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            self._out_file.close()
@@ -0,0 +1,65 @@
+import gzip
+import io
+import random
+from collections import namedtuple
+
+from extract import get_reverse_complement
+
+NUCLEOTIDES = 'ATGC'
+QUALITY_LETTERS = 'FGHIJK#'
+
+# read design of a library: the pyumi pattern of the forward FASTQ and the parts of the forward read,
+# adapters are written with substitutions at error_rate, UMIs are random, the read is filled up with the insert
+ReadDesign = namedtuple('ReadDesign', ['name', 'pattern', 'parts', 'max_prefix_len', 'rc_share',
+                                       'find_in_reverse_complement'])
+UMI_PART = 'UMI'
+SMART_ADAPTER = 'TGGTATCAACGCAGAGTAC'
+
+DESIGNS = {
+    'anchored': ReadDesign('anchored', '^UMI:N{12}', [(UMI_PART, 12)], 0, 0.0, False),
+    'adapter_umi': ReadDesign('adapter_umi', f'^{SMART_ADAPTER}(UMI:N{{12}})',
+                              [SMART_ADAPTER, (UMI_PART, 12)], 0, 0.0, False),
+    'multi_umi': ReadDesign('multi_umi', f'{SMART_ADAPTER}(UMI:N{{6}})TCACCAT(UMI:N{{6}})',
+                            [SMART_ADAPTER, (UMI_PART, 6), 'TCACCAT', (UMI_PART, 6)], 5, 0.0, False),
+    'reverse_complement': ReadDesign('reverse_complement', f'^{SMART_ADAPTER}(UMI:N{{12}})',
+                                     [SMART_ADAPTER, (UMI_PART, 12)], 0, 0.5, True),
+}
+
+
+def get_random_sequence(rng: random.Random, length: int) -> str:
+    return ''.join(rng.choices(NUCLEOTIDES, k=length))
+
+
+def add_substitutions(rng: random.Random, sequence: str, error_rate: float) -> str:
+    return ''.join(rng.choice(NUCLEOTIDES.replace(letter, '')) if rng.random() < error_rate else letter
+                   for letter in sequence)
+
+
+def create_read_sequence(rng: random.Random, design: ReadDesign, read_length: int, error_rate: float) -> str:
+    """Returns the forward read of the design: random prefix, adapters with errors and UMIs, then the insert."""
+    sequence = get_random_sequence(rng, rng.randint(0, design.max_prefix_len))
+    for part in design.parts:
+        if isinstance(part, tuple):
+            sequence += get_random_sequence(rng, part[1])
+        else:
+            sequence += add_substitutions(rng, part, error_rate)
+    sequence += get_random_sequence(rng, max(read_length - len(sequence), 0))
+    return get_reverse_complement(sequence) if rng.random() < design.rc_share else sequence
+
+
+def open_fastq(path: str) -> io.TextIOWrapper:
+    """Opens gzipped FASTQ for writing without the modification time in the header, so the file is reproducible."""
+    return io.TextIOWrapper(gzip.GzipFile(path, 'wb', compresslevel=1, mtime=0), encoding='ascii')
+
+
+def write_read_pairs(fq1_path: str, fq2_path: str, design: ReadDesign, read_pairs_count: int,
+                     error_rate=0.01, read_length=150, seed=0):
+    """Writes read_pairs_count synthetic read pairs of the design, the same seed gives the same FASTQs."""
+    rng = random.Random(seed)
+    with open_fastq(fq1_path) as fq1, open_fastq(fq2_path) as fq2:
+        for i in range(read_pairs_count):
+            read1_seq = create_read_sequence(rng, design, read_length, error_rate)
+            read2_seq = get_random_sequence(rng, read_length)
+            for fq, read_seq, read_num in ((fq1, read1_seq, 1), (fq2, read2_seq, 2)):
+                read_quality = ''.join(rng.choices(QUALITY_LETTERS, k=len(read_seq)))
+                fq.write(f"@read{i} {read_num}:N:0:1\n{read_seq}\n+\n{read_quality}\n")
@@ -0,0 +1,143 @@
+import os
+import shutil
+from collections import namedtuple
+from itertools import chain
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional, Union
+
+from logger import set_logger
+from stream import MAX_BATCHES_IN_FLIGHT
+
+logger = set_logger(name=__file__)
+
+FASTQ_FIELD_SEPARATOR = '\n'  # fields of FASTQ records can not contain line breaks
+SHARED_MEMORY_DIR = '/dev/shm'  # tmpfs of shared memory on Linux, only 64M in docker containers by default
+SLOT_SIZE_HEADROOM = 1.25  # buffers are created larger than the batch, so the next batches of similar size fit
+
+# handle of read pairs packed into shared memory, only the handle is pickled to the worker
+SharedBatch = namedtuple('SharedBatch', ['name', 'size'])
+
+
+def pack_read_pairs(read_pairs: list[tuple]) -> bytes:
+    """Joins the fields (name, sequence, quality) of both mates of all read pairs into one ASCII buffer."""
+    return FASTQ_FIELD_SEPARATOR.join(chain.from_iterable(chain.from_iterable(read_pairs))).encode('ascii')
+
+
+def unpack_read_pairs(buffer) -> list[tuple]:
+    """
+    Returns the read pairs packed by pack_read_pairs(), buffer is any bytes-like object.
+    The buffer is decoded once for the batch: workers match and assemble the records as str.
+    """
+    if not len(buffer):
+        return []
+    fields = iter(str(buffer, 'ascii').split(FASTQ_FIELD_SEPARATOR))
+    return list(zip(zip(fields, fields, fields), zip(fields, fields, fields)))
+
+
+def read_shared_batch(batch: Union[SharedBatch, list[tuple]]) -> list[tuple]:
+    """
+    Attaches to the shared memory of the batch in the worker and unpacks its read pairs,
+    read pairs which did not fit into shared memory are passed (pickled) as is.
+    """
+    if not isinstance(batch, SharedBatch):
+        return batch
+    if not batch.size:
+        return []
+    memory = shared_memory.SharedMemory(batch.name)
+    try:
+        with memory.buf[:batch.size] as buffer:
+            return unpack_read_pairs(buffer)
+    finally:
+        memory.close()
+
+
+def get_free_shared_memory() -> float:
+    """Returns free bytes of the shared memory, unlimited if its size is unknown."""
+    if not os.path.isdir(SHARED_MEMORY_DIR):
+        return float('inf')
+    return shutil.disk_usage(SHARED_MEMORY_DIR).free
+
+
+def allocate_shared_memory(size: int) -> Optional[shared_memory.SharedMemory]:
+    """
+    Creates shared memory with all its pages allocated upfront, returns None if the shared memory has no room for them.
+    Pages of the tmpfs are allocated only when they are written otherwise, and writing past its free space
+    kills the process by SIGBUS.
+    """
+    memory = shared_memory.SharedMemory(create=True, size=size)
+    if not os.path.isdir(SHARED_MEMORY_DIR):
+        return memory
+    try:
+        fd = os.open(os.path.join(SHARED_MEMORY_DIR, memory.name.lstrip('/')), os.O_RDWR)
+        try:
+            os.posix_fallocate(fd, 0, memory.size)
+        finally:
+            os.close(fd)
+    except OSError:
+        memory.close()
+        memory.unlink()
+        return None
+    return memory
+
+
+def start_resource_tracker():
+    """
+    Starts the tracker of shared memory before the workers are forked, so they share it with the main process:
+    otherwise every worker starts its own tracker, which unlinks the buffers attached by the worker when it exits.
+    """
+    resource_tracker.ensure_running()
+
+
+class SharedBatchRing:
+    """
+    Shared memory buffers reused by the read batches in flight: the batch k is packed into the buffer
+    k % slots_count, so slots_count has to be max_in_flight of starmap_bounded(): when it takes the next batch,
+    the result of the batch submitted slots_count batches ago is already returned and its buffer is free.
+    A buffer is recreated larger, when the batch does not fit into it, all its pages (with the headroom for
+    the next batches) are allocated when it is created. Buffers are unlinked on exit.
+    If the shared memory has no room for the buffer, the read pairs are passed to the worker pickled.
+    """
+
+    def __init__(self, slots_count=MAX_BATCHES_IN_FLIGHT):
+        self.slots = [None] * slots_count
+        self.batches_count = 0
+        self.pickled_batches_count = 0
+
+    def pack(self, read_pairs: list[tuple]) -> Union[SharedBatch, list[tuple]]:
+        buffer = pack_read_pairs(read_pairs)
+        slot_index = self.batches_count % len(self.slots)
+        self.batches_count += 1
+        memory = self.slots[slot_index]
+        if memory is None or memory.size < len(buffer):
+            self._unlink(slot_index)
+            slot_size = max(int(len(buffer) * SLOT_SIZE_HEADROOM), 1)
+            memory = allocate_shared_memory(slot_size) if slot_size <= get_free_shared_memory() else None
+            if memory is None:
+                self._warn_pickled()
+                return read_pairs
+            self.slots[slot_index] = memory
+        memory.buf[:len(buffer)] = buffer
+        return SharedBatch(memory.name, len(buffer))
+
+    def _warn_pickled(self):
+        if not self.pickled_batches_count:
+            logger.warning(f'No room for read batches in the shared memory ({SHARED_MEMORY_DIR}), '
+                           f'passing them to the workers pickled, consider a larger --shm-size of the container')
+        self.pickled_batches_count += 1
+
+    def _unlink(self, slot_index: int):
+        memory = self.slots[slot_index]
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+            self.slots[slot_index] = None
+
+    def close(self):
+        for slot_index in range(len(self.slots)):
+            self._unlink(slot_index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
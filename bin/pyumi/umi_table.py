@@ -0,0 +1,51 @@
+import numpy as np
+
+from logger import set_logger
+
+logger = set_logger(name=__file__)
+
+
+def summarize_umis(umis: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Returns unique UMIs of a batch and the index of every read UMI in them."""
+    unique_umis, read_umi_index = np.unique(np.array(umis, dtype='S'), return_inverse=True)
+    return unique_umis, read_umi_index.astype(np.uint32).ravel()
+
+
+class UmiTable:
+    """
+    Accumulates UMI counts and the UMI index of every output read for each FASTQ with a pattern.
+
+    The table is saved as a compressed numpy archive with arrays (fq is 'fq1' or 'fq2'):
+    {fq}_umis (UMI sequences), {fq}_counts (reads count per UMI) and
+    {fq}_read_umi_index (index in {fq}_umis of each read in the output FASTQ order).
+    """
+
+    def __init__(self, fastqs: list[str]):
+        self.umi_ids = {fastq: {} for fastq in fastqs}
+        self.read_umi_indices = {fastq: [] for fastq in fastqs}
+
+    def add_batch(self, batch_umis: dict[str, tuple[np.ndarray, np.ndarray]]):
+        """Adds UMIs of a batch summarized by summarize_umis(), batches have to come in the output order."""
+        for fastq, (unique_umis, read_umi_index) in batch_umis.items():
+            umi_ids = self.umi_ids[fastq]
+            batch_umi_ids = np.fromiter((umi_ids.setdefault(umi, len(umi_ids)) for umi in unique_umis.tolist()),
+                                        dtype=np.uint32, count=len(unique_umis))
+            self.read_umi_indices[fastq].append(batch_umi_ids[read_umi_index])
+
+    def get_arrays(self, fastq: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        umi_ids = self.umi_ids[fastq]
+        read_umi_index = np.concatenate(self.read_umi_indices[fastq] or [np.zeros(0, dtype=np.uint32)])
+        umis = np.array(list(umi_ids), dtype='S') if umi_ids else np.zeros(0, dtype='S1')
+        counts = np.bincount(read_umi_index, minlength=len(umi_ids)).astype(np.uint64)
+        return umis, counts, read_umi_index
+
+    def save(self, output_path: str):
+        arrays = {}
+        for fastq in self.umi_ids:
+            arrays[f'{fastq}_umis'], arrays[f'{fastq}_counts'], arrays[f'{fastq}_read_umi_index'] = \
+                self.get_arrays(fastq)
+        with open(output_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        unique_umis_count = {fastq: len(umi_ids) for fastq, umi_ids in self.umi_ids.items()}
+        logger.info(f'UMI table saved into {output_path}, unique UMIs count: {unique_umis_count}')
+
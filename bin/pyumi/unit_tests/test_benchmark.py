@@ -0,0 +1,20 @@
+import sys
+
+from benchmark import run_isolated
+
+
+def succeed(value: int) -> dict:
+    return {"value": value}
+
+
+def fail_input_checks(value: int) -> dict:
+    sys.exit(1)
+
+
+def test_run_isolated():
+    result = run_isolated(succeed, 5)
+    assert result['value'] == 5 and set(result['peak_rss']) == {'main', 'children'}
+
+
+def test_run_isolated_returns_none_if_child_fails():
+    assert run_isolated(fail_input_checks, 5) is None
@@ -0,0 +1,35 @@
+from pytest import raises
+
+from demultiplex import SampleWriters, load_sample_barcodes
+from extract import create_new_read, init_worker, process_batch
+
+
+def test_load_sample_barcodes(tmp_path):
+    sample_barcodes_path = tmp_path / 'samples.tsv'
+    sample_barcodes_path.write_text('sample\tbarcode\nS1\tACGT\nS2\tttgc\n\n')
+    assert load_sample_barcodes(str(sample_barcodes_path)) == {'ACGT': 'S1', 'TTGC': 'S2'}
+
+    sample_barcodes_path.write_text('S1\tACGT\nS2\tACGT\n')
+    with raises(SystemExit):
+        load_sample_barcodes(str(sample_barcodes_path))
+
+
+def test_sample_writers_metrics(tmp_path):
+    sample_writers = SampleWriters({'ACGT': 'S1', 'TTGC': 'S1', 'GGAA': 'S2'}, str(tmp_path), 'R1.fastq.gz',
+                                   'R2.fastq.gz')
+    assert sample_writers.samples_count == 2
+    assert sample_writers.get_metrics() == {'S1': {'sample_barcodes': ['ACGT', 'TTGC'], 'read_pairs': 0},
+                                            'S2': {'sample_barcodes': ['GGAA'], 'read_pairs': 0}}
+
+
+def test_process_batch_demultiplexes_samples():
+    init_worker('^(?P<SBC>[ATGCN]{2})(?P<UMI>[ATGCN]{4})', '', find_umi_in_rc=False,
+                barcode_to_sample={'AC': 'S1'})
+    read_pairs = [(('r1', 'ACTTTTGG', 'KKKKKKKK'), ('r1', 'CC', 'KK')),
+                  (('r2', 'GGTTTTGG', 'KKKKKKKK'), ('r2', 'CC', 'KK'))]
+    batch_result = process_batch(read_pairs)
+    assert batch_result.samples['S1'].fq1_records == create_new_read('r1 SBC:AC', 'TTTTGG', 'KKKKKK').encode()
+    assert batch_result.samples['S1'].reads_count == 1
+    assert batch_result.fq1_records == create_new_read('r2 SBC:GG', 'TTTTGG', 'KKKKKK').encode()
+    assert batch_result.stats['undetermined_pairs'] == 1
+    assert batch_result.stats['discarded_pairs'] == 0
@@ -1,7 +1,8 @@
 from pytest import fixture
 
-from extract import (create_new_read, get_reverse_complement, PatternMarkup, BarcodeMarkup, remove_subseq,
-                     replace_umi_to_the_seq_start)
+import regex
+
+from extract import create_barcoded_read, create_new_read, get_reverse_complement, init_worker, process_batch
 
 
 @fixture(scope='module')
@@ -19,21 +20,6 @@ def read_quality() -> str:
     return "KK?KK.KAKKKK&KKY"
 
 
-@fixture(scope='module')
-def barcode_seq() -> str:
-    return "TTTT"
-
-
-@fixture(scope='module')
-def barcode_quality() -> str:
-    return "K.KA"
-
-
-@fixture(scope='module')
-def pattern_markup(barcode_seq, barcode_quality) -> str:
-    return PatternMarkup(BarcodeMarkup(barcode_seq, barcode_quality), 4, 8)
-
-
 def test_create_new_read(read_header, read_seq, read_quality):
     assert (create_new_read(read_header, read_seq, read_quality)
             == (f"@{read_header}\n"
@@ -47,10 +33,50 @@ def test_get_reverse_complement(read_seq):
     assert get_reverse_complement(read_seq) == 'GGGGCCCCAAAATTTT'
 
 
-def test_replace_umi_to_the_seq_start(read_seq, read_quality, pattern_markup):
-    assert (replace_umi_to_the_seq_start(read_seq, read_quality, pattern_markup)
-            == ("TTTTAAAAGGGGCCCC", "K.KAKK?KKKKK&KKY"))
+def test_create_barcoded_read(read_header, read_seq, read_quality):
+    match = regex.search('(?P<SBC>[ATGCN]{2})(?P<UMI>[ATGCN]{2})GG', read_seq)
+    assert (create_barcoded_read((read_header, read_seq, read_quality), match, header_barcode_types=('SBC',))
+            == (create_new_read(f'{read_header} SBC:TT', 'TTAAAAGGCCCC', 'KAKK?KKK&KKY'), 'TT', 'TT'))
+
+
+def test_create_barcoded_read_replaces_n_in_umi(read_header):
+    match = regex.search('^(?P<UMI>[ATGCN]{4})', 'ANNTGG')
+    assert create_barcoded_read((read_header, 'ANNTGG', 'KKKKKK'), match) == \
+           (create_new_read(read_header, 'AAATGG', 'KKKKKK'), 'AAAT', '')
+
+
+def test_process_batch(read_header, read_seq, read_quality):
+    init_worker('^(?P<UMI>[ATGCN]{4})(GGGG){s<=1}', '', find_umi_in_rc=False)
+    read1, read2 = (read_header, 'TTTTGGGGAAAA', read_quality[:12]), (read_header, read_seq, read_quality)
+    batch_result = process_batch([(read1, read2), (read2, read1)])
+    assert batch_result.reads_count == 2
+    assert batch_result.fq1_records == create_new_read(read_header, 'TTTTAAAA', 'KK?KKKKK').encode()
+    assert batch_result.fq2_records == create_new_read(*read2).encode()
+    assert batch_result.stats['discarded_pairs'] == 1
+
+
+def test_process_batch_with_header_barcodes(read_header, read_quality):
+    init_worker('^(?P<SBC>[ATGCN]{2})(GGGG){s<=1}(?P<UMI>[ATGCN]{4})', '', find_umi_in_rc=False)
+    read1, read2 = (read_header, 'ACGGGGTTTTAA', read_quality[:12]), (read_header, 'CCCC', 'KKKK')
+    batch_result = process_batch([(read1, read2)])
+    assert batch_result.fq1_records == create_new_read(f'{read_header} SBC:AC', 'TTTTAA', 'KAKKKK').encode()
+
+
+def test_process_batch_counts_kept_matches(read_header):
+    init_worker('^(?P<UMI>[ATGCN]{4})(GGGG){s<=1}', '', find_umi_in_rc=True)
+    matched_pair = ((read_header, 'TTTTGGGGAAAA', 'K' * 12), (read_header, 'AAAAGGGGTTTT', 'K' * 12))
+    fuzzy_pair = ((read_header, 'TTTTGCGGAAAA', 'K' * 12), (read_header, 'ACACACACACAC', 'K' * 12))
+    batch_result = process_batch([matched_pair, fuzzy_pair])  # the mate and reverse complements match too
+    assert {tier: batch_result.stats[tier] for tier in ('fixed', 'exact', 'fuzzy')} == \
+           {'fixed': 0, 'exact': 1, 'fuzzy': 1}
+    assert batch_result.error_counts == {'fq1': {0: 1, 1: 1}}
 
 
-def test_remove_subseq(read_seq):
-    assert remove_subseq(read_seq, 0, 8) == 'GGGGCCCC'
+def test_process_batch_counts_budget_exceeded_once_per_pair(read_header):
+    pattern = '(?:[ATGCN]+)+(?P<UMI>[ATGCN]{4})(TTTTTTTTTTTTTTTT){s<=4}'  # catastrophic backtracking
+    init_worker(pattern, pattern, find_umi_in_rc=True, match_timeout=0.01)
+    stuck_read = (read_header, 'A' * 28 + 'C' * 20, 'K' * 48)
+    matched_read = (read_header, 'ACGT' + 'T' * 16, 'K' * 20)
+    batch_result = process_batch([(stuck_read, stuck_read), (matched_read, matched_read)])
+    assert batch_result.stats['budget_exceeded'] == 1  # all placements of both patterns of the pair exceeded it
+    assert batch_result.stats['discarded_pairs'] == 1
@@ -0,0 +1,61 @@
+from pytest import fixture
+
+from extract import get_reverse_complement
+from matcher import BUDGET_EXCEEDED, TieredMatcher, create_matcher
+
+
+@fixture(scope='module')
+def pattern() -> str:
+    return "^(TGGTATC){s<=1}(?P<UMI>[ATGCN]{4})"
+
+
+def test_create_matcher_without_pattern():
+    assert create_matcher('') is None
+
+
+def test_tiered_matcher_counts_tiers(pattern):
+    matcher = TieredMatcher(pattern)
+    assert matcher.search('TGGTATCAAAAGG').captures('UMI') == ['AAAA']
+    assert matcher.search('TCCTATCCCCCGG') is None
+    assert matcher.pop_stats() == {}  # searches are not counted, only the kept matches
+    for sequence in ('TGGTATCAAAAGG', 'TGCTATCCCCCGG'):
+        matcher.count_match(matcher.search(sequence))
+    assert matcher.pop_stats() == {'exact': 1, 'fuzzy': 1}
+    assert matcher.pop_stats() == {}
+    assert matcher.pop_error_counts() == {0: 1, 1: 1}
+
+
+def test_tiered_matcher_without_fuzzy_costs():
+    matcher = TieredMatcher("^(?P<UMI>[ATGCN]{4})")
+    assert matcher.fuzzy_pattern is None
+    assert matcher.search('ACGTAAAA').captures('UMI') == ['ACGT']
+
+
+def test_tiered_matcher_search_window(pattern):
+    assert TieredMatcher(pattern).search_window == 11
+    assert TieredMatcher("(TGGTATC){s<=1}(?P<UMI>[ATGCN]{4})").search_window is None
+    matcher = TieredMatcher("(TGGTATC){s<=1}(?P<UMI>[ATGCN]{4})", search_window=11)
+    assert matcher.search('CTGGTATCAAAAGG') is None
+    assert matcher.search('TGGTATCAAAAGG').span() == (0, 11)
+
+
+def test_tiered_matcher_search_many_reverse_complement(pattern):
+    matcher = TieredMatcher(pattern)
+    sequences = ['CCNGATACCA', 'TTCCTTGATACCA', 'ATTCCTTGATACGA', 'TTYYTTGATACCA']
+    rc_matches = matcher.search_many_reverse_complement(sequences)
+    matches = matcher.search_many([get_reverse_complement(sequence[-matcher.search_window:])
+                                   for sequence in sequences])
+    assert [(match.span(), match.spans('UMI'), match.captures('UMI'), match.fuzzy_counts) if match else None
+            for match in rc_matches] == \
+           [(match.span(), match.spans('UMI'), match.captures('UMI'), match.fuzzy_counts) if match else None
+            for match in matches]
+    assert rc_matches[1].captures('UMI') == ['AAGG'] and rc_matches[3].captures('UMI') == ['AAAA']
+    assert rc_matches[0] is None
+
+
+def test_tiered_matcher_match_timeout():
+    pattern = "(?:[ATGCN]+)+(TTTTTTTTTTTTTTTT){s<=4}"  # catastrophic backtracking in the poly-A read
+    matcher = TieredMatcher(pattern, match_timeout=0.01)
+    matches = matcher.search_many(['A' * 28 + 'C' * 20, 'ACGTTTTTTTTTTTTTTTTT'])
+    assert matches[0] is BUDGET_EXCEEDED and not matches[0] and matches[1]
+    assert matcher.pop_stats() == {}  # read pairs exceeding the budget are counted by process_batch()
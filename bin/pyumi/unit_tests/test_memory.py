@@ -0,0 +1,27 @@
+from pytest import raises
+
+import memory
+from memory import MemoryBudget, parse_memory_size
+
+
+def test_parse_memory_size():
+    assert parse_memory_size('12G') == 12 * 1024 ** 3
+    assert parse_memory_size('512 MB') == 512 * 1024 ** 2
+    assert parse_memory_size('1000') == 1000
+    with raises(ValueError):
+        parse_memory_size('12 apples')
+
+
+def test_memory_budget_follows_read_length(monkeypatch):
+    monkeypatch.setattr(memory, 'get_rss', lambda: 0)
+    budget = MemoryBudget(max_memory=1024 ** 3, max_in_flight=2, workers_count=0)
+    assert budget.batch_size == memory.PROBE_BATCH_SIZE
+
+    short_read = ('r1', 'A' * 100, 'K' * 100)
+    budget.observe([(short_read, short_read)] * 10)
+    short_reads_batch_size = budget.batch_size
+
+    long_read = ('r1', 'A' * 10_000, 'K' * 10_000)
+    budget.observe([(long_read, long_read)] * 10)
+    assert budget.batch_size < short_reads_batch_size
+    assert 2 * budget.batch_size * memory.BATCH_MEMORY_COPIES * budget.bytes_per_read_pair <= 1024 ** 3
@@ -0,0 +1,29 @@
+from collections import Counter
+
+from matcher import PLACEMENTS
+from orientation import OrientationLearner, select_placements
+
+
+def test_select_placements():
+    assert select_placements(Counter({'fwd': 990, 'rc': 10})) == ('fwd', 'rc')
+    assert select_placements(Counter({'fwd': 999, 'mate_rc': 1})) == ('fwd',)
+    assert select_placements(Counter()) == PLACEMENTS
+
+
+def test_orientation_learner():
+    learner = OrientationLearner(['fq1'], profile_reads_count=200, recheck_interval=3)
+    # batches are submitted ahead of their results
+    assert learner.next_placements() is None
+    assert learner.next_placements() is None
+    learner.update({'fq1': Counter({'fwd': 100})}, reads_count=100)
+    assert not learner.is_learned
+    learner.update({'fq1': Counter({'fwd': 97, 'rc': 3})}, reads_count=100)
+    assert learner.is_learned
+    assert learner.next_placements() is None  # 3rd batch re-checks all placements
+    restricted_placements = learner.next_placements()
+    assert restricted_placements == {'fq1': ('fwd', 'rc')}
+    # the restricted batch comes first and is not re-checked, then the re-checking one
+    learner.update({'fq1': Counter({'mate_rc': 100})}, reads_count=100, placements=restricted_placements)
+    assert learner.placements == {'fq1': ('fwd', 'rc')}
+    learner.update({'fq1': Counter({'fwd': 50, 'mate_fwd': 50})}, reads_count=100)
+    assert learner.placements == {'fq1': ('fwd', 'rc', 'mate_fwd')}
@@ -3,7 +3,10 @@ from pytest import fixture
 
 from pattern import (add_nucleotide_cost, replace_barcode_type_to_regex_group,add_brackets_around_barcode,
                      validate_pattern, parse_umi_length, add_nucleotide_cost, NORMAL_NUCLEOTIDES, IUPAC_WILDCARDS,
-                     ValidationError, get_prepared_pattern_and_umi_len)
+                     ValidationError, get_prepared_pattern_and_umi_len, get_exact_pattern,
+                     get_fixed_position_umi_len, parse_prepared_pattern, get_max_span, get_search_window,
+                     PatternNode, get_barcode_lengths, format_pattern_nodes, get_complement_class,
+                     get_reverse_complement_pattern)
 
 
 @fixture(scope='module')
@@ -90,6 +93,9 @@ def test_validate_pattern_when_fail(pattern6):
 
 def test_add_brackets_around_barcode(pattern1):
     assert add_brackets_around_barcode(pattern1, barcode_type='UMI') == "^(UMI:N{12})"
+    assert add_brackets_around_barcode("^(UMI:N{12})", barcode_type='UMI') == "^(UMI:N{12})"
+    assert add_brackets_around_barcode("^UMI:N{6}SBC:N{4}", barcode_type='UMI') == "^(UMI:N{6})SBC:N{4}"
+    assert add_brackets_around_barcode("^CB:N{8}ACGT(UMI:N{10})", barcode_type='CB') == "^(CB:N{8})ACGT(UMI:N{10})"
 
 
 def test_replace_umi_barcode_to_regex_group(pattern2):
@@ -106,12 +112,84 @@ def test_without_add_nucleotide_cost(pattern8):
     assert add_nucleotide_cost(pattern=pattern8) == pattern8
 
 
+def test_get_exact_pattern(pattern8):
+    assert (get_exact_pattern("^[ATGCN]{0:2}(TGGTATCAACGCAGAGT){s<=4}(?P<UMI>[ATGCN]{14})")
+            == "^[ATGCN]{0:2}(TGGTATCAACGCAGAGT)(?P<UMI>[ATGCN]{14})")
+    assert get_exact_pattern(pattern8) == pattern8
+
+
+def test_get_fixed_position_umi_len(pattern7):
+    assert get_fixed_position_umi_len("^(?P<UMI>[ATGCN]{12})") == 12
+    assert get_fixed_position_umi_len("^(?P<UMI>[ATGCN]{6})(?P<UMI>[ATGCN]{6})") == 12
+    assert get_fixed_position_umi_len("(?P<UMI>[ATGCN]{12})") == 0
+    assert get_fixed_position_umi_len(pattern7) == 0
+
+
 def test_get_prepared_pattern_and_umi_len(pattern2, pattern12):
     assert (get_prepared_pattern_and_umi_len(pattern=pattern2)
             == ("^[ATGCN]{0:2}(TGGTATCAACGCAGAGT){s<=4}(?P<UMI>[ATGCN]{14})", 14))
     assert (get_prepared_pattern_and_umi_len(pattern=pattern12)
             == ("^(TGGTATCAACGCAGAGTAC){s<=4}(?P<UMI>[ATGCN]{19})(TCTTGGGGG){s<=2}", 19))
 
+    assert (get_prepared_pattern_and_umi_len(pattern="^TGGTATCAACGCAGAGTAC(SBC:N{4})(UMI:N{12})", max_error=1)
+            == ("^(TGGTATCAACGCAGAGTAC){s<=2}(?P<SBC>[ATGCN]{4})(?P<UMI>[ATGCN]{12})", 12))
+
+    assert (get_prepared_pattern_and_umi_len(pattern="^UMI:N{6}SBC:N{4}")
+            == ("^(?P<UMI>[ATGCN]{6})(?P<SBC>[ATGCN]{4})", 6))
+    assert (get_prepared_pattern_and_umi_len(pattern="^CB:N{8}ACGT(UMI:N{10})", max_error=3)
+            == ("^(?P<CB>[ATGCN]{8})(ACGT){s<=2}(?P<UMI>[ATGCN]{10})", 10))
+
     # TODO!
     # assert (BarcodePattern(pattern='^N{13}').get_prepared_pattern()
     #         == "^(?P<UMI>[ATGCN]{13})")
+
+
+def test_get_barcode_lengths(pattern2):
+    assert get_barcode_lengths(pattern2) == {'UMI': 14}
+    assert get_barcode_lengths("^(CB:N{8})TCACCAT(SBC:N{4})(UMI:N{12})") == {'UMI': 12, 'SBC': 4, 'CB': 8}
+    assert get_barcode_lengths("^UMI:N{6}SBC:N{4}") == {'UMI': 6, 'SBC': 4}
+    assert get_barcode_lengths('') == {}
+
+
+def test_parse_prepared_pattern():
+    assert parse_prepared_pattern("^(TG){s<=1}(?P<UMI>[ATGCN]{2,3})") == [
+        PatternNode('anchor', '^', [], 1, 1, ''),
+        PatternNode('group', None, [PatternNode('literal', 'T', [], 1, 1, ''),
+                                    PatternNode('literal', 'G', [], 1, 1, '')], 1, 1, 's<=1'),
+        PatternNode('group', 'UMI', [PatternNode('class', '[ATGCN]', [], 2, 3, '')], 1, 1, ''),
+    ]
+    assert parse_prepared_pattern("^(A|T)") is None
+
+
+def test_get_max_span(pattern7):
+    assert get_max_span(parse_prepared_pattern(pattern7)) == 37  # {0:2} is not a quantifier, but literal
+    assert get_max_span(parse_prepared_pattern("^(TGG){i<=1,s<=2}[ATGCN]{2,4}")) == 8
+    assert get_max_span(parse_prepared_pattern("^TG*")) is None
+
+
+def test_get_search_window(pattern13):
+    assert get_search_window("^(TGGTATCAACGCAGAGTAC){s<=4}(?P<UMI>[ATGCN]{19})(TCTTGGGGG){s<=2}") == 47
+    assert get_search_window(pattern13) is None
+    assert get_search_window("^(?P<UMI>[ATGCN]{12})$") is None
+
+
+def test_format_pattern_nodes(pattern13):
+    for pattern in ("^(TGGTATCAACGCAGAGTAC){s<=4}(?P<UMI>[ATGCN]{19})(TCTTGGGGG){s<=2}", pattern13,
+                    "^(TG){i<=1,s<=2}[ATGCN]{2,4}.*"):
+        assert format_pattern_nodes(parse_prepared_pattern(pattern)).replace('{0,}', '*') == pattern
+
+
+def test_get_complement_class():
+    assert get_complement_class('GT') == '[AC]'
+    assert get_complement_class('C') == 'G'
+    assert get_complement_class('A') == '[BDHKMNRSTVWY]'  # IUPAC wildcards are complemented into A
+    assert get_complement_class('N') is None
+
+
+def test_get_reverse_complement_pattern():
+    assert get_reverse_complement_pattern("^(TGG){s<=1}(?P<UMI>[ATGCN]{2})") == \
+           "(?P<UMI>[ABCDGHKMNRSTVWY]{2})(CCA){s<=1}$"
+    assert get_reverse_complement_pattern("(?P<SBC>[GC]{2})(TC)(?P<UMI>.{3})") == "(?P<UMI>.{3})(GA)(?P<SBC>[CG]{2})"
+    assert get_reverse_complement_pattern("^(TGG){i<=1}(?P<UMI>[ATGCN]{2})") is None  # insertions
+    assert get_reverse_complement_pattern("^(TGG)(?P<UMI>[ATGCN]{2,3})") is None  # variable length
+    assert get_reverse_complement_pattern("^(TGG)(?P<UMI>[^A]{2})") is None  # negated class
@@ -0,0 +1,42 @@
+from collections import deque
+
+from extract import init_worker, process_batch
+from performance import PerformanceStats, iter_timed
+
+
+def test_iter_timed():
+    times = deque()
+    assert list(iter_timed(iter('abc'), times)) == ['a', 'b', 'c']
+    assert len(times) == 3
+
+
+def test_performance_stats():
+    init_worker('^(?P<UMI>[ATGCN]{4})(GGGG){s<=1}', '', find_umi_in_rc=False)
+    batch_result = process_batch([(('r1', 'TTTTGGGGAA', 'KKKKKKKKKK'), ('r1', 'CC', 'KK')),
+                                  (('r2', 'AAAA', 'KKKK'), ('r2', 'CC', 'KK'))])
+    performance_stats = PerformanceStats()
+    performance_stats.start()
+    performance_stats.parse_times.extend([0.5, 0.25])
+    performance_stats.add_chunk(batch_result, write_time=0.125, compress_time=0.0)
+    performance_stats.add_chunk(batch_result, write_time=0.125, compress_time=0.0)
+    performance_stats.finish(compress_time=1.0)
+
+    metrics = performance_stats.get_metrics()
+    assert [chunk['parse_time'] for chunk in metrics['chunks']] == [0.5, 0.25]
+    assert metrics['chunks'][0]['placement_hits'] == {'fq1': {'fwd': 1}}
+    total = metrics['total']
+    assert (total['read_pairs'], total['discarded_pairs']) == (4, 2)
+    assert (total['parse_time'], total['write_time'], total['compress_time']) == (0.75, 0.25, 1.0)
+    assert total['match_tiers'] == {'fixed': 0, 'exact': 2, 'fuzzy': 0}
+    assert total['placement_hits'] == {'fq1': {'fwd': 2}}
+
+
+def test_performance_stats_of_batches_read_by_workers():
+    init_worker('^(?P<UMI>[ATGCN]{4})', '', find_umi_in_rc=False)
+    batch_result = process_batch([(('r1', 'TTTTGGGGAA', 'KKKKKKKKKK'), ('r1', 'CC', 'KK'))])
+    performance_stats = PerformanceStats()
+    performance_stats.start()
+    performance_stats.add_chunk(batch_result._replace(parse_time=0.5), write_time=0.125, compress_time=0.0)
+    performance_stats.add_chunk(batch_result._replace(parse_time=0.0), write_time=0.125, compress_time=0.0)
+    performance_stats.finish(compress_time=1.0)
+    assert [chunk['parse_time'] for chunk in performance_stats.get_metrics()['chunks']] == [0.5, 0.0]
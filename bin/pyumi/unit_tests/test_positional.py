@@ -0,0 +1,9 @@
+from positional import extract_fixed_umis
+
+
+def test_extract_fixed_umis():
+    reads = [('read1', 'ACNTGGGG', 'KKKKKKKK'), ('read2', 'ACG', 'KKK'), ('read3', 'AC.TGGGG', 'KKKKKKKK'),
+             ('read4', 'NNNNTTTT', 'KKKKKKKK')]
+    new_sequences, is_unmatched = extract_fixed_umis(reads, umi_length=4)
+    assert new_sequences == ['ACATGGGG', 'ACG', 'AC.TGGGG', 'AAAATTTT']
+    assert is_unmatched.tolist() == [False, True, True, False]
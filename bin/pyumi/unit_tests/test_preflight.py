@@ -0,0 +1,31 @@
+import gzip
+from multiprocessing.pool import ThreadPool
+
+from extract import init_worker
+from preflight import estimate_reads_count, run_preflight
+
+
+def create_fastq(path, reads: list[tuple[str, str]]) -> str:
+    with gzip.open(path, 'wt') as f:
+        for read_id, sequence in reads:
+            f.write(f"@{read_id}\n{sequence}\n+\n{'K' * len(sequence)}\n")
+    return str(path)
+
+
+def test_estimate_reads_count(tmp_path):
+    fastq_path = create_fastq(tmp_path / 'R1.fastq.gz', [(f'r{i}', 'ACGT') for i in range(10)])
+    assert estimate_reads_count(fastq_path, sampled_reads_count=20) == 10
+    assert estimate_reads_count(fastq_path, sampled_reads_count=10) == 10
+
+
+def test_run_preflight(tmp_path):
+    fq1_path = create_fastq(tmp_path / 'R1.fastq.gz', [('r1', 'TTTTGGGGAA'), ('r2', 'TTTTGCGGAA'), ('r3', 'AAAA'),
+                                                       ('r4', 'TTTTGGGGAA')])
+    fq2_path = create_fastq(tmp_path / 'R2.fastq.gz', [(f'r{i}', 'CCCC') for i in range(1, 5)])
+    with ThreadPool(1, initializer=init_worker,
+                    initargs=('^(?P<UMI>[ATGCN]{4})(GGGG){s<=1}', '', False)) as pool:
+        report = run_preflight([fq1_path], [fq2_path], read_pairs_count=3, pool=pool, workers_count=2)
+    assert report['read_pairs'] == 3
+    assert report['match_rate'] == round(2 / 3, 4)
+    assert report['error_counts'] == {'fq1': {'0': 1, '1': 1}}
+    assert report['match_tiers'] == {'fixed': 0, 'exact': 1, 'fuzzy': 1}
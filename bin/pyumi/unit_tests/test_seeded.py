@@ -0,0 +1,47 @@
+import regex
+from pytest import mark
+
+from extract import create_barcoded_read, get_reverse_complement
+from seeded import PatternSegment, create_seeded_matcher, get_pattern_segments
+
+PATTERN = "(TGGTATC){s<=1}(?P<UMI>[ATGCN]{4})(GGAC){s<=1}"
+
+
+def test_get_pattern_segments():
+    assert get_pattern_segments("^(TGGTATC){s<=1}(?P<UMI>[ATGCN]{4})") == \
+           (True, [PatternSegment('TGGTATC', 1, None, 0), PatternSegment('', 0, 'UMI', 4)])
+    assert get_pattern_segments("^(?P<UMI>[ATGCN]{4})") is None  # no adapter
+    assert get_pattern_segments("(TGGTATC){i<=1}(?P<UMI>[ATGCN]{4})") is None  # insertions
+    assert get_pattern_segments("(TGGTATC){s<=1}(?P<UMI>[ATGCN]{4,6})") is None  # variable length
+
+
+@mark.parametrize('sequence', ['AATGGTATCAAAAGGACTT',  # exact
+                               'AATGCTATCAAAAGGTCTT',  # substitutions in both adapters
+                               'TGGTTTCCCCCGGACATGGTATCAAAAGGAC',  # the exact match is better than the leftmost one
+                               'TGGTATCAAAAGG',  # too short
+                               'AATGGTATCAANAGGAC',  # N in UMI
+                               'AATGGTATCAARAGGAC'])  # letter, which is not allowed in UMI
+def test_seeded_matcher_is_the_same_as_regex(sequence):
+    regex_match = regex.compile(PATTERN, regex.BESTMATCH).search(sequence)
+    seeded_match = create_seeded_matcher(PATTERN).search(sequence)
+    read = ('read', sequence, 'K' * len(sequence))
+    assert (create_barcoded_read(read, seeded_match) if seeded_match else None) == \
+           (create_barcoded_read(read, regex_match) if regex_match else None)
+
+
+def test_seeded_matcher_search_many():
+    matches = create_seeded_matcher(PATTERN).search_many(['TGGTATCAAAAGGAC', 'CCCC', 'TTGGTTTCCCCCGGAC'])
+    assert [match.captures('UMI') if match else None for match in matches] == [['AAAA'], None, ['CCCC']]
+    assert matches[2].span() == (1, 16)
+
+
+@mark.parametrize('pattern', [PATTERN, "^(TGGTATC){s<=1}(?P<UMI>[ATGCN]{4})"])
+def test_reverse_complement_seeded_matcher(pattern):
+    sequences = ['AAGTCCTTTTGATACCATT', 'AAGTCCTTTTGATAGCATT', 'GTCCTTTTGATACCA', 'GTCCGGGGGAAACCAGTCRTTGGGATACCA',
+                 'CCAA', 'GTCCTTTTGATACCAGTCCGGGGGATACCA']
+    rc_matches = create_seeded_matcher(pattern, is_reverse_complement=True).search_many(sequences)
+    matches = create_seeded_matcher(pattern).search_many([get_reverse_complement(sequence) for sequence in sequences])
+    assert [(len(sequence) - match.span()[1], match.captures('UMI'), match.fuzzy_counts) if match else None
+            for sequence, match in zip(sequences, rc_matches)] == \
+           [(match.span()[0], [get_reverse_complement(umi) for umi in match.captures('UMI')], match.fuzzy_counts)
+            if match else None for match in matches]
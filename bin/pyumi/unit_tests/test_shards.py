@@ -0,0 +1,118 @@
+import gzip
+import struct
+import zlib
+from collections import deque
+
+from pytest import fixture
+
+import shards
+from shards import (ShardMatePairer, get_fastq_compression, get_uncompressed_size, is_shardable, iter_lane_shards,
+                    iter_shard_reads, iter_shards, read_shard_pairs)
+from stream import MultiLaneReader, PairedFastqReader
+from utils import create_worker_pool, iter_shard_results
+
+
+def create_records(read_ids: list[int], read_num: int) -> bytes:
+    return ''.join(f"@read{i} {read_num}:N:0:1\nACGT{i}\n+\nKKKK{i}\n" for i in read_ids).encode()
+
+
+def compress_bgzf_block(data: bytes) -> bytes:
+    """Compresses data into one BGZF block like bgzip does: a gzip member with the block size in the BC subfield."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = 26 + len(deflated)  # the gzip header with the BC subfield, the deflated data, CRC32 and ISIZE
+    header = b'\x1f\x8b\x08\x04' + struct.pack('<IBBH', 0, 0, 0xff, 6) + b'BC' + struct.pack('<HH', 2, block_size - 1)
+    return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def create_bgzf(path, data: bytes, block_size: int) -> str:
+    with open(path, 'wb') as f:
+        for block_start in range(0, len(data), block_size):
+            f.write(compress_bgzf_block(data[block_start:block_start + block_size]))
+        f.write(compress_bgzf_block(b''))  # the end of file marker
+    return str(path)
+
+
+def create_plain(path, data: bytes) -> str:
+    path.write_bytes(data)
+    return str(path)
+
+
+@fixture
+def fastqs(tmp_path) -> dict[str, str]:
+    data = create_records(list(range(10)), 1)
+    gzip_path = tmp_path / 'R1.fastq.gz'
+    gzip_path.write_bytes(gzip.compress(data))
+    return {'plain': create_plain(tmp_path / 'R1.fastq', data),
+            'bgzf': create_bgzf(tmp_path / 'R1.bgzf.fastq.gz', data, block_size=50),
+            'gzip': str(gzip_path)}
+
+
+def test_get_fastq_compression(fastqs):
+    assert {compression: get_fastq_compression(path) for compression, path in fastqs.items()} == \
+           {'plain': 'plain', 'bgzf': 'bgzf', 'gzip': 'gzip'}
+    assert [is_shardable(fastqs[compression]) for compression in ('plain', 'bgzf', 'gzip')] == [True, True, False]
+
+
+def test_get_uncompressed_size(fastqs):
+    assert {compression: get_uncompressed_size(fastqs[compression]) for compression in ('plain', 'bgzf')} == \
+           {'plain': 290, 'bgzf': 290}
+
+
+def test_shards_read_like_pyfastx(fastqs):
+    expected_reads = [read1 for read1, _ in PairedFastqReader(fastqs['gzip'], fastqs['gzip']).iter_pairs()]
+    for compression in ('plain', 'bgzf'):
+        for shards_count in (1, 2, 3, 7, 20, 200):
+            fastq_shards = list(iter_shards(fastqs[compression], shards_count))
+            assert len(fastq_shards) == shards_count
+            assert [read for shard in fastq_shards for read in iter_shard_reads(shard)] == expected_reads
+
+
+def test_shards_skip_quality_lines_like_headers(tmp_path):
+    data = ''.join(f"@read{i}\nACGT\n+\n@@@@\n" for i in range(20)).encode()
+    expected_reads = [(f'read{i}', 'ACGT', '@@@@') for i in range(20)]
+    for fastq_path in (create_plain(tmp_path / 'R1.fastq', data), create_bgzf(tmp_path / 'R1.fastq.gz', data, 30)):
+        for shards_count in range(1, 40):
+            assert [read for shard in iter_shards(fastq_path, shards_count) for read in iter_shard_reads(shard)] == \
+                   expected_reads
+
+
+def test_read_shard_pairs(tmp_path):
+    fq1_path = create_plain(tmp_path / 'R1.fastq', create_records([0, 1, 3, 2, 5], 1))
+    fq2_path = create_bgzf(tmp_path / 'R2.fastq.gz', create_records([0, 2, 3, 4], 2), block_size=40)
+    shard_pairs = list(shards.iter_paired_shards(fq1_path, fq2_path, shards_count=2))
+    read_pairs, pending_reads1, pending_reads2 = read_shard_pairs(*shard_pairs[0])
+    assert [read1[0] for read1, _ in read_pairs] == ['read0 1:N:0:1', 'read3 1:N:0:1']
+    assert list(pending_reads1) == ['read1'] and list(pending_reads2) == ['read2']
+    mate_pairer = ShardMatePairer()
+    assert mate_pairer.pair(pending_reads1, pending_reads2) == []
+    read_pairs, pending_reads1, pending_reads2 = read_shard_pairs(*shard_pairs[1])
+    assert read_pairs == []
+    assert [read1[0] for read1, _ in mate_pairer.pair(pending_reads1, pending_reads2)] == ['read2 1:N:0:1']
+    assert mate_pairer.unpaired_reads_count == 3  # read1, read5 and read4
+
+
+def test_iter_lane_shards(tmp_path):
+    reader = MultiLaneReader([create_plain(tmp_path / 'L1_R1.fastq', create_records([0, 1, 2], 1)),
+                              create_plain(tmp_path / 'L2_R1.fastq', create_records([3], 1))],
+                             [create_plain(tmp_path / 'L1_R2.fastq', create_records([0, 1, 2], 2)),
+                              create_plain(tmp_path / 'L2_R2.fastq', create_records([3], 2))])
+    lane_indices = deque()
+    shard_pairs = list(iter_lane_shards(reader, 2, lane_indices))
+    assert list(lane_indices) == [0, 1, 0]
+    assert [[read1[0] for read1, _ in read_shard_pairs(*shard_pair)[0]] for shard_pair in shard_pairs] == \
+           [['read0 1:N:0:1', 'read1 1:N:0:1'], ['read3 1:N:0:1'], ['read2 1:N:0:1']]
+
+
+def test_iter_shard_results_pairs_mates_of_different_shards(tmp_path):
+    fq2_data = ''.join(f"@read{i} 2:N:0:1\n{'A' * 10 * i}\n+\n{'K' * 10 * i}\n" for i in range(10)).encode()
+    reader = MultiLaneReader([create_plain(tmp_path / 'R1.fastq', create_records(list(range(11)), 1))],
+                             [create_plain(tmp_path / 'R2.fastq', fq2_data)])
+    lane_indices = deque()
+    shards_args = ((*shard_pair, None) for shard_pair in iter_lane_shards(reader, 3, lane_indices))
+    with create_worker_pool('^(?P<UMI>[ATGCN]{2})', '', find_umi_in_rc=False, workers_count=1) as pool:
+        batch_results = list(iter_shard_results(pool, shards_args, reader, lane_indices, batch_size=2))
+    assert sum(batch_result.reads_count for batch_result in batch_results) == 10
+    assert sum(batch_result.stats['cross_shard_pairs'] for batch_result in batch_results) > 0
+    assert reader.get_metrics()[0]['read_pairs'] == 10
+    assert reader.unpaired_reads_count == 1
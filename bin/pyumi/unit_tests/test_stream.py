@@ -0,0 +1,101 @@
+import gzip
+from multiprocessing.pool import ThreadPool
+
+from pytest import fixture, raises
+
+import stream
+from stream import (BackgroundWriter, CompressedFastqWriter, MultiLaneReader, PairedFastqReader, get_read_id,
+                    prefetch, starmap_bounded)
+
+
+def create_fastq(path, read_ids: list[int], read_num: int) -> str:
+    with gzip.open(path, 'wt') as f:
+        for i in read_ids:
+            f.write(f"@read{i} {read_num}:N:0:1\nACGT\n+\nKKKK\n")
+    return str(path)
+
+
+@fixture
+def fastq_pair(tmp_path) -> tuple[str, str]:
+    return (create_fastq(tmp_path / 'R1.fastq.gz', [0, 1, 2, 3, 4], 1),
+            create_fastq(tmp_path / 'R2.fastq.gz', [0, 1, 2, 3, 4], 2))
+
+
+def test_get_read_id():
+    assert get_read_id('read1 1:N:0:1') == 'read1'
+    assert get_read_id('read1/2') == 'read1'
+
+
+def test_paired_fastq_reader_batches(fastq_pair):
+    batches = list(PairedFastqReader(*fastq_pair).iter_batches(batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[0][0] == (('read0 1:N:0:1', 'ACGT', 'KKKK'), ('read0 2:N:0:1', 'ACGT', 'KKKK'))
+
+
+def test_paired_fastq_reader_drops_unpaired_reads(tmp_path):
+    reader = PairedFastqReader(create_fastq(tmp_path / 'R1.fastq.gz', [0, 1, 3, 2, 5], 1),
+                               create_fastq(tmp_path / 'R2.fastq.gz', [0, 2, 3, 4], 2))
+    assert [get_read_id(read1[0]) for read1, _ in reader.iter_pairs()] == ['read0', 'read3', 'read2']
+    assert reader.unpaired_reads_count == 3
+
+
+def test_multi_lane_reader(tmp_path, fastq_pair):
+    reader = MultiLaneReader([fastq_pair[0], create_fastq(tmp_path / 'L2_R1.fastq.gz', [5, 6, 7], 1)],
+                             [fastq_pair[1], create_fastq(tmp_path / 'L2_R2.fastq.gz', [5, 7], 2)])
+    batches = list(reader.iter_batches(batch_size=2))
+    assert [[get_read_id(read1[0]) for read1, _ in batch] for batch in batches] == \
+           [['read0', 'read1'], ['read5', 'read7'], ['read2', 'read3'], ['read4']]
+    assert reader.unpaired_reads_count == 1
+    assert [(lane['read_pairs'], lane['unpaired_reads']) for lane in reader.get_metrics()] == [(5, 0), (2, 1)]
+
+
+def test_starmap_bounded_keeps_order():
+    with ThreadPool(processes=3) as pool:
+        batches_args = [(i, 2) for i in range(10)]
+        assert list(starmap_bounded(pool, pow, batches_args, max_in_flight=2)) == [i ** 2 for i in range(10)]
+
+
+def test_prefetch_keeps_order(fastq_pair):
+    reader = PairedFastqReader(*fastq_pair)
+    assert list(prefetch(reader.iter_batches(batch_size=2), max_prefetched=1)) == list(reader.iter_batches(2))
+    assert list(prefetch(iter([]))) == []
+
+
+def test_prefetch_raises_errors():
+    def fail():
+        yield 1
+        raise ValueError('broken FASTQ')
+
+    with raises(ValueError):
+        list(prefetch(fail()))
+
+
+def test_prefetch_stops_with_consumer():
+    items = prefetch(iter(range(100)), max_prefetched=1)
+    assert next(items) == 0
+    items.close()  # does not hang on the full queue
+
+
+def test_background_writer_keeps_order():
+    written = []
+    with BackgroundWriter(max_pending=1) as writer:
+        for i in range(10):
+            writer.submit(written.append, i)
+    assert written == list(range(10))
+
+
+def test_compressed_fastq_writer_keeps_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(stream, 'COMPRESSION_BLOCK_SIZE', 10)
+    records = [f"@read{i}\nACGT\n+\nKKKK\n" for i in range(100)]
+    with CompressedFastqWriter(str(tmp_path / 'out.fastq.gz'), compression_threads=2) as writer:
+        for record in records:
+            writer.write(record.encode())
+    with gzip.open(tmp_path / 'out.fastq.gz', 'rt') as f:
+        assert f.read() == ''.join(records)
+
+
+def test_compressed_fastq_writer_without_records(tmp_path):
+    with CompressedFastqWriter(str(tmp_path / 'out.fastq.gz')):
+        pass
+    with gzip.open(tmp_path / 'out.fastq.gz', 'rt') as f:
+        assert f.read() == ''
@@ -0,0 +1,28 @@
+import gzip
+
+from extract import get_reverse_complement
+from synthetic import DESIGNS, SMART_ADAPTER, write_read_pairs
+
+
+def read_sequences(path) -> list[str]:
+    with gzip.open(path, 'rt') as f:
+        return f.read().splitlines()[1::4]
+
+
+def test_write_read_pairs_is_reproducible(tmp_path):
+    paths = [str(tmp_path / name) for name in ('a1.fq.gz', 'a2.fq.gz', 'b1.fq.gz', 'b2.fq.gz')]
+    write_read_pairs(paths[0], paths[1], DESIGNS['multi_umi'], 10, seed=7)
+    write_read_pairs(paths[2], paths[3], DESIGNS['multi_umi'], 10, seed=7)
+    assert read_sequences(paths[0]) == read_sequences(paths[2])
+    assert len(read_sequences(paths[1])) == 10
+
+
+def test_write_read_pairs_design(tmp_path):
+    fq1_path, fq2_path = str(tmp_path / 'R1.fq.gz'), str(tmp_path / 'R2.fq.gz')
+    write_read_pairs(fq1_path, fq2_path, DESIGNS['reverse_complement'], 50, error_rate=0.0, read_length=40)
+    sequences = read_sequences(fq1_path)
+    assert all(len(sequence) == 40 for sequence in sequences)
+    forward_sequences = [sequence for sequence in sequences if sequence.startswith(SMART_ADAPTER)]
+    assert 0 < len(forward_sequences) < 50
+    assert all(get_reverse_complement(sequence).startswith(SMART_ADAPTER)
+               for sequence in sequences if sequence not in forward_sequences)
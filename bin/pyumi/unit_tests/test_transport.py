@@ -0,0 +1,44 @@
+import errno
+import os
+
+import transport
+from transport import SharedBatch, SharedBatchRing, pack_read_pairs, read_shared_batch, unpack_read_pairs
+
+READ_PAIRS = [(('read0 1:N:0:1', 'ACGT', 'KKKK'), ('read0 2:N:0:1', 'TTGCA', 'FFFFF')),
+              (('read1 1:N:0:1', 'A', 'K'), ('read1 2:N:0:1', '', ''))]
+
+
+def test_pack_read_pairs():
+    assert unpack_read_pairs(pack_read_pairs(READ_PAIRS)) == READ_PAIRS
+    assert unpack_read_pairs(pack_read_pairs([])) == []
+
+
+def test_shared_batch_ring_reuses_buffers():
+    with SharedBatchRing(slots_count=2) as batch_ring:
+        batches = [batch_ring.pack(READ_PAIRS[:1]), batch_ring.pack(READ_PAIRS), batch_ring.pack(READ_PAIRS[:1])]
+        assert all(isinstance(batch, SharedBatch) for batch in batches)
+        assert batches[2].name == batches[0].name
+        assert read_shared_batch(batches[1]) == READ_PAIRS
+        assert read_shared_batch(batches[2]) == READ_PAIRS[:1]
+        assert read_shared_batch(batch_ring.pack(READ_PAIRS * 10)) == READ_PAIRS * 10  # the buffer is recreated
+        assert read_shared_batch(batch_ring.pack([])) == []
+    assert batch_ring.slots == [None, None]
+
+
+def test_shared_batch_ring_pickles_without_room(monkeypatch):
+    monkeypatch.setattr(transport, 'get_free_shared_memory', lambda: 0)
+    with SharedBatchRing(slots_count=2) as batch_ring:
+        batch = batch_ring.pack(READ_PAIRS)
+        assert batch is READ_PAIRS
+        assert read_shared_batch(batch) == READ_PAIRS
+        assert batch_ring.pickled_batches_count == 1
+
+
+def test_shared_batch_ring_pickles_without_pages(monkeypatch):
+    def fail_fallocate(fd, offset, length):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    monkeypatch.setattr(os, 'posix_fallocate', fail_fallocate)
+    with SharedBatchRing(slots_count=2) as batch_ring:
+        assert batch_ring.pack(READ_PAIRS) is READ_PAIRS
+        assert batch_ring.slots == [None, None]
@@ -0,0 +1,23 @@
+import numpy as np
+
+from umi_table import UmiTable, summarize_umis
+
+
+def test_summarize_umis():
+    unique_umis, read_umi_index = summarize_umis(['CCA', 'AAT', 'CCA'])
+    assert unique_umis.tolist() == [b'AAT', b'CCA']
+    assert read_umi_index.tolist() == [1, 0, 1]
+
+
+def test_umi_table(tmp_path):
+    umi_table = UmiTable(['fq1'])
+    umi_table.add_batch({'fq1': summarize_umis(['CCA', 'AAT', 'CCA'])})
+    umi_table.add_batch({'fq1': summarize_umis(['GGG', 'AAT'])})
+    umis, counts, read_umi_index = umi_table.get_arrays('fq1')
+    assert umis[read_umi_index].tolist() == [b'CCA', b'AAT', b'CCA', b'GGG', b'AAT']
+    assert dict(zip(umis.tolist(), counts.tolist())) == {b'CCA': 2, b'AAT': 2, b'GGG': 1}
+
+    umi_table.save(tmp_path / 'umi_table.npz')
+    with np.load(tmp_path / 'umi_table.npz') as saved_table:
+        assert saved_table['fq1_umis'].tolist() == umis.tolist()
+        assert saved_table['fq1_read_umi_index'].tolist() == read_umi_index.tolist()
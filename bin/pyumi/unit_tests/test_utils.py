@@ -0,0 +1,10 @@
+from pytest import raises
+
+from pattern import get_prepared_pattern_and_umi_len
+from utils import create_worker_pool
+
+
+def test_create_worker_pool_exits_on_invalid_pattern():
+    invalid_pattern, _ = get_prepared_pattern_and_umi_len('^(UMI:N{12}')
+    with raises(SystemExit):
+        create_worker_pool(invalid_pattern, '', find_umi_in_rc=False, workers_count=1)
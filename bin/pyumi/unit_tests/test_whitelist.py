@@ -0,0 +1,51 @@
+from pytest import raises
+
+from extract import correct_umis, create_new_read, init_worker, process_batch
+from whitelist import UmiCorrector, build_neighbourhood_index, check_whitelist_umi_lengths, get_neighbours
+
+
+def test_get_neighbours():
+    assert len(get_neighbours('ACGT', 1)) == 3 * 4
+    assert len(set(get_neighbours('ACGT', 2))) == 9 * 6
+    assert 'ACGT' not in get_neighbours('ACGT', 1)
+
+
+def test_build_neighbourhood_index():
+    index = build_neighbourhood_index(['AAAA', 'AATT'], max_distance=1)
+    assert index['AAAA'] == 'AAAA'
+    assert index['CAAA'] == 'AAAA'
+    assert index['AATA'] == ''  # at distance 1 from both
+    assert 'CCCC' not in index
+
+    index = build_neighbourhood_index(['AAAA', 'AACC'], max_distance=2)
+    assert index['AAAC'] == ''
+    assert index['AAAG'] == 'AAAA'  # closer to AAAA, than to AACC
+
+
+def test_umi_corrector():
+    umi_corrector = UmiCorrector(['AAAA', 'CCCC'])
+    assert [umi_corrector.correct(umi) for umi in ('AAAA', 'AAAT', 'GGGG')] == ['AAAA', 'AAAA', 'GGGG']
+    assert umi_corrector.pop_stats() == {'whitelisted_umis': 1, 'corrected_umis': 1, 'unknown_umis': 1}
+    assert umi_corrector.pop_stats() == {}
+
+
+def test_correct_umis():
+    new_reads = [create_new_read('r1', 'AAATGG', 'KKKKKK'), create_new_read('r2', 'CG', 'KK')]
+    umis = ['AAAT', '']
+    correct_umis(new_reads, umis, UmiCorrector(['AAAA']), [0, 1])
+    assert new_reads == [create_new_read('r1', 'AAAAGG', 'KKKKKK'), create_new_read('r2', 'CG', 'KK')]
+    assert umis == ['AAAA', '']
+
+
+def test_process_batch_corrects_umis():
+    init_worker('^(?P<UMI>[ATGCN]{4})', '', find_umi_in_rc=False, umi_corrector=UmiCorrector(['TTTT']))
+    read_pairs = [(('r1', 'TTTAGG', 'KKKKKK'), ('r1', 'CC', 'KK'))]
+    batch_result = process_batch(read_pairs)
+    assert batch_result.fq1_records == create_new_read('r1', 'TTTTGG', 'KKKKKK').encode()
+    assert batch_result.stats['corrected_umis'] == 1
+
+
+def test_check_whitelist_umi_lengths():
+    check_whitelist_umi_lengths(['ACGT', 'ACG'], [4])
+    with raises(SystemExit):
+        check_whitelist_umi_lengths(['ACGT', 'TTGC'], [4, 6])
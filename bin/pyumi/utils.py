@@ -1,20 +1,31 @@
 import json
+import multiprocessing
 import os
 import sys
-from typing import Optional, Union
+import time
+from collections import Counter, deque
+from contextlib import nullcontext
+from multiprocessing.pool import Pool
+from typing import Iterable, Iterator, Optional
 
-import shutil
-import subprocess
-import tempfile
+import regex
 
-from extract import get_processed_fastqs
+from demultiplex import SampleWriters
+from extract import BatchResult, init_worker, process_shard, process_shared_batch
 from logger import set_logger
+from matcher import create_matcher
+from memory import MemoryBudget
+from orientation import OrientationLearner
+from performance import PerformanceStats, iter_timed
+from shards import ShardMatePairer, get_reads_per_shard, is_shardable, iter_lane_shards
+from stream import (BackgroundWriter, CompressedFastqWriter, MultiLaneReader, prefetch, starmap_bounded,
+                    DEFAULT_COMPRESSION_LEVEL, DEFAULT_COMPRESSION_THREADS, MAX_BATCHES_IN_FLIGHT, WORKERS_COUNT)
+from transport import SharedBatchRing, start_resource_tracker
+from umi_table import UmiTable
+from whitelist import UmiCorrector
 
 logger = set_logger(name=__file__)
 
-TEMPDIR_NAME = tempfile.gettempdir()
-FASTQ_CHUNK_SIZE = 2_000_000  # reads count in one fastq chunk
-
 
 def save_metrics(*metrics: dict, output_json: str):
     """Saves metrics into JSON file"""
@@ -38,70 +49,6 @@ def exit_with_error(message: Optional[str]):
     sys.exit(1)
 
 
-def run_command(command: list[str], stdin=None, stdout=False) -> Union[str, None]:
-    logger.info(f'Running {command}...')
-
-    try:
-        command_process = subprocess.run(command, text=True, capture_output=True, stdin=stdin, check=True)
-    except subprocess.CalledProcessError as e:
-        logger.critical(e.stderr)
-        logger.critical(e.stdout)
-        exit_with_error(f"Failed to run {command}")
-    except Exception as e:
-        exit_with_error(f"Undefined error: {e}")
-
-    if stdout:
-        return command_process.stdout
-
-
-def concat_files(files: list[str]) -> str:
-    print(files)
-    output_file = tempfile.NamedTemporaryFile().name
-    with open(output_file, 'w') as out_f:
-        for file in files:
-            with open(file, 'r') as f:
-                out_f.write(f.read())
-    remove(*files)
-    return output_file
-
-
-def remove(*file: str):
-    for f in file:
-        os.remove(f)
-
-
-def save_to_file(data: str, file_path=None) -> str:
-    file_path = file_path or tempfile.NamedTemporaryFile().name
-    with open(file_path, 'w') as f:
-        f.write(data)
-    return file_path
-
-
-def compress(file: str):
-    logger.info(f'Compressing {file} into {file}.gz...')
-
-    pigz_cmd = ['pigz', file]
-    run_command(pigz_cmd)
-
-    file_gz = file + '.gz'
-    check_if_exist(file_gz)
-
-    logger.info(f'{file} has been compressed.')
-
-    return file_gz
-
-
-def replace_file(src_file: str, dst_file: str):
-    """
-    Replaces file from source to the destination
-
-    :param src_file: path to the file, that we need to move
-    :param dst_file: path to destination file
-    """
-    shutil.move(src_file, dst_file)
-    logger.info(f'{src_file} replaced to {dst_file}')
-
-
 def check_if_exist(file: str):
     """
     Checks if file exists
@@ -117,77 +64,182 @@ def check_if_exist(file: str):
     logger.info(f"Expected file {file} found.")
 
 
-def save_results(read1_file: str, read2_file: str,
-                 read1_out_file: str, read2_out_file: str):
-    for file, out_file in [(read1_file, read1_out_file),
-                           (read2_file, read2_out_file)]:
-        check_if_exist(file)
-        file_gz = compress(file)
-        replace_file(file_gz, out_file)
-
-
-def extract_umi(fq12_chunks: list[str], read1_pattern: str,
-                read2_pattern: str, find_umi_in_rc: bool) -> tuple[str, str, int]:
-    total_reads_count, initial_reads_count = 0, 0
-    processed_fq1_chunks, processed_fq2_chunks = [], []
-
-    logger.info(f'Extracting UMI...')
-    for fq1_chunk, fq2_chunk in fq12_chunks:
-        (processed_fq1_chunk_path, processed_fq2_chunk_path,
-         reads_num_before, reads_num_after) = get_processed_fastqs(fq1_chunk, fq2_chunk, read1_pattern,
-                                                                   read2_pattern, find_umi_in_rc)
-        processed_fq1_chunks.append(processed_fq1_chunk_path)
-        processed_fq2_chunks.append(processed_fq2_chunk_path)
-
-        initial_reads_count += reads_num_before
-        total_reads_count += reads_num_after
-
-        remove(fq1_chunk, fq2_chunk)
-
-    processed_fq1 = concat_files(processed_fq1_chunks)
-    processed_fq2 = concat_files(processed_fq2_chunks)
-
-    logger.info(f'UMI successfully extracted. R1 FASTQ: {processed_fq1}, R2 FASTQ: {processed_fq2}')
-
-    return processed_fq1, processed_fq2, total_reads_count
-
-
-def split_by_chunks(fq1_path: str, fq2_path: str) -> list[str]:
-    logger.info(f'Splitting {fq1_path} and {fq2_path} into chunks by {FASTQ_CHUNK_SIZE} reads...')
-
-    fq1_outdir = os.path.join(TEMPDIR_NAME, 'chunks', 'fq1')
-    fq2_outdir = os.path.join(TEMPDIR_NAME, 'chunks', 'fq2')
-
-    for fq_path, output_dir in [(fq1_path, fq1_outdir), (fq2_path, fq2_outdir)]:
-        cmd = ['seqkit', 'split2', fq_path, '--by-size', str(FASTQ_CHUNK_SIZE),
-               '--by-size-prefix', '', '--out-dir', output_dir]
-        run_command(cmd)
-
-    fq1_chunks = sorted([entry.path for entry in os.scandir(fq1_outdir)])
-    fq2_chunks = sorted([entry.path for entry in os.scandir(fq2_outdir)])
-
-    logger.info(f'Splitting {fq1_path} and {fq2_path} has been done.')
-
-    return zip(fq1_chunks, fq2_chunks)
-
-
-def keep_only_paired_reads(fq1: str, fq2: str, clear=False):
-    logger.info('Filter out unpaired reads...')
-
-    outdir = os.path.join(TEMPDIR_NAME, 'paired')
-    cmd = ['seqkit', 'pair', '-1', fq1, '-2', fq2, '--out-dir', outdir, '--force']
-
-    run_command(cmd)
-
-    new_fq1 = os.path.join(outdir, os.path.basename(fq1))
-    new_fq2 = os.path.join(outdir, os.path.basename(fq2))
-
-    if clear:
-        remove(fq1, fq2)
-
-    logger.info('Filtering unpaired reads has been done.')
-
-    return new_fq1, new_fq2
+def create_worker_pool(read1_pattern: str, read2_pattern: str, find_umi_in_rc: bool,
+                       search_window: Optional[int] = None, collect_umis=False,
+                       barcode_to_sample: Optional[dict[str, str]] = None,
+                       umi_corrector: Optional[UmiCorrector] = None, match_timeout: Optional[float] = None,
+                       workers_count=WORKERS_COUNT) -> Pool:
+    """
+    Starts the worker processes once for the whole run: every worker compiles the patterns by init_worker()
+    and takes batches from the task queue of the pool, until the pool is closed.
+    Workers are forked before any read is loaded, so they do not inherit the read batches of the parent.
+    Patterns are compiled by the parent first: a pattern failing to compile in the initializer would make the pool
+    restart the workers forever.
+    """
+    for pattern in (read1_pattern, read2_pattern):
+        try:
+            create_matcher(pattern, search_window, match_timeout)
+        except regex.error as e:
+            exit_with_error(f'Invalid pattern {pattern}: {e}, exiting...')
+    start_resource_tracker()
+    return multiprocessing.Pool(processes=workers_count, initializer=init_worker,
+                                initargs=(read1_pattern, read2_pattern, find_umi_in_rc, search_window, collect_umis,
+                                          barcode_to_sample, umi_corrector, match_timeout))
+
+
+def get_compress_time(fq1_writer: CompressedFastqWriter, fq2_writer: CompressedFastqWriter,
+                      sample_writers: Optional[SampleWriters] = None) -> float:
+    return fq1_writer.compress_time + fq2_writer.compress_time + (sample_writers.compress_time if sample_writers else 0)
+
+
+def write_batch_result(batch_result: BatchResult, fq1_writer: CompressedFastqWriter,
+                       fq2_writer: CompressedFastqWriter, sample_writers: Optional[SampleWriters] = None,
+                       umi_table: Optional[UmiTable] = None, performance_stats: Optional[PerformanceStats] = None):
+    start_time = time.perf_counter()
+    compress_time = get_compress_time(fq1_writer, fq2_writer, sample_writers)
+    fq1_writer.write(batch_result.fq1_records)
+    fq2_writer.write(batch_result.fq2_records)
+    if sample_writers:
+        sample_writers.write(batch_result.samples)
+    if umi_table:
+        umi_table.add_batch(batch_result.umis)
+    if performance_stats:
+        performance_stats.add_chunk(batch_result, time.perf_counter() - start_time,
+                                    get_compress_time(fq1_writer, fq2_writer, sample_writers) - compress_time)
+
+
+def process_cross_shard_pairs(pool: Pool, read_pairs: list[tuple],
+                              orientation_learner: Optional[OrientationLearner] = None) -> BatchResult:
+    """Processes the pairs of mates read by different shards, counted in the stats as cross_shard_pairs."""
+    batch_result = pool.apply(process_shared_batch,
+                              (read_pairs, orientation_learner.next_placements() if orientation_learner else None))
+    batch_result.stats['cross_shard_pairs'] = len(read_pairs)
+    return batch_result._replace(parse_time=0.0)
+
+
+def iter_shard_results(pool: Pool, shards_args: Iterable[tuple], reader: MultiLaneReader, lane_indices: deque,
+                       batch_size: int, orientation_learner: Optional[OrientationLearner] = None) -> \
+        Iterator[BatchResult]:
+    """
+    Yields the results of the shards processed by the workers (see process_shard()) and of the pairs of mates
+    read by different shards of a lane, which are paired by the main process and processed in batches of batch_size.
+    The read pairs and the reads left without a mate are added to the lanes of the reader.
+    """
+    mate_pairers = [ShardMatePairer() for _ in reader.readers]
+    cross_shard_pairs = [[] for _ in reader.readers]
+    for shard_result in starmap_bounded(pool, process_shard, shards_args, MAX_BATCHES_IN_FLIGHT):
+        lane_index = lane_indices.popleft()
+        reader.add_lane_reads(lane_index, shard_result.batch_result.reads_count)
+        yield shard_result.batch_result
+        read_pairs = cross_shard_pairs[lane_index]
+        read_pairs += mate_pairers[lane_index].pair(shard_result.pending_reads1, shard_result.pending_reads2)
+        if len(read_pairs) >= batch_size:
+            reader.add_lane_reads(lane_index, len(read_pairs))
+            yield process_cross_shard_pairs(pool, read_pairs, orientation_learner)
+            cross_shard_pairs[lane_index] = []
+    for lane_index, (mate_pairer, read_pairs) in enumerate(zip(mate_pairers, cross_shard_pairs)):
+        reader.add_lane_reads(lane_index, len(read_pairs), mate_pairer.unpaired_reads_count)
+        if read_pairs:
+            yield process_cross_shard_pairs(pool, read_pairs, orientation_learner)
+
+
+def extract_umi(reader: MultiLaneReader, out_fq1_path: str, out_fq2_path: str,
+                read1_pattern: str, read2_pattern: str, find_umi_in_rc: bool,
+                compression_level=DEFAULT_COMPRESSION_LEVEL, compression_threads=DEFAULT_COMPRESSION_THREADS,
+                orientation_learner: Optional[OrientationLearner] = None,
+                search_window: Optional[int] = None, umi_table: Optional[UmiTable] = None,
+                memory_budget: Optional[MemoryBudget] = None,
+                sample_writers: Optional[SampleWriters] = None,
+                umi_corrector: Optional[UmiCorrector] = None,
+                performance_stats: Optional[PerformanceStats] = None,
+                match_timeout: Optional[float] = None,
+                pool: Optional[Pool] = None,
+                parallel_reading=False) -> Counter:
+    """
+    Streams read pairs of the input FASTQs (of all lanes of the reader) through the worker pool
+    directly into the compressed output FASTQs, keeping only paired reads.
+    If pool is given, it has to be created by create_worker_pool() with the same arguments, otherwise
+    the pool is created for this call.
+    The next batches are parsed by the reader thread and the previous results are written by the writer thread,
+    while the pool processes the current ones.
+    If orientation_learner is given, patterns are searched only in the learned placements.
+    If umi_table is given, UMIs of the output reads are added into it.
+    If memory_budget is given, it sizes the batches from the observed memory per read pair.
+    If sample_writers are given, pairs with a known sample barcode are written into the outputs of their sample,
+    only undetermined pairs are written into the output FASTQs.
+    If umi_corrector is given, UMIs are snapped to the whitelisted ones by the workers.
+    If performance_stats are given, the time of every stage and the match counters of every batch are added into it.
+    If match_timeout is given, the fuzzy search of a pattern in a read is limited to this number of seconds.
+    Parsed batches are passed to the workers in shared memory buffers (see transport.py).
+    If parallel_reading is set, the reader thread only splits uncompressed or BGZF FASTQs into shards
+    and every worker parses its shards itself, mates read by different shards are paired by the main process,
+    other inputs are parsed by the reader thread.
+    Returns counters of processed reads and barcode matches.
+    """
+    fastq_paths = [path for lane in reader.readers for path in (lane.fq1_path, lane.fq2_path)]
+    if parallel_reading and not all(map(is_shardable, fastq_paths)):
+        logger.warning('Gzipped FASTQs can not be split for parallel reading (only uncompressed or BGZF ones), '
+                       'reading them by the main process')
+        parallel_reading = False
+    lane_indices = deque()  # lanes of the shards submitted to the pool, in the order of their results
+    reads_per_shard = get_reads_per_shard(reader, memory_budget) if parallel_reading else None
+    if parallel_reading:
+        tasks = iter_lane_shards(reader, reads_per_shard, lane_indices)
+    else:
+        tasks = reader.iter_batches(memory_budget=memory_budget)
+    if performance_stats:
+        performance_stats.start()
+        if not parallel_reading:  # the workers time reading of their shards themselves
+            tasks = iter_timed(tasks, performance_stats.parse_times)
+    tasks = prefetch(tasks)
+    batch_ring = SharedBatchRing(MAX_BATCHES_IN_FLIGHT)
+    if not parallel_reading:
+        tasks = ((batch_ring.pack(read_pairs),) for read_pairs in tasks)  # packed as starmap_bounded takes them
+    batches_args = ((*task, orientation_learner.next_placements() if orientation_learner else None) for task in tasks)
+    stats = Counter()
+
+    logger.info('Extracting UMI...')
+    pool_context = nullcontext(pool) if pool else create_worker_pool(
+        read1_pattern, read2_pattern, find_umi_in_rc, search_window, umi_table is not None,
+        sample_writers.barcode_to_sample if sample_writers else None, umi_corrector, match_timeout)
+    with (pool_context as pool,
+          CompressedFastqWriter(out_fq1_path, compression_level, compression_threads) as fq1_writer,
+          CompressedFastqWriter(out_fq2_path, compression_level, compression_threads) as fq2_writer,
+          sample_writers or nullcontext(),
+          batch_ring,
+          BackgroundWriter() as writer):
+        if parallel_reading:
+            batch_results = iter_shard_results(pool, batches_args, reader, lane_indices, reads_per_shard,
+                                               orientation_learner)
+        else:
+            batch_results = starmap_bounded(pool, process_shared_batch, batches_args, MAX_BATCHES_IN_FLIGHT)
+        for batch_result in batch_results:
+            writer.submit(write_batch_result, batch_result, fq1_writer, fq2_writer, sample_writers, umi_table,
+                          performance_stats)
+            stats['total_reads'] += batch_result.reads_count
+            stats.update(batch_result.stats)
+            if orientation_learner:
+                orientation_learner.update(batch_result.placement_hits, batch_result.reads_count,
+                                           batch_result.placements)
+    stats['unpaired_reads'] = reader.unpaired_reads_count
+    if performance_stats:
+        performance_stats.finish(get_compress_time(fq1_writer, fq2_writer, sample_writers))
+
+    logger.info(f"Read pairs processed: {stats['total_reads']}, reads without a mate in the input: "
+                f"{stats['unpaired_reads']}, pairs discarded without barcode: {stats['discarded_pairs']}")
+    logger.info(f"Matches resolved by positional cut: {stats['fixed']}, by exact search: {stats['exact']}, "
+                f"by fuzzy search: {stats['fuzzy']}")
+    if stats['cross_shard_pairs']:
+        logger.warning(f"Mates of {stats['cross_shard_pairs']} read pairs were read by different shards "
+                       f"and paired by the main process")
+    if stats['budget_exceeded']:
+        logger.warning(f"Read pairs left without a match after exceeding the match budget: {stats['budget_exceeded']}")
+
+    for out_path in (out_fq1_path, out_fq2_path):
+        check_if_exist(out_path)
+    logger.info(f'UMI successfully extracted. R1 FASTQ: {out_fq1_path}, R2 FASTQ: {out_fq2_path}')
+
+    return stats
 
 
 def check_error_tolerance_size(umi_len: int, error_tolerance: int):
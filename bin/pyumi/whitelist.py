@@ -0,0 +1,107 @@
+import gzip
+import sys
+from collections import Counter
+from itertools import combinations, product
+
+from logger import set_logger
+from pattern import NORMAL_NUCLEOTIDES
+
+logger = set_logger(name=__file__)
+
+MAX_WHITELIST_DISTANCE = 2
+
+
+def load_umi_whitelist(whitelist_path: str) -> list[str]:
+    """Loads UMI sequences, one per line (the first column of tab-separated lines), from a plain or gzipped file."""
+    open_file = gzip.open if whitelist_path.endswith('.gz') else open
+    whitelist = []
+    with open_file(whitelist_path, 'rt') as f:
+        for line_number, line in enumerate(f, start=1):
+            umi = line.split('\t', 1)[0].strip().upper()
+            if not umi:
+                continue
+            if not set(umi) <= set(NORMAL_NUCLEOTIDES):
+                logger.critical(f'Invalid UMI {umi} in line {line_number} of {whitelist_path}, exiting...')
+                sys.exit(1)
+            whitelist.append(umi)
+    if not whitelist:
+        logger.critical(f'No UMIs found in {whitelist_path}, exiting...')
+        sys.exit(1)
+    return whitelist
+
+
+def check_whitelist_umi_lengths(whitelist: list[str], umi_lengths: list[int]):
+    """
+    Exits if the whitelist has no UMIs of the UMI length of a pattern: no UMI of the pattern could be corrected,
+    warns about whitelisted UMIs of other lengths, which are never matched.
+    """
+    whitelist_lengths = Counter(map(len, whitelist))
+    for umi_length in umi_lengths:
+        if umi_length not in whitelist_lengths:
+            logger.critical(f'UMI whitelist has no UMIs of the UMI length of the pattern ({umi_length}), '
+                            f'its UMI lengths are {sorted(whitelist_lengths)}, exiting...')
+            sys.exit(1)
+    other_lengths_count = sum(count for length, count in whitelist_lengths.items() if length not in umi_lengths)
+    if other_lengths_count:
+        logger.warning(f'{other_lengths_count} whitelisted UMIs differ in length from the UMIs of the patterns '
+                       f'{umi_lengths}, they are never matched')
+
+
+def get_neighbours(umi: str, distance: int) -> list[str]:
+    """Returns all sequences with exactly distance substitutions from the UMI.
+    N is not substituted: it is replaced with A in the extracted UMIs.
+    """
+    neighbours = []
+    for positions in combinations(range(len(umi)), distance):
+        substitutions = [NORMAL_NUCLEOTIDES.replace(umi[position], '') for position in positions]
+        for letters in product(*substitutions):
+            neighbour = list(umi)
+            for position, letter in zip(positions, letters):
+                neighbour[position] = letter
+            neighbours.append(''.join(neighbour))
+    return neighbours
+
+
+def build_neighbourhood_index(whitelist: list[str], max_distance=1) -> dict[str, str]:
+    """
+    Maps every whitelisted UMI and every sequence within max_distance substitutions from it to the UMI.
+    Sequences at the same smallest distance from several whitelisted UMIs are ambiguous and mapped to ''.
+    """
+    index = {umi: umi for umi in whitelist}
+    for distance in range(1, max_distance + 1):
+        index_at_distance = {}
+        for umi in whitelist:
+            for neighbour in get_neighbours(umi, distance):
+                if neighbour in index:  # closer to another whitelisted UMI
+                    continue
+                index_at_distance[neighbour] = umi if index_at_distance.get(neighbour, umi) == umi else ''
+        index.update(index_at_distance)
+    return index
+
+
+class UmiCorrector:
+    """
+    Snaps UMIs to the whitelisted ones by the precomputed neighbourhood index, UMIs without a single
+    closest whitelisted UMI within max_distance are kept as they are.
+    Counts whitelisted, corrected and unknown UMIs.
+    """
+
+    def __init__(self, whitelist: list[str], max_distance=1):
+        self.max_distance = max_distance
+        self.index = build_neighbourhood_index(whitelist, max_distance)
+        self.stats = Counter()
+        logger.info(f'UMI whitelist of {len(whitelist)} UMIs is indexed with {len(self.index)} sequences '
+                    f'within {max_distance} substitutions')
+
+    def correct(self, umi: str) -> str:
+        whitelisted_umi = self.index.get(umi)
+        if not whitelisted_umi:
+            self.stats['unknown_umis'] += 1
+            return umi
+        self.stats['whitelisted_umis' if whitelisted_umi == umi else 'corrected_umis'] += 1
+        return whitelisted_umi
+
+    def pop_stats(self) -> Counter:
+        """Returns the counters accumulated since the last call and resets them."""
+        stats, self.stats = self.stats, Counter()
+        return stats
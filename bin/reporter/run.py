@@ -4,7 +4,7 @@ import pandas as pd
 from logger import set_logger
 
 
-from utils import get_read_to_umi_mapping, get_consensus_group_size_per_read
+from utils import get_read_to_umi_mapping, get_read_to_umi_mapping_from_umi_table, get_consensus_group_size_per_read
 from viz import create_report
 
 logger = set_logger(name=__file__)
@@ -19,6 +19,9 @@ def parse_args() -> argparse.Namespace:
                         required=True)
     parser.add_argument('--in-fq2-calib', help='Input fastq.gz file after calib step, PE pair 2')
 
+    parser.add_argument('--in-umi-table', help='Input UMI table after pyumi step, used instead of re-parsing '
+                                               'the pyumi FASTQ')
+
     parser.add_argument('--umi-reverse', action='store_true')
 
     parser.add_argument('--report-file')
@@ -33,8 +36,13 @@ def main() -> None:
     pyumi_data_path = args.in_fq1_pyumi if not args.umi_reverse else args.in_fq2_pyumi
     calib_data_path = args.in_fq1_calib if not args.umi_reverse else args.in_fq2_calib
 
-    logger.info(f"Started reading initial data from {pyumi_data_path}")
-    umi_to_count_mapping_pre, id_to_umi, sequences = get_read_to_umi_mapping(pyumi_data_path)
+    if args.in_umi_table:
+        logger.info(f"Started reading initial data from {args.in_umi_table}")
+        umi_to_count_mapping_pre, id_to_umi, sequences = get_read_to_umi_mapping_from_umi_table(
+            args.in_umi_table, fastq='fq2' if args.umi_reverse else 'fq1')
+    else:
+        logger.info(f"Started reading initial data from {pyumi_data_path}")
+        umi_to_count_mapping_pre, id_to_umi, sequences = get_read_to_umi_mapping(pyumi_data_path)
 
     logger.info(f"Started reading calib data from {calib_data_path}")
     umi_to_count_mapping_post = get_consensus_group_size_per_read(calib_data_path, id_to_umi)
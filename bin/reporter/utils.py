@@ -1,6 +1,12 @@
 import gzip
 from collections import defaultdict, Counter
 
+import numpy as np
+
+from logger import set_logger
+
+logger = set_logger(name=__file__)
+
 
 def get_consensus_group_size_per_read(fastq_file: str, id_to_umi: dict[int, str]) -> dict[str, int]:
     """Reads a FASTQ file chunk and returns a list of reads."""
@@ -44,4 +50,24 @@ def get_read_to_umi_mapping(fastq_file: str, umi_len: int = 12) -> dict[str, int
             id_to_umi[read_id] = umi
             read_id += 1
 
-    return umi_to_count, id_to_umi, sequences
\ No newline at end of file
+    return umi_to_count, id_to_umi, sequences
+
+
+def get_read_to_umi_mapping_from_umi_table(umi_table_file: str,
+                                           fastq: str = 'fq1') -> tuple[dict, np.ndarray, np.ndarray]:
+    """Loads the UMI table written by pyumi (--out-umi-table) instead of re-parsing the pyumi FASTQ.
+    Returns the same UMI counts and read id to UMI mapping as get_read_to_umi_mapping(),
+    and UMI of every read in place of the read sequences.
+    The table has UMIs only of the FASTQs with a pattern, UMIs of the other FASTQ are used if fastq has no pattern.
+    """
+    with np.load(umi_table_file) as umi_table:
+        if f'{fastq}_umis' not in umi_table.files:
+            other_fastq = 'fq2' if fastq == 'fq1' else 'fq1'
+            logger.warning(f'No UMIs of {fastq} in {umi_table_file}, using UMIs of {other_fastq}')
+            fastq = other_fastq
+        umis = umi_table[f'{fastq}_umis']
+        counts = umi_table[f'{fastq}_counts']
+        read_umi_index = umi_table[f'{fastq}_read_umi_index']
+    umi_to_count = dict(zip(umis.tolist(), counts.tolist()))
+    read_umis = umis[read_umi_index]
+    return umi_to_count, read_umis, read_umis
@@ -9,6 +9,7 @@ process PyUMI {
         path params.out_pyumi_fq1, emit: fq1
         path params.out_pyumi_fq2, emit: fq2
         path params.out_pyumi_json, emit: json
+        path params.out_pyumi_umi_table, emit: umi_table, optional: true
     script:
         """
         python3.9 /usr/local/run.py \
@@ -18,6 +19,12 @@ process PyUMI {
             --fq2-pattern "${params.fq2_pattern ? params.fq2_pattern : ''}" \
             --out-fq1 ${params.out_pyumi_fq1} \
             --out-fq2 ${params.out_pyumi_fq2} \
-            --out-json ${params.out_pyumi_json}
+            --out-json ${params.out_pyumi_json} \
+            ${params.run_umi_reporter ? "--out-umi-table ${params.out_pyumi_umi_table}" : ''} \
+            ${params.pyumi_preflight ? "--preflight ${params.pyumi_preflight}" : ''} \
+            ${params.pyumi_preflight_min_match_rate != null ? "--preflight-min-match-rate ${params.pyumi_preflight_min_match_rate}" : ''} \
+            ${params.pyumi_match_timeout != null ? "--match-timeout ${params.pyumi_match_timeout}" : ''} \
+            ${params.pyumi_parallel_reading ? '--parallel-reading' : ''} \
+            ${task.memory ? "--max-memory ${task.memory.toBytes()}" : ''}
         """
 }
\ No newline at end of file
@@ -7,6 +7,7 @@ process Reporter {
         path fq2_pyumi
         path fq1_calib
         path fq2_calib
+        path umi_table
     output:
         path params.out_report_file, emit: html
     script:
@@ -16,6 +17,7 @@ process Reporter {
             --in-fq2-pyumi $fq2_pyumi \
             --in-fq1-calib $fq1_calib \
             --in-fq2-calib $fq2_calib \
+            --in-umi-table $umi_table \
             --report-file ${params.out_report_file}
         """
 }
\ No newline at end of file
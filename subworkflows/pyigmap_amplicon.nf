@@ -24,11 +24,11 @@ workflow PYIGMAP_AMPLICON_WITH_UMI {
         fq2
 
     main:
-        PyUMI(fq1, fq2)
+        PyUMI(fq1.toSortedList(), fq2.toSortedList())  // lanes are processed by one run
         CalibDedup(PyUMI.out.fq1, PyUMI.out.fq2, PyUMI.out.json)
 
         if (params.run_umi_reporter) {
-            Reporter(PyUMI.out.fq1, PyUMI.out.fq2, CalibDedup.out.fq1, CalibDedup.out.fq2)
+            Reporter(PyUMI.out.fq1, PyUMI.out.fq2, CalibDedup.out.fq1, CalibDedup.out.fq2, PyUMI.out.umi_table)
         }
 
         igblast_ref = file(params.igblast_ref)